@@ -0,0 +1,217 @@
+"""Activation checkpointing for the backbones of the hybrid model.
+
+Training ``HybridSkinCancerModel`` keeps every intermediate activation of
+Swin-Tiny and EfficientNet-B0 alive until backward, which is what limits the
+batch size. With checkpointing, only the input of each wrapped unit is kept;
+its inside is recomputed during backward (roughly one extra forward pass of
+the wrapped part):
+
+    enable_activation_checkpointing(hybrid_model, swin='block', efficientnet='stage')
+    memory_report(hybrid_model, batch_sizes=(16, 32, 64, 128))
+
+Granularity: ``'stage'`` wraps the 4 Swin stages / 7 MBConv stages (fewest
+stored boundaries, but backward rebuilds a whole stage at once), ``'block'``
+wraps every Swin block / MBConv block (more boundaries, the recompute peak
+is one block); ``every=2`` wraps only every second unit. Modules are patched in place, so parameter
+names, ``state_dict`` and saved checkpoints do not change. Nothing is
+recomputed in eval mode or under ``torch.no_grad()``.
+
+BatchNorm layers inside a recomputed unit would update their running
+statistics a second time during backward; the recompute runs with their
+momentum set to zero, so the statistics match a run without checkpointing.
+"""
+
+import contextlib
+import copy
+import functools
+import time
+
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+GRANULARITIES = ('stage', 'block')
+
+_UNITS = {
+    # Backbone: granularity -> module class names
+    'swin': {'stage': ('SwinTransformerStage',), 'block': ('SwinTransformerBlock',)},
+    'efficientnet': {'stage': (), 'block': ('MBConv', 'FusedMBConv')},
+}
+
+
+def units(backbone, kind, granularity):
+    """Modules of ``backbone`` to wrap, in forward order."""
+    if granularity not in GRANULARITIES:
+        raise ValueError(f'granularity must be one of {GRANULARITIES}, got {granularity!r}')
+    if kind == 'efficientnet' and granularity == 'stage':
+        # torchvision's stages are plain Sequentials of MBConv blocks
+        blocks = _UNITS['efficientnet']['block']
+        return [module for module in backbone.modules() if isinstance(module, nn.Sequential) and len(module)
+                and all(type(child).__name__ in blocks for child in module)]
+    names = _UNITS[kind][granularity]
+    return [module for module in backbone.modules() if type(module).__name__ in names]
+
+
+@contextlib.contextmanager
+def _frozen_norm_stats(module):
+    norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in norms]
+    for m in norms:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, (momentum, tracked) in zip(norms, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(tracked)
+
+
+_tracker = None  # Set by memory_report while it counts saved activations
+
+
+def _checkpointed_forward(module, *args, **kwargs):
+    forward = functools.partial(type(module).forward, module)
+    if not (module.training and torch.is_grad_enabled()):
+        return forward(*args, **kwargs)
+    if _tracker is not None:
+        for arg in args:
+            if torch.is_tensor(arg):
+                _tracker.pack(arg)  # The unit's input is all it keeps for backward
+    return checkpoint(forward, *args, use_reentrant=False,
+                      context_fn=lambda: (contextlib.nullcontext(), _frozen_norm_stats(module)), **kwargs)
+
+
+def checkpoint_module(module):
+    """Makes ``module`` recompute its activations in backward (training only)."""
+    # A partial rather than a closure, so deepcopy/pickle of the model bind the copy
+    module.forward = functools.partial(_checkpointed_forward, module)
+
+
+def uncheckpoint_module(module):
+    vars(module).pop('forward', None)
+
+
+def enable_activation_checkpointing(model, swin='block', efficientnet=None, every=1):
+    """Wraps units of ``model.swin_transformer`` and ``model.efficientnet``
+    (None leaves a backbone alone). Returns the number of wrapped modules."""
+    disable_activation_checkpointing(model)
+    count = 0
+    for kind, backbone, granularity in (('swin', model.swin_transformer, swin),
+                                        ('efficientnet', model.efficientnet, efficientnet)):
+        if granularity is None:
+            continue
+        for module in units(backbone, kind, granularity)[::every]:
+            checkpoint_module(module)
+            count += 1
+    return count
+
+
+def disable_activation_checkpointing(model):
+    for module in model.modules():
+        uncheckpoint_module(module)
+
+
+def _train_step(model, inputs, labels, autocast):
+    with autocast:
+        loss = nn.functional.cross_entropy(model(inputs).float(), labels)
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+
+
+class _SavedActivations:
+    """Bytes of the tensors autograd holds for backward after the forward pass
+    (the activation memory checkpointing trades away), each storage counted
+    once. Used on CPU, where torch has no peak allocation counter."""
+
+    def __init__(self, model):
+        self.storages = {}
+        self.parameters = {p.untyped_storage().data_ptr() for p in model.parameters()}
+
+    def pack(self, tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in self.parameters:  # Weights are not activations
+            self.storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    def unpack(self, tensor):
+        return tensor
+
+    @property
+    def nbytes(self):
+        return sum(self.storages.values())
+
+
+def _measure(model, batch_size, device, autocast, steps, size):
+    inputs = torch.randn(batch_size, 3, size, size, device=device)
+    labels = torch.randint(0, 2, (batch_size,), device=device)
+    _train_step(model, inputs, labels, autocast)  # Warm-up
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline = torch.cuda.memory_allocated(device)
+        start = time.perf_counter()
+        for _ in range(steps):
+            _train_step(model, inputs, labels, autocast)
+        torch.cuda.synchronize(device)
+        elapsed = time.perf_counter() - start
+        return torch.cuda.max_memory_allocated(device) - baseline, batch_size * steps / elapsed
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        _train_step(model, inputs, labels, autocast)
+    elapsed = time.perf_counter() - start
+
+    # One more forward to count what it saves for backward
+    global _tracker
+    _tracker = _SavedActivations(model)
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(_tracker.pack, _tracker.unpack), autocast:
+            loss = nn.functional.cross_entropy(model(inputs).float(), labels)
+        saved = _tracker.nbytes
+    finally:
+        _tracker = None
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+    return saved, batch_size * steps / elapsed
+
+
+DEFAULT_CONFIGS = {
+    'none': {'swin': None, 'efficientnet': None},
+    'swin stage': {'swin': 'stage', 'efficientnet': None},
+    'swin block': {'swin': 'block', 'efficientnet': None},
+    'swin + effnet block': {'swin': 'block', 'efficientnet': 'block'},
+}
+
+
+def memory_report(model, batch_sizes=(16, 32, 64, 128), configs=None, device='cpu', precision='fp32', steps=2,
+                  size=224):
+    """Training-step memory and throughput for each checkpointing config and
+    batch size, on random inputs. Runs on a copy of ``model``. On CUDA the
+    memory column is the allocator's peak, on CPU the activations held for
+    backward after the forward pass (without the transient recompute of one
+    unit). Returns the rows it prints."""
+    device = torch.device(device)
+    configs = configs or DEFAULT_CONFIGS
+    model = copy.deepcopy(model).to(device).train()
+    dtype = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[precision]
+    autocast = torch.autocast(device.type, dtype=dtype or torch.float32, enabled=dtype is not None)
+
+    rows = []
+    print(f'{"config":>20} {"batch":>6} {"memory MB":>10} {"img/s":>8}')
+    for name, config in configs.items():
+        enable_activation_checkpointing(model, **config)
+        for batch_size in batch_sizes:
+            try:
+                memory, throughput = _measure(model, batch_size, device, autocast, steps, size)
+            except (RuntimeError, MemoryError) as error:  # Out of memory
+                print(f'{name:>20} {batch_size:>6} {"OOM":>10} {"-":>8}  ({str(error).splitlines()[0][:60]})')
+                rows.append({'config': name, 'batch_size': batch_size, 'memory_mb': None, 'images_per_sec': None})
+                if device.type == 'cuda':
+                    torch.cuda.empty_cache()
+                continue
+            rows.append({'config': name, 'batch_size': batch_size, 'memory_mb': memory / 2 ** 20,
+                         'images_per_sec': throughput})
+            print(f'{name:>20} {batch_size:>6} {memory / 2 ** 20:>10.0f} {throughput:>8.1f}')
+    disable_activation_checkpointing(model)
+    return rows
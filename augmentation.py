@@ -0,0 +1,283 @@
+"""Batched augmentation for the PyTorch training scripts.
+
+The per-image PIL transform chains (RandomResizedCrop, RandomRotation, flips,
+ColorJitter, ToTensor, Normalize) run once per sample inside the Dataset and
+pay Python overhead on every image. ``BatchAugment`` does the same work on a
+whole collated uint8 batch after it has been moved to the training device:
+all geometric transforms are folded into one per-sample affine matrix and
+applied with a single ``grid_sample`` call, colour jitter is a handful of
+broadcast tensor ops, and normalization happens last.
+
+Feed it raw uint8 images, e.g. ``CachedImageFolder(..., as_pil=False)``:
+
+    augment = BatchAugment(rotation=10, hflip=True, brightness=0.2).to(device)
+    images = augment(images.to(device))         # random, in train() mode
+    images = augment.normalize(images.to(device))  # deterministic, for eval
+"""
+
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+def _rand(n, device, generator=None):
+    # Drawn on the generator's own device, so a seeded CPU generator also serves CUDA batches
+    if generator is None:
+        return torch.rand(n, device=device)
+    return torch.rand(n, device=generator.device, generator=generator).to(device)
+
+
+def _uniform(low, high, n, device, generator=None):
+    return low + (high - low) * _rand(n, device, generator)
+
+
+def _grayscale(images):
+    # Same weights as torchvision.transforms.functional.rgb_to_grayscale
+    r, g, b = images.unbind(dim=1)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(1)
+
+
+def _blend(images, other, factor):
+    return (factor * images + (1 - factor) * other).clamp(0, 1)
+
+
+def _rgb_to_hsv(images):
+    r, g, b = images.unbind(dim=1)
+    maxc = images.amax(dim=1)
+    minc = images.amin(dim=1)
+    delta = maxc - minc
+    eq = maxc == minc
+
+    s = delta / torch.where(eq, torch.ones_like(maxc), maxc)
+    delta_safe = torch.where(eq, torch.ones_like(delta), delta)
+    rc = (maxc - r) / delta_safe
+    gc = (maxc - g) / delta_safe
+    bc = (maxc - b) / delta_safe
+
+    h = torch.where(maxc == r, bc - gc,
+                    torch.where(maxc == g, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = torch.where(eq, torch.zeros_like(h), h)
+    h = (h / 6.0) % 1.0
+    return torch.stack((h, s, maxc), dim=1)
+
+
+def _hsv_to_rgb(images):
+    h, s, v = images.unbind(dim=1)
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.to(torch.int64) % 6
+
+    p = (v * (1.0 - s)).clamp(0, 1)
+    q = (v * (1.0 - s * f)).clamp(0, 1)
+    t = (v * (1.0 - s * (1.0 - f))).clamp(0, 1)
+
+    mask = i.unsqueeze(1) == torch.arange(6, device=images.device).view(1, -1, 1, 1)
+    r = torch.stack((v, q, p, p, t, v), dim=1)
+    g = torch.stack((t, v, v, q, p, p), dim=1)
+    b = torch.stack((p, p, t, v, v, q), dim=1)
+    return torch.stack([(channel * mask).sum(dim=1) for channel in (r, g, b)], dim=1)
+
+
+class BatchAugment(nn.Module):
+    """Random geometric and colour augmentation applied to a whole batch.
+
+    Every sample draws its own parameters from the same distributions as the
+    equivalent per-image transforms:
+
+    * ``resized_crop=(scale, ratio)``: ``transforms.RandomResizedCrop``
+    * ``rotation``: ``transforms.RandomRotation`` / Keras ``rotation_range`` (degrees)
+    * ``shear``: Keras ``shear_range`` (degrees)
+    * ``zoom``: Keras ``zoom_range``, independent x/y factors in ``[1 - zoom, 1 + zoom]``
+    * ``shift``: Keras ``width_shift_range``/``height_shift_range`` (fraction of the side)
+    * ``hflip``/``vflip``: flips with probability 0.5
+    * ``brightness``/``contrast``/``saturation``/``hue``: ``transforms.ColorJitter``
+
+    ``resized_crop`` follows ``RandomResizedCrop.get_params``: up to ten
+    (area, ratio) draws per sample, the first crop that fits the image is
+    used, and a centre crop with the ratio clamped into range otherwise. Crop
+    sizes are continuous rather than rounded to whole pixels.
+
+    Like ColorJitter the four colour ops run in random order, but the order is
+    drawn once per batch rather than once per image. Out-of-frame pixels are
+    black (``padding_mode='zeros'``, torchvision) or edge-replicated
+    (``padding_mode='border'``, Keras ``fill_mode='nearest'``).
+
+    Inputs are uint8 ``(N, H, W, C)`` or ``(N, C, H, W)`` batches; the output is
+    a normalized float ``(N, C, size, size)`` batch. In ``eval()`` mode only the
+    conversion and normalization are applied. ``generator`` (a seeded
+    ``torch.Generator``, on any device) makes the random draws reproducible.
+    """
+
+    def __init__(self, size=None, resized_crop=None, rotation=0.0, shear=0.0, zoom=0.0, shift=0.0,
+                 hflip=False, vflip=False, brightness=0.0, contrast=0.0, saturation=0.0, hue=0.0,
+                 mean=IMAGENET_MEAN, std=IMAGENET_STD, padding_mode='zeros', generator=None):
+        super(BatchAugment, self).__init__()
+        self.size = size
+        self.resized_crop = resized_crop
+        self.rotation = rotation
+        self.shear = shear
+        self.zoom = zoom
+        self.shift = shift
+        self.hflip = hflip
+        self.vflip = vflip
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.padding_mode = padding_mode
+        self.generator = generator
+
+        self.register_buffer('mean', torch.tensor(mean if mean is not None else (0.0, 0.0, 0.0)).view(1, -1, 1, 1))
+        self.register_buffer('std', torch.tensor(std if std is not None else (1.0, 1.0, 1.0)).view(1, -1, 1, 1))
+
+    @property
+    def has_geometry(self):
+        return bool(self.resized_crop or self.rotation or self.shear or self.zoom or self.shift
+                    or self.hflip or self.vflip)
+
+    def to_float(self, images):
+        if images.dim() == 4 and images.shape[-1] in (1, 3) and images.shape[1] not in (1, 3):
+            images = images.permute(0, 3, 1, 2)
+        if images.dtype == torch.uint8:
+            images = images.float() / 255.0
+        else:
+            images = images.float()
+        return images.contiguous(memory_format=torch.channels_last)
+
+    def normalize(self, images):
+        """Deterministic path: uint8 batch -> resized, normalized float batch."""
+        images = self.to_float(images)
+        if self.size is not None and images.shape[-2:] != (self.size, self.size):
+            images = F.interpolate(images, size=(self.size, self.size), mode='bilinear',
+                                   align_corners=False, antialias=True)
+        return (images - self.mean) / self.std
+
+    def _crop_size(self, n, device, input_aspect, attempts=10):
+        # Width and height of each sample's crop as fractions of the input's,
+        # plus whether a draw fitted (the others are centre crops).
+        # input_aspect is the input's width / height
+        scale, ratio = self.resized_crop
+        g = self.generator
+        area = _uniform(scale[0], scale[1], attempts * n, device, g).view(attempts, n)
+        aspect = torch.exp(_uniform(math.log(ratio[0]), math.log(ratio[1]), attempts * n, device, g)).view(attempts, n)
+        w = torch.sqrt(area * aspect / input_aspect)
+        h = torch.sqrt(area * input_aspect / aspect)
+        fits = (w <= 1) & (h <= 1)
+        first = fits.int().argmax(dim=0, keepdim=True)  # First attempt that fits, 0 if none does
+        found = fits.any(dim=0)
+
+        if input_aspect < min(ratio):
+            fallback = (1.0, input_aspect / min(ratio))
+        elif input_aspect > max(ratio):
+            fallback = (max(ratio) / input_aspect, 1.0)
+        else:
+            fallback = (1.0, 1.0)
+        w = torch.where(found, w.gather(0, first).squeeze(0), fallback[0])
+        h = torch.where(found, h.gather(0, first).squeeze(0), fallback[1])
+        return w, h, found
+
+    def _affine(self, n, device, input_aspect=1.0):
+        # Builds, per sample, the 2x3 matrix mapping output pixel offsets from
+        # the image centre (in units of half the side) to input offsets.
+        # Transforms compose in the same order as the torchvision chains:
+        # crop first, then rotation/shear/zoom/shift, then flips.
+        g = self.generator
+        theta = torch.eye(3, device=device).repeat(n, 1, 1)
+
+        def compose(matrix):
+            nonlocal theta
+            theta = theta @ matrix
+
+        if self.resized_crop:
+            w, h, found = self._crop_size(n, device, input_aspect)
+            cx = _uniform(-1.0, 1.0, n, device, g) * (1 - w) * found
+            cy = _uniform(-1.0, 1.0, n, device, g) * (1 - h) * found
+            m = torch.zeros(n, 3, 3, device=device)
+            m[:, 0, 0], m[:, 1, 1], m[:, 2, 2] = w, h, 1.0
+            m[:, 0, 2], m[:, 1, 2] = cx, cy
+            compose(m)
+
+        if self.shift:
+            m = torch.eye(3, device=device).repeat(n, 1, 1)
+            m[:, 0, 2] = 2 * _uniform(-self.shift, self.shift, n, device, g)
+            m[:, 1, 2] = 2 * _uniform(-self.shift, self.shift, n, device, g)
+            compose(m)
+
+        if self.rotation:
+            angle = torch.deg2rad(_uniform(-self.rotation, self.rotation, n, device, g))
+            cos, sin = torch.cos(angle), torch.sin(angle)
+            m = torch.eye(3, device=device).repeat(n, 1, 1)
+            m[:, 0, 0], m[:, 0, 1] = cos, -sin
+            m[:, 1, 0], m[:, 1, 1] = sin, cos
+            compose(m)
+
+        if self.shear:
+            angle = torch.deg2rad(_uniform(-self.shear, self.shear, n, device, g))
+            m = torch.eye(3, device=device).repeat(n, 1, 1)
+            m[:, 0, 1] = -torch.sin(angle)
+            m[:, 1, 1] = torch.cos(angle)
+            compose(m)
+
+        if self.zoom:
+            m = torch.eye(3, device=device).repeat(n, 1, 1)
+            m[:, 0, 0] = _uniform(1 - self.zoom, 1 + self.zoom, n, device, g)
+            m[:, 1, 1] = _uniform(1 - self.zoom, 1 + self.zoom, n, device, g)
+            compose(m)
+
+        flips = torch.ones(n, 2, device=device)
+        if self.hflip:
+            flips[:, 0] = torch.where(_rand(n, device, g) < 0.5, -1.0, 1.0)
+        if self.vflip:
+            flips[:, 1] = torch.where(_rand(n, device, g) < 0.5, -1.0, 1.0)
+        theta = theta @ torch.diag_embed(torch.cat((flips, torch.ones(n, 1, device=device)), dim=1))
+
+        return theta[:, :2]
+
+    def _color_jitter(self, images):
+        n, device, g = images.shape[0], images.device, self.generator
+
+        def factor(amount):
+            return _uniform(max(0.0, 1 - amount), 1 + amount, n, device, g).view(-1, 1, 1, 1)
+
+        ops = []
+        if self.brightness:
+            ops.append(lambda x: (x * factor(self.brightness)).clamp(0, 1))
+        if self.contrast:
+            ops.append(lambda x: _blend(x, _grayscale(x).mean(dim=(1, 2, 3), keepdim=True), factor(self.contrast)))
+        if self.saturation:
+            ops.append(lambda x: _blend(x, _grayscale(x), factor(self.saturation)))
+        if self.hue:
+            def adjust_hue(x):
+                hsv = _rgb_to_hsv(x)
+                shift = _uniform(-self.hue, self.hue, n, device, g).view(-1, 1, 1)
+                hsv = torch.stack(((hsv[:, 0] + shift) % 1.0, hsv[:, 1], hsv[:, 2]), dim=1)
+                return _hsv_to_rgb(hsv)
+            ops.append(adjust_hue)
+
+        for i in torch.randperm(len(ops), generator=g, device=g.device if g is not None else 'cpu').tolist():
+            images = ops[i](images)
+        return images
+
+    def forward(self, images):
+        if not self.training:
+            return self.normalize(images)
+
+        images = self.to_float(images)
+        size = self.size or images.shape[-1]
+
+        if self.has_geometry:
+            theta = self._affine(images.shape[0], images.device, images.shape[-1] / images.shape[-2])
+            grid = F.affine_grid(theta, (images.shape[0], images.shape[1], size, size), align_corners=False)
+            images = F.grid_sample(images, grid, mode='bilinear', padding_mode=self.padding_mode,
+                                   align_corners=False)
+        elif images.shape[-2:] != (size, size):
+            images = F.interpolate(images, size=(size, size), mode='bilinear', align_corners=False,
+                                   antialias=True)
+
+        images = self._color_jitter(images)
+        return (images - self.mean) / self.std
@@ -0,0 +1,124 @@
+"""Bottleneck-feature caching for frozen Keras backbones.
+
+With ``base_model.trainable = False`` (vgg16.py, the VGG16 half of dccn.py)
+``model.fit`` still pushes every image through all conv blocks every epoch,
+about 15 GFLOPs per image just to train a small Dense head. Since the frozen
+base always maps the same image to the same features, it is run once:
+
+    features = cache_bottleneck_features(base_model, pipeline, '/content/bottlenecks/vgg16_train')
+    head = head_model(model, base_model)
+    head.compile(...)
+    head.fit(features.dataset(batch_size=32, shuffle=True), epochs=10)
+
+The base outputs (7x7x512 for VGG16 at 224x224) are stored as float16 in a
+memory-mapped file. ``head_model`` shares its layers with ``model``, so after
+training the head the full image model is trained too. With ``views > 1`` and
+an augmenting pipeline, that many augmented versions of every image are
+cached, a fixed sample of the augmentation distribution.
+
+A cache is reused as long as the images (their content, from the dataset
+manifest), the pipeline's augmentation and preprocessing, the number of
+views and the base weights are unchanged.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers, models
+
+
+def weights_fingerprint(model):
+    digest = hashlib.sha1()
+    for weights in model.get_weights():
+        digest.update(np.ascontiguousarray(weights).tobytes())
+    return digest.hexdigest()
+
+
+class BottleneckFeatures:
+    """Cached base-model outputs and their labels."""
+
+    def __init__(self, path):
+        with open(path + '.json') as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.labels = np.load(path + '.labels.npy')
+        self.features = np.memmap(path + '.f16', dtype=np.float16, mode='r',
+                                  shape=tuple(self.meta['shape']))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def dataset(self, batch_size=32, shuffle=False, seed=None):
+        """Batches of ``(features, labels)`` read straight from the memmap."""
+        n = len(self.labels)
+        rng = np.random.default_rng(seed)
+
+        def batches():
+            order = rng.permutation(n) if shuffle else np.arange(n)
+            for start in range(0, n, batch_size):
+                # Sorted indices keep reads from the memmap mostly sequential
+                index = np.sort(order[start:start + batch_size])
+                yield self.features[index].astype(np.float32), self.labels[index]
+
+        dataset = tf.data.Dataset.from_generator(batches, output_signature=(
+            tf.TensorSpec((None,) + self.features.shape[1:], tf.float32),
+            tf.TensorSpec((None,) + self.labels.shape[1:], tf.as_dtype(self.labels.dtype))))
+        dataset = dataset.apply(tf.data.experimental.assert_cardinality(-(-n // batch_size)))
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def cache_bottleneck_features(base_model, pipeline, path, views=1, overwrite=False):
+    """Runs ``base_model`` over every batch of ``pipeline`` (a
+    ``keras_pipeline.ImagePipeline``) ``views`` times and stores the outputs.
+
+    Labels are taken from the batches themselves, so the pipeline may shuffle;
+    use a non-augmenting pipeline with ``views=1`` for the exact features.
+    """
+    fingerprint = weights_fingerprint(base_model)
+    meta = {
+        'shape': [pipeline.samples * views] + [int(d) for d in base_model.output_shape[1:]],
+        'views': views,
+        'samples': pipeline.samples,
+        'files': hashlib.sha1('\n'.join(pipeline.filenames or []).encode()).hexdigest(),
+        'fingerprint': pipeline.fingerprint,
+        'pipeline': pipeline.config,
+        'augmented': pipeline.augmented,
+        'weights': fingerprint,
+    }
+    meta = json.loads(json.dumps(meta))  # Tuples become lists, as in the stored copy
+
+    if not overwrite and os.path.exists(path + '.json'):
+        cached = BottleneckFeatures(path)
+        if cached.meta == meta:
+            return cached
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    features = np.memmap(path + '.f16', dtype=np.float16, mode='w+', shape=tuple(meta['shape']))
+    labels = []
+
+    offset = 0
+    for view in range(views):
+        for images, batch_labels in pipeline.dataset:
+            outputs = base_model(images, training=False).numpy()
+            features[offset:offset + len(outputs)] = outputs
+            labels.append(batch_labels.numpy())
+            offset += len(outputs)
+        print(f'[bottleneck] {path}: view {view + 1}/{views} cached ({offset} feature maps)')
+
+    features.flush()
+    del features
+    np.save(path + '.labels.npy', np.concatenate(labels))
+    # The metadata is written last so an interrupted run is never reused
+    with open(path + '.json', 'w') as f:
+        json.dump(meta, f)
+    return BottleneckFeatures(path)
+
+
+def head_model(model, base_model):
+    """The layers of ``model`` that follow ``base_model``, as a model taking
+    the base's output. Layers (and weights) are shared with ``model``."""
+    head_layers = [layer for layer in model.layers if layer is not base_model]
+    return models.Sequential([layers.Input(shape=base_model.output_shape[1:])] + head_layers)
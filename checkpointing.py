@@ -0,0 +1,158 @@
+"""Asynchronous, resumable training checkpoints.
+
+``CheckpointManager`` writes snapshots of a training run (model, optimizer,
+scheduler, RNG states and the position in the epoch) so a pre-empted run can
+continue where it stopped, even in the middle of an epoch:
+
+    checkpoints = CheckpointManager('/content/drive/MyDrive/checkpoints/swim', every_steps=200)
+    trainer = Trainer(model, optimizer, criterion, device, checkpoint=checkpoints)
+    for epoch in range(trainer.resume(), num_epochs):   # 0 for a fresh run
+        trainer.train_epoch(train_loader)
+        trainer.save_checkpoint(metric=val_accuracy)    # also tracks the best epoch
+
+The training loop is only blocked while the state is copied to CPU memory;
+``torch.save``, the fsync and the rename run on a background thread. The last
+``keep_last`` checkpoints are kept, plus ``best.pt`` for the best ``metric``
+seen (``mode='max'`` or ``'min'``). Files are written to a temporary name and
+renamed, so a crash during a write never leaves a truncated checkpoint.
+"""
+
+import json
+import os
+import random
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+_NAME = re.compile(r'^ckpt-(\d+)\.pt$')
+
+
+def to_cpu(obj):
+    """Deep copy of a (nested) state dict with every tensor cloned to CPU."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _write(state, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    # Make the rename itself durable
+    directory = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+class CheckpointManager:
+    """Keeps ``ckpt-<step>.pt`` files and ``best.pt`` in ``directory``.
+
+    ``every_steps`` is read by the ``Trainer``: a snapshot is taken every that
+    many optimizer steps (0 disables the in-epoch snapshots).
+    """
+
+    def __init__(self, directory, keep_last=3, every_steps=500, mode='max'):
+        if mode not in ('max', 'min'):
+            raise ValueError(f"mode must be 'max' or 'min', got {mode!r}")
+        self.directory = directory
+        self.keep_last = keep_last
+        self.every_steps = every_steps
+        self.mode = mode
+        os.makedirs(directory, exist_ok=True)
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint')
+        self._pending = None
+        self.best_metric = None
+        best_info = os.path.join(directory, 'best.json')
+        if os.path.exists(best_info):
+            with open(best_info) as f:
+                self.best_metric = json.load(f)['metric']
+
+    def checkpoints(self):
+        """Existing checkpoint paths, oldest first."""
+        found = []
+        for name in os.listdir(self.directory):
+            match = _NAME.match(name)
+            if match:
+                found.append((int(match.group(1)), os.path.join(self.directory, name)))
+        return [path for _, path in sorted(found)]
+
+    def latest(self):
+        paths = self.checkpoints()
+        return paths[-1] if paths else None
+
+    def is_better(self, metric):
+        if metric is None:
+            return False
+        if self.best_metric is None:
+            return True
+        return metric > self.best_metric if self.mode == 'max' else metric < self.best_metric
+
+    def save(self, step, state, metric=None):
+        """Copies ``state`` to CPU and writes it in the background. Waits for
+        the previous write first, so at most one snapshot is held in memory."""
+        snapshot = to_cpu(state)
+        self.wait()
+        best = self.is_better(metric)
+        if best:
+            self.best_metric = metric
+        self._pending = self._executor.submit(self._save, step, snapshot, metric if best else None)
+
+    def _save(self, step, snapshot, best_metric):
+        path = os.path.join(self.directory, f'ckpt-{step:09d}.pt')
+        _write(snapshot, path)
+        if best_metric is not None:
+            best = os.path.join(self.directory, 'best.pt')
+            shutil.copyfile(path, best + '.tmp')
+            os.replace(best + '.tmp', best)
+            with open(os.path.join(self.directory, 'best.json'), 'w') as f:
+                json.dump({'metric': best_metric, 'step': step}, f)
+        for old in self.checkpoints()[:-self.keep_last]:
+            os.remove(old)
+
+    def wait(self):
+        """Blocks until the background write (if any) has finished; raises its error."""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def load(self, path=None, map_location='cpu'):
+        """The latest checkpoint (or ``path``, e.g. ``'best'``), None if there is none."""
+        self.wait()
+        if path == 'best':
+            path = os.path.join(self.directory, 'best.pt')
+        path = path or self.latest()
+        if path is None or not os.path.exists(path):
+            return None
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
@@ -0,0 +1,440 @@
+"""Training several models in lockstep from one decode/augment stream.
+
+VGG16, the DCNN, EfficientNet-B0, Swin-Tiny and the hybrid all train on the
+same images, and run as separate scripts each of them decodes and augments
+the whole dataset every epoch. ``CoTrainer`` reads and augments every batch
+once, then hands each model the view it needs (resized to its input size,
+ImageNet-normalized or in ``[0, 1]``). Every model steps on every batch with
+its own optimizer, loss and metrics:
+
+    stream = SharedStream(BatchAugment(hflip=True, rotation=10, mean=None, std=None))
+    trainer = CoTrainer(stream, [build_member('efficientnet_b0'), build_member('dccn')], mode='thread')
+    history = trainer.fit(train_loader, epochs=10, val_loader=val_loader)
+    trainer.close()
+
+or for the five models at once:
+
+    python co_training.py /content/drive/MyDrive/data/train --val /content/drive/MyDrive/data/test
+
+With ``mode='thread'`` the members step in threads of this process (PyTorch
+and TensorFlow release the GIL in their kernels); with ``mode='process'``
+each member is built and trained in its own spawned process and the views
+travel through shared memory, so members must then be given as picklable
+factories (e.g. ``functools.partial(build_member, 'vgg16')``) and are saved
+to ``save_dir`` on ``close()``. A bounded queue per member keeps the stream
+at most ``prefetch`` batches ahead of the slowest model.
+
+All members see the same augmentation (geometric and colour ops of the
+stream); only the resize and normalization differ per model. Every epoch
+prints each member's loss, accuracy and step time, and the time the shared
+input pipeline took, which separate runs would have spent once per model.
+"""
+
+import argparse
+import functools
+import os
+import queue
+import threading
+import time
+import traceback
+
+import torch
+import torch.nn.functional as F
+
+from augmentation import IMAGENET_MEAN, IMAGENET_STD
+from metrics import ConfusionMatrix
+from training_engine import PRECISIONS, logits_of, param_groups
+
+NORMALIZATIONS = ('imagenet', 'unit')
+
+
+class SharedStream:
+    """Augments each loader batch once and derives the per-member views.
+
+    ``augment`` must produce ``[0, 1]`` images (a ``BatchAugment`` built with
+    ``mean=None, std=None``); it runs in ``train()`` mode for training
+    epochs and only converts in ``eval()`` mode.
+    """
+
+    def __init__(self, augment, device='cpu'):
+        if not (torch.all(augment.mean == 0) and torch.all(augment.std == 1)):
+            raise ValueError('the shared augmentation must output [0, 1] images: use mean=None, std=None')
+        self.device = torch.device(device)
+        self.augment = augment.to(self.device)
+        self.mean = torch.tensor(IMAGENET_MEAN, device=self.device).view(1, -1, 1, 1)
+        self.std = torch.tensor(IMAGENET_STD, device=self.device).view(1, -1, 1, 1)
+
+    def __call__(self, images, training):
+        self.augment.train(training)
+        with torch.no_grad():
+            return self.augment(images.to(self.device, non_blocking=True))
+
+    def views(self, images, specs):
+        """``{(size, normalization): batch}`` for every requested spec; each
+        size is resized once even if several members use it."""
+        resized, views = {}, {}
+        with torch.no_grad():
+            for size, normalization in specs:
+                if (size, normalization) in views:
+                    continue
+                if size not in resized:
+                    resized[size] = images if images.shape[-1] == size else F.interpolate(
+                        images, size=(size, size), mode='bilinear', align_corners=False, antialias=True)
+                view = resized[size]
+                if normalization == 'imagenet':
+                    view = (view - self.mean) / self.std
+                views[(size, normalization)] = view.contiguous()
+        return views
+
+
+class TorchMember:
+    """A PyTorch model with its optimizer, criterion and metrics."""
+
+    def __init__(self, name, model, optimizer, criterion, size=224, normalization='imagenet', device='cpu',
+                 precision='fp32', scheduler=None):
+        if normalization not in NORMALIZATIONS:
+            raise ValueError(f'normalization must be one of {NORMALIZATIONS}, got {normalization!r}')
+        self.name = name
+        self.device = torch.device(device)
+        self.model = model.to(self.device)
+        self.optimizer = optimizer
+        self.criterion = criterion
+        self.size = size
+        self.normalization = normalization
+        self.precision = precision
+        self.scheduler = scheduler
+
+    def autocast(self):
+        dtype = PRECISIONS[self.precision]
+        return torch.autocast(device_type=self.device.type, dtype=dtype or torch.float32, enabled=dtype is not None)
+
+    def start_epoch(self, training):
+        self.training = training
+        self.model.train(training)
+        self.total_loss = torch.zeros((), device=self.device)
+        self.metrics = None
+        self.seconds = 0.0
+        self.images = 0
+
+    def step(self, images, labels):
+        start = time.perf_counter()
+        images = images.to(self.device, non_blocking=True)
+        labels = labels.to(self.device, non_blocking=True)
+        with torch.set_grad_enabled(self.training):
+            with self.autocast():
+                outputs = logits_of(self.model(images)).float()
+            loss = self.criterion(outputs, labels)
+            if self.training:
+                self.optimizer.zero_grad(set_to_none=True)
+                loss.backward()
+                self.optimizer.step()
+        if self.metrics is None:
+            self.metrics = ConfusionMatrix(outputs.size(1), self.device)
+        self.metrics.update(outputs.detach().argmax(dim=1), labels)
+        self.total_loss += loss.detach() * labels.size(0)
+        self.images += labels.size(0)
+        self.seconds += time.perf_counter() - start
+
+    def end_epoch(self):
+        if self.training and self.scheduler is not None:
+            self.scheduler.step()
+        return {'loss': self.total_loss.item() / max(1, self.images),
+                'accuracy': self.metrics.accuracy() if self.metrics is not None else 0.0,
+                'confusion': self.metrics.matrix if self.metrics is not None else None,
+                'seconds': self.seconds, 'images': self.images}
+
+    def save(self, directory):
+        torch.save(self.model.state_dict(), os.path.join(directory, f'{self.name}.pth'))
+
+
+class KerasMember:
+    """A compiled Keras model (binary sigmoid output or softmax over the
+    classes) trained with ``train_on_batch`` on NHWC views."""
+
+    def __init__(self, name, model, size=150, normalization='unit'):
+        import tensorflow as tf
+
+        if normalization not in NORMALIZATIONS:
+            raise ValueError(f'normalization must be one of {NORMALIZATIONS}, got {normalization!r}')
+        self.name = name
+        self.model = model
+        self.size = size
+        self.normalization = normalization
+        self.binary = model.output_shape[-1] == 1
+        self.loss_fn = tf.keras.losses.get(model.loss)  # compile() keeps e.g. 'binary_crossentropy' as given
+
+    def start_epoch(self, training):
+        self.training = training
+        self.model.reset_metrics()
+        self.logs = {}
+        self.confusion = None
+        self.seconds = 0.0
+        self.images = 0
+
+    def step(self, images, labels):
+        start = time.perf_counter()
+        x = images.permute(0, 2, 3, 1).float().cpu().numpy()  # NCHW -> NHWC
+        y = labels.cpu().numpy()
+        y = y.astype('float32') if self.binary else y
+        if self.training:
+            self.logs = self.model.train_on_batch(x, y, return_dict=True)  # Metrics accumulate until reset_metrics()
+        else:
+            # Predictions rather than test_on_batch, for the confusion matrix
+            outputs = self.model.predict_on_batch(x)
+            preds = (outputs[:, 0] > 0.5).astype('int64') if self.binary else outputs.argmax(axis=1)
+            if self.confusion is None:
+                self.confusion = ConfusionMatrix(2 if self.binary else outputs.shape[1])
+                self.loss_sum = 0.0
+            self.confusion.update(torch.from_numpy(preds), labels.cpu())
+            self.loss_sum += float(self.loss_fn(y[:, None] if self.binary else y, outputs).numpy().mean()) * len(y)
+        self.images += len(y)
+        self.seconds += time.perf_counter() - start
+
+    def end_epoch(self):
+        if self.training:
+            loss, accuracy, confusion = self.logs.get('loss', 0.0), self.logs.get('accuracy', 0.0), None
+        else:
+            loss = self.loss_sum / max(1, self.images) if self.confusion is not None else 0.0
+            accuracy = self.confusion.accuracy() if self.confusion is not None else 0.0
+            confusion = self.confusion.matrix if self.confusion is not None else None
+        return {'loss': float(loss), 'accuracy': float(accuracy), 'confusion': confusion,
+                'seconds': self.seconds, 'images': self.images}
+
+    def save(self, directory):
+        self.model.save(os.path.join(directory, f'{self.name}.keras'))
+
+
+def _serve(index, member, inbox, outbox, threads=None):
+    """Member loop, in a thread or a spawned process. Messages to ``outbox``
+    are ``(kind, index, name, payload)``. After a failure (reported once) it
+    keeps draining its inbox so the stream never blocks on it."""
+    if threads:
+        for name in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS'):
+            os.environ[name] = str(threads)  # Before the factory imports its framework
+        torch.set_num_threads(threads)
+    name, failed = getattr(member, 'name', None), False
+    try:
+        if not hasattr(member, 'step'):
+            member = member()  # A factory, called in the worker
+        name = member.name
+        outbox.put(('ready', index, name, (member.size, member.normalization)))
+    except Exception:
+        outbox.put(('error', index, name, traceback.format_exc()))
+        failed = True
+    while True:
+        command, payload = inbox.get()
+        if command == 'stop':
+            if not failed and payload:
+                try:
+                    member.save(payload)
+                except Exception:
+                    traceback.print_exc()
+            return
+        if failed:
+            continue
+        try:
+            if command == 'start':
+                member.start_epoch(payload)
+            elif command == 'batch':
+                member.step(*payload)
+            elif command == 'end':
+                outbox.put(('result', index, name, member.end_epoch()))
+        except Exception:
+            failed = True
+            outbox.put(('error', index, name, traceback.format_exc()))
+
+
+class CoTrainer:
+    """Steps every member on every batch of a ``SharedStream``."""
+
+    def __init__(self, stream, members, mode='thread', prefetch=2, threads_per_member=None, save_dir=None):
+        if mode not in ('thread', 'process'):
+            raise ValueError(f"mode must be 'thread' or 'process', got {mode!r}")
+        self.stream = stream
+        self.mode = mode
+        self.save_dir = save_dir
+        self.history = []
+        if mode == 'process':
+            import torch.multiprocessing as mp
+
+            context = mp.get_context('spawn')
+            threads = threads_per_member or max(1, (os.cpu_count() or 1) // len(members))
+            self.outbox = context.Queue()
+            self.inboxes = [context.Queue(prefetch) for _ in members]
+            self.workers = [context.Process(target=_serve, args=(i, member, inbox, self.outbox, threads), daemon=True)
+                            for i, (member, inbox) in enumerate(zip(members, self.inboxes))]
+        else:
+            self.outbox = queue.Queue()
+            self.inboxes = [queue.Queue(prefetch) for _ in members]
+            self.workers = [threading.Thread(target=_serve, args=(i, member, inbox, self.outbox), daemon=True)
+                            for i, (member, inbox) in enumerate(zip(members, self.inboxes))]
+        self.members = members if mode == 'thread' else None  # The objects, to use after training
+        for worker in self.workers:
+            worker.start()
+
+        ready = self._collect('ready')
+        self.names = [name for name, _ in ready]
+        self.specs = [spec for _, spec in ready]
+
+    def _collect(self, kind):
+        # One message of `kind` (or an error) per worker; errors are raised here
+        messages, errors = {}, {}
+        while len(messages) + len(errors) < len(self.workers):
+            message_kind, index, name, payload = self.outbox.get()
+            if message_kind == 'error':
+                errors[index] = f'{name or index}: {payload}'
+            elif message_kind == kind:
+                messages[index] = (name, payload)
+        if errors:
+            self.close(save=False)
+            raise RuntimeError('co-training member failed:\n' + '\n'.join(errors.values()))
+        return [messages[i] for i in range(len(self.workers))]
+
+    def _broadcast(self, command, payload=None):
+        for inbox in self.inboxes:
+            inbox.put((command, payload))
+
+    def run_epoch(self, loader, training=True):
+        """One pass of every member over ``loader``. Returns ``{name: result}``
+        and the pipeline timings."""
+        self._broadcast('start', training)
+        timings = {'fetch': 0.0, 'augment': 0.0, 'views': 0.0, 'handoff': 0.0}
+        start = fetch_start = time.perf_counter()
+        for images, labels in loader:
+            t_augment = time.perf_counter()
+            images = self.stream(images, training)
+            t_views = time.perf_counter()
+            views = self.stream.views(images, self.specs)
+            t_handoff = time.perf_counter()
+            for inbox, spec in zip(self.inboxes, self.specs):
+                inbox.put(('batch', (views[spec], labels)))  # Blocks while this member is `prefetch` behind
+            timings['fetch'] += t_augment - fetch_start
+            timings['augment'] += t_views - t_augment
+            timings['views'] += t_handoff - t_views
+            fetch_start = time.perf_counter()
+            timings['handoff'] += fetch_start - t_handoff
+        self._broadcast('end')
+        results = dict(self._collect('result'))
+        timings['total'] = time.perf_counter() - start
+        return results, timings
+
+    def fit(self, train_loader, epochs, val_loader=None):
+        """Trains every member for ``epochs`` epochs. Returns ``{name: [epoch
+        results]}``, each with the ``train`` and ``val`` loss/accuracy."""
+        history = {name: [] for name in self.names}
+        for epoch in range(epochs):
+            train, timings = self.run_epoch(train_loader, training=True)
+            val = self.run_epoch(val_loader, training=False)[0] if val_loader is not None else {}
+            print(f'Epoch [{epoch + 1}/{epochs}]')
+            for name in self.names:
+                entry = {'train_loss': train[name]['loss'], 'train_acc': train[name]['accuracy'],
+                         'step_seconds': train[name]['seconds']}
+                if name in val:
+                    entry.update(val_loss=val[name]['loss'], val_acc=val[name]['accuracy'])
+                history[name].append(entry)
+                line = f"  {name:>16}: loss {entry['train_loss']:.4f}, acc {entry['train_acc']:.4f}"
+                if name in val:
+                    line += f", val loss {entry['val_loss']:.4f}, val acc {entry['val_acc']:.4f}"
+                print(line + f", {train[name]['seconds']:.0f}s stepping")
+            self.report(timings)
+            self.history.append(timings)
+        return history
+
+    def report(self, timings):
+        pipeline = timings['fetch'] + timings['augment'] + timings['views']
+        n = len(self.names)
+        print(f"  input pipeline: {pipeline:.1f}s (data wait {timings['fetch']:.1f}, augment {timings['augment']:.1f}, "
+              f"views {timings['views']:.1f}) once for {n} models, instead of about {n * pipeline:.1f}s in "
+              f"{n} separate runs; {timings['handoff']:.1f}s waiting for the slowest model, "
+              f"{timings['total']:.0f}s in total")
+
+    def close(self, save=True):
+        """Stops the workers; ``save_dir`` receives every member's weights."""
+        if self.save_dir and save:
+            os.makedirs(self.save_dir, exist_ok=True)
+        self._broadcast('stop', self.save_dir if save else None)
+        for worker in self.workers:
+            worker.join(timeout=600)
+
+
+def build_member(kind, num_classes=2, device='cpu', precision='bf16', pretrained=True):
+    """The models of the training scripts, with their optimizers:
+    'vgg16' (vgg16.py, frozen base, 224px), 'dccn' (dccn.py, 150px),
+    'efficientnet_b0' (swin.py), 'swin_tiny' and 'hybrid' (hybrid_model.py).
+    Module-level, so ``functools.partial(build_member, kind)`` is a factory
+    for ``mode='process'``."""
+    criterion = torch.nn.CrossEntropyLoss()
+    if kind == 'efficientnet_b0':
+        from torchvision.models import efficientnet_b0
+
+        model = efficientnet_b0(pretrained=pretrained)
+        model.classifier[1] = torch.nn.Linear(model.classifier[1].in_features, num_classes)
+        optimizer = torch.optim.Adam(param_groups(model, {'features': 1e-5, 'classifier': 1e-3}))
+        return TorchMember(kind, model, optimizer, criterion, device=device, precision=precision)
+    if kind == 'swin_tiny':
+        import timm
+
+        model = timm.create_model('swin_tiny_patch4_window7_224', pretrained=pretrained, num_classes=num_classes)
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+        return TorchMember(kind, model, optimizer, criterion, device=device, precision=precision)
+    if kind == 'hybrid':
+        from hybrid_network import HybridSkinCancerModel, feature_extractors
+
+        model = HybridSkinCancerModel(*feature_extractors(pretrained=pretrained), num_classes)
+        optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+        return TorchMember(kind, model, optimizer, criterion, device=device, precision=precision)
+    if kind == 'dccn':
+        from dccn_search import DCCN_DEFAULTS, build_dccn
+
+        return KerasMember(kind, build_dccn(DCCN_DEFAULTS), size=DCCN_DEFAULTS['image_size'])
+    if kind == 'vgg16':
+        from tensorflow.keras import layers, models
+        from tensorflow.keras.applications import VGG16
+        from tensorflow.keras.optimizers import Adam
+
+        base_model = VGG16(weights='imagenet' if pretrained else None, include_top=False, input_shape=(224, 224, 3))
+        base_model.trainable = False
+        model = models.Sequential([base_model, layers.Flatten(), layers.Dense(256, activation='relu'),
+                                   layers.Dropout(0.5), layers.Dense(1, activation='sigmoid')])
+        model.compile(optimizer=Adam(learning_rate=0.0001), loss='binary_crossentropy', metrics=['accuracy'])
+        return KerasMember(kind, model, size=224)
+    raise ValueError(f'unknown model {kind!r}')
+
+
+MODELS = ('vgg16', 'dccn', 'efficientnet_b0', 'swin_tiny', 'hybrid')
+KERAS_MODELS = ('vgg16', 'dccn')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train several models from one decode/augment stream')
+    parser.add_argument('train', help='ImageFolder root of the training images')
+    parser.add_argument('--val', default=None, help='ImageFolder root of the validation images')
+    parser.add_argument('--models', nargs='+', default=list(MODELS), choices=MODELS)
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--mode', default='thread', choices=('thread', 'process'))
+    parser.add_argument('--precision', default='bf16', choices=sorted(PRECISIONS))
+    parser.add_argument('--no-pretrained', dest='pretrained', action='store_false')
+    parser.add_argument('--save-dir', default=None, help='weights of every model after training')
+    args = parser.parse_args()
+
+    from augmentation import BatchAugment
+    from data_loading import make_loader
+    from image_cache import CachedImageFolder
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    train_loader = make_loader(CachedImageFolder(args.train, size=224, as_pil=False), batch_size=args.batch_size,
+                               shuffle=True, name='train')
+    val_loader = make_loader(CachedImageFolder(args.val, size=224, as_pil=False), batch_size=args.batch_size,
+                             name='val') if args.val else None
+    # The augmentations the scripts have in common, on [0, 1] images
+    stream = SharedStream(BatchAugment(hflip=True, rotation=10, brightness=0.2, contrast=0.2, saturation=0.2,
+                                       mean=None, std=None), device)
+    # PyTorch members first: torchvision and timm can crash on import once TensorFlow is loaded
+    kinds = sorted(args.models, key=lambda kind: kind in KERAS_MODELS)
+    factories = [functools.partial(build_member, kind, device=device, precision=args.precision,
+                                   pretrained=args.pretrained) for kind in kinds]
+    members = factories if args.mode == 'process' else [factory() for factory in factories]
+    trainer = CoTrainer(stream, members, mode=args.mode, save_dir=args.save_dir)
+    trainer.fit(train_loader, args.epochs, val_loader)
+    trainer.close()
@@ -0,0 +1,191 @@
+"""Shared DataLoader factory for the PyTorch training scripts.
+
+Every script builds its loaders through ``make_loader`` so decode, augmentation
+and collation run in persistent background workers that prefetch several
+batches ahead of the training step. The returned loader also measures how
+long the training loop sat waiting on data each epoch, which tells us whether
+a run is input-bound.
+
+Shuffled loaders draw their order from ``ResumableRandomSampler``: the
+permutation is a function of ``(seed, epoch)``, so a run restored from a
+checkpoint can skip the samples it already trained on without loading them.
+
+When the script runs as one rank of a data-parallel job (see
+distributed_training.py), every rank iterates over its own shard: shuffled
+loaders use ``DistributedResumableSampler`` (same permutation on all ranks,
+padded so every rank gets the same number of batches), evaluation loaders
+``ShardSampler`` (each sample exactly once, so the all-reduced metrics are
+exact). Such loaders have ``sharded = True``.
+"""
+
+import os
+import time
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, Sampler
+
+
+def available_cores():
+    # Respect taskset/cgroup pinning where the platform exposes it
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def default_num_workers():
+    if 'NUM_WORKERS' in os.environ:
+        return int(os.environ['NUM_WORKERS'])
+
+    cores = available_cores()
+    if torch.cuda.is_available():
+        # The accelerator does the math, so the host cores can all feed it
+        return min(8, max(1, cores - 1))
+    # On CPU-only boxes the training step needs the other half of the cores
+    return min(8, max(1, cores // 2))
+
+
+class ResumableRandomSampler(Sampler):
+    """Random order that depends only on ``seed`` and the epoch.
+
+    Every pass uses the next epoch's permutation; ``set_epoch`` selects the
+    epoch of the next pass and ``skip(n)`` drops its first ``n`` indices. The
+    seed is drawn from torch's global RNG when not given, so
+    ``torch.manual_seed`` still controls it.
+    """
+
+    def __init__(self, data_source, seed=None):
+        self.data_source = data_source
+        self.seed = int(torch.empty((), dtype=torch.int64).random_().item()) if seed is None else seed
+        self.epoch = 0
+        self._skip = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def skip(self, n):
+        self._skip = n
+
+    def __len__(self):
+        return len(self.data_source)
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.data_source), generator=generator)[self._skip:]
+        self._skip = 0
+        self.epoch += 1
+        return iter(order.tolist())
+
+
+class DistributedResumableSampler(ResumableRandomSampler):
+    """This rank's share of the ``(seed, epoch)`` permutation.
+
+    The seed is broadcast from rank 0. The permutation is padded with its
+    first indices to a multiple of the world size (as ``DistributedSampler``
+    does) and rank ``r`` takes every ``world``-th index from ``r``; ``skip``
+    counts this rank's indices.
+    """
+
+    def __init__(self, data_source, seed=None):
+        super(DistributedResumableSampler, self).__init__(data_source, seed)
+        self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+        seed = torch.tensor([self.seed], dtype=torch.int64)
+        dist.broadcast(seed, src=0)
+        self.seed = int(seed.item())
+
+    def __len__(self):
+        return -(-len(self.data_source) // self.world_size)
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.data_source), generator=generator)
+        padding = len(self) * self.world_size - len(order)
+        order = torch.cat([order, order[:padding]])[self.rank::self.world_size][self._skip:]
+        self._skip = 0
+        self.epoch += 1
+        return iter(order.tolist())
+
+
+class ShardSampler(Sampler):
+    """Indices ``rank, rank + world, ...`` in order, without padding."""
+
+    def __init__(self, data_source):
+        self.data_source = data_source
+        self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+
+    def __len__(self):
+        return len(range(self.rank, len(self.data_source), self.world_size))
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.data_source), self.world_size))
+
+
+class TimedLoader:
+    """Wraps a DataLoader and records the time the consumer spent blocked on
+    ``next()`` for every full pass over it."""
+
+    def __init__(self, loader, name='loader', verbose=True):
+        self.loader = loader
+        self.name = name
+        self.verbose = verbose
+        self.history = []
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        wait_time = 0.0
+        start = time.perf_counter()
+
+        # Worker start-up (first epoch only, workers are persistent) counts as waiting
+        fetch_start = start
+        iterator = iter(self.loader)
+        while True:
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                break
+            wait_time += time.perf_counter() - fetch_start
+            yield batch
+            fetch_start = time.perf_counter()
+
+        epoch_time = time.perf_counter() - start
+        self.history.append({'wait_time': wait_time, 'epoch_time': epoch_time})
+
+        if self.verbose:
+            share = 100 * wait_time / epoch_time if epoch_time > 0 else 0.0
+            print(f'[{self.name}] waited {wait_time:.1f}s on data out of {epoch_time:.1f}s ({share:.0f}%)')
+
+
+def make_loader(dataset, batch_size, shuffle=False, num_workers=None, prefetch_factor=4,
+                pin_memory=None, name=None, verbose=True, **kwargs):
+    if num_workers is None:
+        num_workers = default_num_workers()
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+
+    if num_workers > 0:
+        kwargs.setdefault('persistent_workers', True)
+        kwargs.setdefault('prefetch_factor', prefetch_factor)
+
+    name = name or ('train' if shuffle else 'eval')
+    sharded = False
+    if 'sampler' not in kwargs and not isinstance(dataset, torch.utils.data.IterableDataset):
+        distributed = dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+        if shuffle:
+            kwargs['sampler'] = (DistributedResumableSampler if distributed else ResumableRandomSampler)(dataset)
+            shuffle = False
+        elif distributed:
+            kwargs['sampler'] = ShardSampler(dataset)
+        sharded = distributed
+
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                        pin_memory=pin_memory, **kwargs)
+    loader = TimedLoader(loader, name=name, verbose=verbose and (not sharded or dist.get_rank() == 0))
+    loader.sharded = sharded
+    return loader
@@ -0,0 +1,221 @@
+"""Persistent manifest of an ImageFolder-style dataset.
+
+Discovering the merged 2017+2019 Kaggle/ISIC tree from scratch (``ImageFolder``
+walking every class, ``os.listdir`` per class, building a generator just to
+read its ``classes``) costs minutes on the Drive mount. ``DatasetManifest``
+records every image once, with its label, byte size, mtime, dimensions and
+content hash, in ``data/<split>.manifest.json`` next to the data root.
+
+Later runs only stat the directories: a directory whose mtime is unchanged
+reuses its recorded listing, and only changed directories are listed again.
+Files that kept their size and mtime are not re-read. Dataset construction,
+class counts, class weights and train/validation splits all come from it:
+
+    manifest = DatasetManifest('/content/drive/MyDrive/data/train')
+    manifest.class_counts(), manifest.class_weights(), manifest.split(0.2)
+
+Build or refresh from the shell:
+
+    python dataset_manifest.py /content/drive/MyDrive/data/train /content/drive/MyDrive/data/test
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff', '.webp')
+VERSION = 1
+
+
+def default_manifest_path(root):
+    # data/train -> data/train.manifest.json
+    root = os.path.normpath(root)
+    return os.path.join(os.path.dirname(root), os.path.basename(root) + '.manifest.json')
+
+
+def _describe(path):
+    st = os.stat(path)
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    try:
+        # Only parses the header
+        with Image.open(path) as image:
+            width, height = image.size
+    except OSError:
+        width = height = None
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'width': width, 'height': height,
+            'sha1': digest.hexdigest()}
+
+
+class DatasetManifest:
+    """Every image under ``root`` in ``datasets.ImageFolder`` order.
+
+    ``samples``, ``targets``, ``classes`` and ``class_to_idx`` match what
+    ``ImageFolder(root)`` would produce; ``entries[i]`` holds the recorded
+    size, mtime, width, height and sha1 of ``samples[i]``.
+    """
+
+    def __init__(self, root, path=None, rescan=True, num_workers=None):
+        self.root = os.path.normpath(root)
+        self.path = path or default_manifest_path(root)
+        self.num_workers = num_workers
+
+        self._dirs, self._files = {}, {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                stored = json.load(f)
+            if stored.get('version') == VERSION:
+                self._dirs, self._files = stored['dirs'], stored['files']
+
+        if rescan or not self._dirs:
+            self.refresh()
+        else:
+            self._index()
+
+    def refresh(self, full=False):
+        """Brings the manifest up to date and saves it if anything changed.
+
+        Only directories whose mtime changed are listed again. ``full=True``
+        re-lists every directory and re-checks every file, which also catches
+        files rewritten in place (that does not touch the directory mtime).
+        """
+        start = time.perf_counter()
+        old_dirs, old_files = self._dirs, self._files
+        dirs, files, pending = {}, {}, []
+
+        def scan(rel):
+            directory = os.path.join(self.root, rel) if rel else self.root
+            mtime = os.stat(directory).st_mtime
+            known = old_dirs.get(rel)
+
+            if known is not None and known['mtime'] == mtime and not full:
+                dirs[rel] = known
+                for name in known['files']:
+                    files[os.path.join(rel, name)] = old_files[os.path.join(rel, name)]
+            else:
+                subdirs, names = [], []
+                for entry in os.scandir(directory):
+                    if entry.is_dir(follow_symlinks=True):
+                        subdirs.append(entry.name)
+                    elif rel and entry.name.lower().endswith(IMG_EXTENSIONS):
+                        # Files directly in the root are not samples, as in ImageFolder
+                        names.append(entry.name)
+                dirs[rel] = {'mtime': mtime, 'subdirs': sorted(subdirs), 'files': sorted(names)}
+                for name in names:
+                    file_rel = os.path.join(rel, name)
+                    known_file = old_files.get(file_rel)
+                    if known_file is not None:
+                        st = os.stat(os.path.join(self.root, file_rel))
+                        if known_file['size'] == st.st_size and known_file['mtime'] == st.st_mtime:
+                            files[file_rel] = known_file
+                            continue
+                    pending.append(file_rel)
+
+            for name in dirs[rel]['subdirs']:
+                scan(os.path.join(rel, name))
+
+        scan('')
+
+        if pending:
+            # Hashing is I/O bound, threads overlap the reads
+            with ThreadPoolExecutor(max_workers=self.num_workers or min(32, (os.cpu_count() or 1) * 4)) as pool:
+                described = pool.map(_describe, [os.path.join(self.root, rel) for rel in pending])
+                for rel, entry in zip(pending, described):
+                    files[rel] = entry
+
+        changed = bool(pending) or dirs != old_dirs or files.keys() != old_files.keys()
+        self._dirs, self._files = dirs, files
+        self._index()
+        if changed:
+            self.save()
+            print(f'[manifest] {self.root}: {len(pending)} new or changed of {len(self.samples)} images, '
+                  f'updated in {time.perf_counter() - start:.1f}s')
+
+    def _index(self):
+        self.classes = list(self._dirs['']['subdirs'])
+        self.class_to_idx = {name: i for i, name in enumerate(self.classes)}
+
+        self.samples, self.entries = [], []
+        for name in self.classes:
+            # Same order as ImageFolder: directories sorted by path, files sorted by name
+            stack, class_dirs = [name], []
+            while stack:
+                rel = stack.pop()
+                class_dirs.append(rel)
+                stack.extend(os.path.join(rel, sub) for sub in self._dirs[rel]['subdirs'])
+            for rel in sorted(class_dirs, key=lambda rel: os.path.join(self.root, rel)):
+                for file_name in self._dirs[rel]['files']:
+                    file_rel = os.path.join(rel, file_name)
+                    self.samples.append((os.path.join(self.root, file_rel), self.class_to_idx[name]))
+                    self.entries.append(self._files[file_rel])
+
+        self.targets = [target for _, target in self.samples]
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': VERSION, 'root': os.path.abspath(self.root),
+                       'dirs': self._dirs, 'files': self._files}, f)
+        # Atomic, so a crashed run never leaves a truncated manifest
+        os.replace(tmp, self.path)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def class_counts(self):
+        counts = [0] * len(self.classes)
+        for target in self.targets:
+            counts[target] += 1
+        return counts
+
+    def class_weights(self):
+        """``{class_index: weight}`` like ``compute_class_weight('balanced')``."""
+        counts = self.class_counts()
+        return {i: len(self.targets) / (len(counts) * count) for i, count in enumerate(counts) if count}
+
+    def fingerprint(self):
+        """Hash of the sample list (paths, labels and content hashes), for
+        caches that store data in ``samples`` order."""
+        digest = hashlib.sha1()
+        for (path, target), entry in zip(self.samples, self.entries):
+            digest.update(f'{os.path.relpath(path, self.root)}\0{target}\0{entry["sha1"]}\n'.encode())
+        return digest.hexdigest()
+
+    def split(self, val_fraction, seed=0):
+        """Returns ``(train_indices, val_indices)`` into ``samples``."""
+        return split_by_hash([entry['sha1'] for entry in self.entries], val_fraction, seed)
+
+
+def split_by_hash(sha1s, val_fraction, seed=0):
+    """Returns ``(train_indices, val_indices)`` into ``sha1s``.
+
+    Each image is assigned by its content hash, so the split is the same on
+    every run, unaffected by new images arriving, and duplicate files
+    always land on the same side.
+    """
+    train, val = [], []
+    threshold = int(val_fraction * 2 ** 32)
+    for i, sha1 in enumerate(sha1s):
+        key = hashlib.sha1(f'{seed}:{sha1}'.encode()).digest()
+        (val if int.from_bytes(key[:4], 'big') < threshold else train).append(i)
+    return train, val
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or refresh the dataset manifests')
+    parser.add_argument('roots', nargs='+', help='ImageFolder roots, e.g. data/train data/test')
+    parser.add_argument('--full', action='store_true', help='re-check every directory and file')
+    args = parser.parse_args()
+
+    for root in args.roots:
+        manifest = DatasetManifest(root, rescan=not args.full)
+        if args.full:
+            manifest.refresh(full=True)
+        print(f'{root}: {len(manifest)} images, class counts {dict(zip(manifest.classes, manifest.class_counts()))}')
@@ -20,9 +20,49 @@ from tensorflow.keras.preprocessing.image import ImageDataGenerator
 from tensorflow.keras import layers, models
 import matplotlib.pyplot as plt
 
+import subprocess
+import sys
+
+import image_loading
+from bottleneck_cache import cache_bottleneck_features, head_model
+from dccn_search import DCCN_DEFAULTS, best_config, build_dccn
+from evaluation_cache import evaluate_cached
+from keras_pipeline import flow_from_archive, flow_from_directory
+from progressive_resizing import ResolutionSchedule, TimeToAccuracy, fit_progressive
+from shard_archive import pack_split
+
+# Decode JPEGs at reduced resolution (DCT scaling) before the final resize,
+# set to False to decode at full resolution
+image_loading.FAST_DECODE = True
+
+# Model outputs on the validation set are computed once per weights and reused by every report
+EVAL_CACHE_DIR = '/content/drive/MyDrive/eval_cache'
+
 # Define directories
 train_dir = '/content/drive/MyDrive/data/train'
 validation_dir = '/content/drive/MyDrive/data/test'
+shard_dir = '/content/drive/MyDrive/shards'  # Sequential shard archive of train_dir (packed on first use)
+
+# Search filters, Dense units, dropout, L2, learning rate and batch size with successive
+# halving (hyperparameter_search.py) before the final training run. Trials are scored on a
+# held-out 20% of train_dir; validation_dir is only used by the final run. Results are kept in
+# SEARCH_DB, so an interrupted search resumes; with False the original architecture is used.
+# The search runs as its own process (dccn_search.py), since its spawned workers re-import
+# the main module and this script trains at import
+HYPERPARAMETER_SEARCH = False
+SEARCH_DB = '/content/drive/MyDrive/hyperparameter_search.db'
+
+dccn_config = dict(DCCN_DEFAULTS)
+if HYPERPARAMETER_SEARCH:
+    subprocess.run([sys.executable, '-m', 'dccn_search', train_dir, SEARCH_DB], check=True)
+    dccn_config.update(best_config(SEARCH_DB))
+image_size = (dccn_config['image_size'], dccn_config['image_size'])
+
+# Progressive resizing (progressive_resizing.py): train from 96px with larger batches up to the
+# full size over the first half of the run, validating at full size. The time until
+# TARGET_ACCURACY is printed either way, to compare with the fixed-size run
+PROGRESSIVE_RESIZING = False
+TARGET_ACCURACY = 0.85
 
 # Data augmentation for training
 train_datagen = ImageDataGenerator(
@@ -39,52 +79,49 @@ train_datagen = ImageDataGenerator(
 # Only rescaling for validation
 validation_datagen = ImageDataGenerator(rescale=1./255)
 
-# Create generators
-train_generator = train_datagen.flow_from_directory(
-    train_dir,
-    target_size=(150, 150),
-    batch_size=32,
-    class_mode='binary'  # Change to 'categorical' if needed
+# Create tf.data pipelines (training images stream from the shard archive instead of one file at a time)
+pack_split(train_dir, shard_dir, 'train')
+train_generator = flow_from_archive(
+    train_datagen,  # Same augmentation and rescaling as flow_from_directory
+    shard_dir, 'train',
+    target_size=image_size,
+    batch_size=dccn_config['batch_size'],
+    class_mode='binary'
 )
 
-validation_generator = validation_datagen.flow_from_directory(
+validation_generator = flow_from_directory(
+    validation_datagen,
     validation_dir,
-    target_size=(150, 150),
+    target_size=image_size,
     batch_size=32,
-    class_mode='binary'
+    class_mode='binary',
+    shuffle=False  # Keep predictions aligned with .classes
 )
 
-# Build the model
-model = models.Sequential([
-    layers.Conv2D(32, (3, 3), activation='relu', input_shape=(150, 150, 3)),
-    layers.MaxPooling2D(2, 2),
-
-    layers.Conv2D(64, (3, 3), activation='relu'),
-    layers.MaxPooling2D(2, 2),
-
-    layers.Conv2D(128, (3, 3), activation='relu'),
-    layers.MaxPooling2D(2, 2),
-
-    layers.Conv2D(128, (3, 3), activation='relu'),
-    layers.MaxPooling2D(2, 2),
-
-    layers.Flatten(),
-    layers.Dense(512, activation='relu'),
-    layers.Dense(1, activation='sigmoid')  # Change for multiclass
-])
-
-model.compile(loss='binary_crossentropy',  # Change for multiclass
-              optimizer='adam',
-              metrics=['accuracy'])
+# Build and compile the model (dccn_search.py): 4 Conv+MaxPool blocks, Dense, sigmoid output.
+# The defaults are 32/64/128/128 filters, Dense(512) and Adam(1e-3).
+model = build_dccn(dict(dccn_config, variable_input=PROGRESSIVE_RESIZING))
 
 # Train the model
-history = model.fit(
-    train_generator,
-    steps_per_epoch=train_generator.samples // train_generator.batch_size,
-    validation_data=validation_generator,
-    validation_steps=validation_generator.samples // validation_generator.batch_size,
-    epochs=20 # Adjust as needed
-)
+tracker = TimeToAccuracy()
+if PROGRESSIVE_RESIZING:
+    schedule = ResolutionSchedule(final_size=image_size[0], epochs=20, start_size=96, multiple=16,
+                                  base_batch_size=dccn_config['batch_size'])
+    history = fit_progressive(
+        model, schedule,
+        lambda size, batch_size: flow_from_archive(train_datagen, shard_dir, 'train', target_size=(size, size),
+                                                   batch_size=batch_size, class_mode='binary').dataset,
+        validation_data=validation_generator.dataset,
+        callbacks=[tracker.keras_callback()]
+    )
+else:
+    history = model.fit(
+        train_generator.dataset,
+        validation_data=validation_generator.dataset,
+        epochs=20, # Adjust as needed
+        callbacks=[tracker.keras_callback()]
+    )
+tracker.report(TARGET_ACCURACY, 'progressive' if PROGRESSIVE_RESIZING else 'fixed resolution')
 
 # Plot accuracy and loss
 plt.plot(history.history['accuracy'], label='Train Accuracy')
@@ -106,10 +143,12 @@ plt.show()
 import numpy as np
 from sklearn.metrics import confusion_matrix, ConfusionMatrixDisplay
 
-# Step 1: Predict on the validation data
-validation_generator.reset()  # Reset to start from the beginning
-predictions = model.predict(validation_generator, steps=validation_generator.samples // validation_generator.batch_size + 1)
-predicted_classes = (predictions > 0.5).astype("int32").flatten()  # Convert probabilities to binary labels (0 or 1)
+# Step 1: Predict on the validation data (one pass per model state, reused by the reports below)
+results = evaluate_cached(EVAL_CACHE_DIR, 'dccn-val', model.get_weights(), validation_generator,
+                          lambda: (model.predict(validation_generator.dataset), validation_generator.classes),
+                          transform=validation_datagen, extra=f'{image_size[0]}x{image_size[1]}')
+predictions = results.outputs
+predicted_classes = results.preds  # Convert probabilities to binary labels (0 or 1)
 
 # Step 2: Get the true labels
 true_classes = validation_generator.classes
@@ -125,10 +164,12 @@ plt.show()
 
 from sklearn.metrics import classification_report, accuracy_score
 
-# Predict on the validation data
-validation_generator.reset()
-predictions = model.predict(validation_generator, steps=validation_generator.samples // validation_generator.batch_size + 1)
-predicted_classes = (predictions > 0.5).astype("int32").flatten()
+# Predictions on the validation data, from the evaluation cache (same weights, no second pass)
+results = evaluate_cached(EVAL_CACHE_DIR, 'dccn-val', model.get_weights(), validation_generator,
+                          lambda: (model.predict(validation_generator.dataset), validation_generator.classes),
+                          transform=validation_datagen, extra=f'{image_size[0]}x{image_size[1]}')
+predictions = results.outputs
+predicted_classes = results.preds
 
 # Get the true labels
 true_classes = validation_generator.classes
@@ -152,17 +193,20 @@ model = models.Sequential([
     layers.Dense(1, activation='sigmoid')
 ])
 
-train_generator = train_datagen.flow_from_directory(
+train_generator = flow_from_directory(
+    train_datagen,
     train_dir,
     target_size=(224, 224),
     batch_size=32,
     class_mode='binary'
 )
-validation_generator = validation_datagen.flow_from_directory(
+validation_generator = flow_from_directory(
+    validation_datagen,
     validation_dir,
     target_size=(224, 224),
     batch_size=32,
-    class_mode='binary'
+    class_mode='binary',
+    shuffle=False  # Keep predictions aligned with .classes
 )
 
 layers.Dense(512, activation='relu', kernel_regularizer=tf.keras.regularizers.l2(0.01))
@@ -201,18 +245,21 @@ train_datagen = ImageDataGenerator(
 validation_datagen = ImageDataGenerator(rescale=1./255)
 
 # Create generators
-train_generator = train_datagen.flow_from_directory(
+train_generator = flow_from_directory(
+    train_datagen,
     train_dir,
     target_size=(224, 224),  # Higher resolution
     batch_size=32,
     class_mode='binary'  # Change to 'categorical' if needed
 )
 
-validation_generator = validation_datagen.flow_from_directory(
+validation_generator = flow_from_directory(
+    validation_datagen,
     validation_dir,
     target_size=(224, 224),
     batch_size=32,
-    class_mode='binary'
+    class_mode='binary',
+    shuffle=False  # Keep predictions aligned with .classes
 )
 
 # Load the VGG16 model with pre-trained ImageNet weights, without the top layers
@@ -239,15 +286,36 @@ model.compile(
 lr_scheduler = ReduceLROnPlateau(monitor='val_loss', factor=0.5, patience=3, verbose=1)
 early_stopping = EarlyStopping(monitor='val_loss', patience=5, restore_best_weights=True)
 
+# Train only the head on cached VGG16 features while the base is frozen (see bottleneck_cache.py).
+# AUGMENTED_VIEWS = 0 caches the plain images, N > 0 caches N augmented views of each image.
+# With False the head trains with model.fit on the augmented stream as before.
+BOTTLENECK_TRAINING = False
+AUGMENTED_VIEWS = 0
+bottleneck_dir = '/content/drive/MyDrive/bottlenecks'
+
 # Train the model
-history = model.fit(
-    train_generator,
-    steps_per_epoch=train_generator.samples // train_generator.batch_size,
-    validation_data=validation_generator,
-    validation_steps=validation_generator.samples // validation_generator.batch_size,
-    epochs=20,  # Adjust as needed
-    callbacks=[lr_scheduler, early_stopping]
-)
+if BOTTLENECK_TRAINING:
+    feature_source = train_generator if AUGMENTED_VIEWS else flow_from_directory(
+        validation_datagen, train_dir, target_size=(224, 224), batch_size=32, class_mode='binary', shuffle=False)
+    train_features = cache_bottleneck_features(base_model, feature_source, bottleneck_dir + '/dccn_vgg16_train',
+                                               views=max(1, AUGMENTED_VIEWS))
+    val_features = cache_bottleneck_features(base_model, validation_generator, bottleneck_dir + '/dccn_vgg16_val')
+
+    head = head_model(model, base_model)  # Shares its layers with model
+    head.compile(loss='binary_crossentropy', optimizer=Adam(learning_rate=1e-4), metrics=['accuracy'])
+    history = head.fit(
+        train_features.dataset(batch_size=32, shuffle=True),
+        validation_data=val_features.dataset(batch_size=32),
+        epochs=20,  # Adjust as needed
+        callbacks=[lr_scheduler, early_stopping]
+    )
+else:
+    history = model.fit(
+        train_generator.dataset,
+        validation_data=validation_generator.dataset,
+        epochs=20,  # Adjust as needed
+        callbacks=[lr_scheduler, early_stopping]
+    )
 
 # Plot accuracy and loss
 plt.plot(history.history['accuracy'], label='Train Accuracy')
@@ -267,9 +335,11 @@ plt.legend()
 plt.show()
 
 # Evaluate model performance with accuracy, precision, recall, and F1-score
-validation_generator.reset()
-predictions = model.predict(validation_generator, steps=validation_generator.samples // validation_generator.batch_size + 1)
-predicted_classes = (predictions > 0.5).astype("int32").flatten()
+results = evaluate_cached(EVAL_CACHE_DIR, 'dccn-vgg16-val', model.get_weights(), validation_generator,
+                          lambda: (model.predict(validation_generator.dataset), validation_generator.classes),
+                          transform=validation_datagen, extra='224x224')
+predictions = results.outputs
+predicted_classes = results.preds
 true_classes = validation_generator.classes
 
 # Print the classification report and confusion matrix
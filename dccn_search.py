@@ -0,0 +1,169 @@
+"""The DCNN of dccn.py as a function of its hyperparameters.
+
+dccn.py used to hard-code the filter counts, the Dense(512) head and Adam's
+default learning rate. ``build_dccn`` builds the same network from a config
+(``DCCN_DEFAULTS`` reproduces the original), ``SEARCH_SPACE`` lists the knobs
+worth searching, and ``train_dccn`` is the objective for
+``hyperparameter_search.successive_halving``:
+
+    best = successive_halving(train_dccn, SEARCH_SPACE, '/content/drive/MyDrive/search.db', 'dccn',
+                              fixed={'train_dir': train_dir})
+    model = build_dccn(dict(DCCN_DEFAULTS, **best['config']))
+
+Trials are scored on a held-out slice of ``train_dir`` (``val_fraction`` of
+it, split by content hash as in ``DatasetManifest.split``), so the test set
+stays untouched until the final evaluation.
+
+``train_dccn`` saves the model in the trial's directory after every rung and
+continues from it, so a trial promoted from 3 to 9 epochs trains 6 more.
+
+The trials run in ``spawn``-ed processes that re-import ``__main__``, so the
+search is started from this module rather than from a training script, and
+the script reads the result back:
+
+    python dccn_search.py /content/drive/MyDrive/data/train /content/drive/MyDrive/hyperparameter_search.db
+
+    config = dict(DCCN_DEFAULTS, **best_config('/content/drive/MyDrive/hyperparameter_search.db'))
+"""
+
+import argparse
+import json
+import os
+
+import tensorflow as tf
+from tensorflow.keras import layers, models
+from tensorflow.keras.optimizers import Adam
+from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+from dataset_manifest import DatasetManifest
+from hyperparameter_search import Choice, IntUniform, LogUniform, TrialStore, Uniform, successive_halving
+from keras_pipeline import flow_from_directory
+
+DCCN_DEFAULTS = {
+    'filters': [32, 64, 128, 128],
+    'dense_units': 512,
+    'dropout': 0.0,
+    'l2': 0.0,
+    'learning_rate': 1e-3,  # Adam's default ('adam' in the original compile)
+    'batch_size': 32,
+    'image_size': 150,
+    'variable_input': False,  # Any input size, for progressive-resolution training
+    'val_fraction': 0.2,  # Share of train_dir held out to score search trials
+}
+
+SEARCH_SPACE = {
+    'filters': Choice([[16, 32, 64, 64], [32, 64, 128, 128], [32, 64, 128, 256], [64, 128, 256, 256]]),
+    'dense_units': Choice([128, 256, 512, 1024]),
+    'dropout': Uniform(0.0, 0.6),
+    'l2': Choice([0.0, 1e-4, 1e-3, 1e-2]),
+    'learning_rate': LogUniform(1e-5, 3e-3),
+    'batch_size': IntUniform(16, 64),
+}
+
+
+@tf.keras.utils.register_keras_serializable(package='dccn')
+class ResizeFeatures(layers.Layer):
+    """Resizes feature maps to a fixed grid (antialiased, so shrinking averages
+    like pooling), so Flatten and Dense get the same shape at any input size.
+    A no-op at the size the grid comes from."""
+
+    def __init__(self, grid, **kwargs):
+        super(ResizeFeatures, self).__init__(**kwargs)
+        self.grid = tuple(grid)
+
+    def call(self, inputs):
+        return tf.image.resize(inputs, self.grid, method='bilinear', antialias=True)
+
+    def get_config(self):
+        return dict(super(ResizeFeatures, self).get_config(), grid=self.grid)
+
+
+def build_dccn(config):
+    """Conv(3x3)+MaxPool blocks, Flatten, Dense, sigmoid output, compiled.
+
+    With ``variable_input`` the model accepts any image size; the last
+    feature map is resized to the grid of ``image_size`` before Flatten.
+    """
+    config = dict(DCCN_DEFAULTS, **config)
+    size = config['image_size']
+    regularizer = tf.keras.regularizers.l2(config['l2']) if config['l2'] else None
+
+    model = models.Sequential([layers.Input(shape=(None, None, 3) if config['variable_input'] else (size, size, 3))])
+    grid = size
+    for filters in config['filters']:
+        model.add(layers.Conv2D(filters, (3, 3), activation='relu'))
+        model.add(layers.MaxPooling2D(2, 2))
+        grid = (grid - 2) // 2
+    if config['variable_input']:
+        model.add(ResizeFeatures((grid, grid)))
+    model.add(layers.Flatten())
+    model.add(layers.Dense(config['dense_units'], activation='relu', kernel_regularizer=regularizer))
+    if config['dropout']:
+        model.add(layers.Dropout(config['dropout']))
+    model.add(layers.Dense(1, activation='sigmoid'))
+
+    model.compile(loss='binary_crossentropy', optimizer=Adam(learning_rate=config['learning_rate']),
+                  metrics=['accuracy'])
+    return model
+
+
+def train_dccn(config, epochs, workdir):
+    """Search objective: accuracy on the held-out slice of ``train_dir``
+    after ``epochs`` epochs in total. ``config`` also carries ``train_dir``."""
+    config = dict(DCCN_DEFAULTS, **config)
+    size, batch_size = config['image_size'], config['batch_size']
+    train_indices, val_indices = DatasetManifest(config['train_dir']).split(config['val_fraction'])
+
+    # Same augmentation as dccn.py
+    train_datagen = ImageDataGenerator(rescale=1./255, rotation_range=40, width_shift_range=0.2,
+                                       height_shift_range=0.2, shear_range=0.2, zoom_range=0.2,
+                                       horizontal_flip=True, fill_mode='nearest')
+    train = flow_from_directory(train_datagen, config['train_dir'], target_size=(size, size),
+                                batch_size=batch_size, class_mode='binary', indices=train_indices)
+    validation = flow_from_directory(ImageDataGenerator(rescale=1./255), config['train_dir'],
+                                     target_size=(size, size), batch_size=batch_size, class_mode='binary',
+                                     shuffle=False, indices=val_indices)
+
+    model_path, state_path = os.path.join(workdir, 'model.keras'), os.path.join(workdir, 'state.json')
+    trained = 0
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            trained = json.load(f)['epochs']
+        model = tf.keras.models.load_model(model_path)  # Weights and optimizer state of the last rung
+    else:
+        model = build_dccn(config)
+
+    if epochs > trained:
+        model.fit(train.dataset, initial_epoch=trained, epochs=epochs, verbose=0)
+        model.save(model_path)
+        with open(state_path, 'w') as f:
+            json.dump({'epochs': epochs}, f)
+
+    _, accuracy = model.evaluate(validation.dataset, verbose=0)
+    return accuracy
+
+
+def best_config(store_path, study='dccn'):
+    """The sampled values of the best finished trial of a stored search."""
+    store = TrialStore(store_path)
+    best = store.leaderboard(study)
+    store.close()
+    if not best or best[0]['score'] is None:
+        raise RuntimeError(f'no finished trial of {study!r} in {store_path}, run dccn_search.py first')
+    return best[0]['config']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Successive-halving search over the dccn.py network')
+    parser.add_argument('train_dir', help='ImageFolder root; trials are scored on a held-out slice of it')
+    parser.add_argument('store', help='SQLite file for the trials, reused to resume')
+    parser.add_argument('--study', default='dccn')
+    parser.add_argument('--trials', type=int, default=27)
+    parser.add_argument('--min-epochs', type=int, default=1)
+    parser.add_argument('--max-epochs', type=int, default=9)
+    parser.add_argument('--eta', type=int, default=3)
+    args = parser.parse_args()
+
+    successive_halving(train_dccn, SEARCH_SPACE, args.store, args.study, n_trials=args.trials,
+                       min_epochs=args.min_epochs, max_epochs=args.max_epochs, eta=args.eta,
+                       fixed={'train_dir': args.train_dir})
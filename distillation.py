@@ -0,0 +1,278 @@
+"""Knowledge distillation of the hybrid model into a small CPU-serving student.
+
+The teacher (``HybridSkinCancerModel``) runs once over ``views`` augmented
+copies of the training set, and its logits are stored on disk. Students are
+then trained against them as often as needed without running the teacher
+again:
+
+    augment = BatchAugment(hflip=True, rotation=10).to(device)  # Random views; a plain BatchAugment() is refused
+    teacher_logits = TeacherLogits('/content/drive/MyDrive/teacher_logits', hybrid_model, train_dataset,
+                                   augment, device, views=4, keys=train_dataset.keys)
+    student = build_student('mobilenet_v3_small', num_classes).to(device)
+    distill(student, teacher_logits, torch.optim.Adam(student.parameters(), lr=1e-3), device, epochs=10)
+    compare({'teacher': hybrid_model, 'student': student}, val_loader, device, transform=image_transforms['val'])
+
+A view has to be the same image for the teacher and the student, so the
+augmentation is seeded. The training set is split once into fixed batches,
+and the batch ``b`` of view ``v`` is always augmented with a generator seeded
+from ``(seed, v, b)``. Epoch ``e`` trains on view ``e % views`` and shuffles
+the order of the batches, not their contents. The cache file is named after
+a hash of the teacher weights, the dataset keys, the augmentation settings
+and the view layout, so a changed teacher or dataset never serves stale
+logits. Old files of the same name are removed.
+
+The loss is Hinton et al.'s: ``alpha`` times the KL divergence between the
+temperature-softened teacher and student distributions (scaled by T^2) plus
+``1 - alpha`` times cross-entropy with the hard labels.
+
+Students (``STUDENTS``): 'dccn' is the dccn.py CNN in PyTorch (150x150 input,
+3.4M parameters). 'mobilenet_v3_small' (1.5M) and 'mobilenet_v3_large'
+(4.2M) are torchvision's ImageNet-pretrained networks with a new classifier.
+"""
+
+import io
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from data_loading import make_loader
+from embedding_cache import weights_hash
+from metrics import ConfusionMatrix
+
+STUDENTS = ('dccn', 'mobilenet_v3_small', 'mobilenet_v3_large')
+
+
+class DCCNStudent(nn.Module):
+    """The dccn.py network: four Conv(3x3)+MaxPool blocks, Dense(512) and the
+    output layer, on inputs resized to ``size`` (150 in dccn.py)."""
+
+    def __init__(self, num_classes, filters=(32, 64, 128, 128), dense_units=512, size=150):
+        super(DCCNStudent, self).__init__()
+        self.size = size
+        blocks, channels, grid = [], 3, size
+        for width in filters:
+            blocks += [nn.Conv2d(channels, width, 3), nn.ReLU(inplace=True), nn.MaxPool2d(2)]
+            channels, grid = width, (grid - 2) // 2
+        self.features = nn.Sequential(*blocks)
+        self.classifier = nn.Sequential(nn.Flatten(), nn.Linear(channels * grid * grid, dense_units),
+                                        nn.ReLU(inplace=True), nn.Linear(dense_units, num_classes))
+
+    def forward(self, x):
+        if x.shape[-2:] != (self.size, self.size):
+            x = F.interpolate(x, size=(self.size, self.size), mode='bilinear', align_corners=False, antialias=True)
+        return self.classifier(self.features(x))
+
+
+def build_student(kind, num_classes, pretrained=True):
+    if kind == 'dccn':
+        return DCCNStudent(num_classes)
+    if kind in ('mobilenet_v3_small', 'mobilenet_v3_large'):
+        from torchvision import models
+
+        model = getattr(models, kind)(pretrained=pretrained)
+        model.classifier[-1] = nn.Linear(model.classifier[-1].in_features, num_classes)
+        return model
+    raise ValueError(f'student must be one of {STUDENTS}, got {kind!r}')
+
+
+def view_seed(seed, view, batch):
+    return ((seed * 1_000_003 + view) * 1_000_003 + batch) % 2 ** 63
+
+
+def augment_view(augment, images, seed):
+    """``augment(images)`` (in train mode) with its random draws seeded by ``seed``."""
+    previous, training = augment.generator, augment.training
+    augment.generator = torch.Generator(images.device).manual_seed(seed)
+    augment.train()
+    try:
+        return augment(images)
+    finally:
+        augment.generator = previous
+        augment.train(training)
+
+
+def _augment_config(augment):
+    # Everything that changes what a view looks like
+    return {key: value for key, value in vars(augment).items()
+            if not key.startswith('_') and key not in ('generator', 'training')}
+
+
+class _FixedBatches:
+    # Batch sampler over fixed index lists, in an order set per epoch
+    def __init__(self, batches):
+        self.batches = batches
+        self.order = list(range(len(batches)))
+
+    def __iter__(self):
+        return (self.batches[b] for b in self.order)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class TeacherLogits:
+    """Teacher logits, ``(views, len(dataset), num_classes)`` float16, for
+    seeded augmented views of ``dataset`` (raw uint8 images, ``augment`` is
+    a random ``BatchAugment``). Computed on creation unless a matching file
+    exists. ``keys`` (e.g. ``CachedImageFolder.keys``, the image content
+    hashes) identify the images; without them only the dataset length is
+    checked."""
+
+    def __init__(self, cache_dir, teacher, dataset, augment, device, views=4, batch_size=64, seed=0, keys=None,
+                 name='teacher'):
+        if views > 1 and not (augment.has_geometry or augment.brightness or augment.contrast
+                              or augment.saturation or augment.hue):
+            raise ValueError('augment only converts and normalizes, so every view would be the same image; '
+                             'pass an augmenting BatchAugment (e.g. hflip=True, rotation=10) or views=1')
+        self.dataset = dataset
+        self.augment = augment
+        self.device = device
+        self.views = views
+        self.seed = seed
+        order = torch.randperm(len(dataset), generator=torch.Generator().manual_seed(seed)).tolist()
+        self.batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+        self._sampler = _FixedBatches(self.batches)
+        self._loader = None
+
+        extra = repr((views, batch_size, seed, len(dataset), sorted(_augment_config(augment).items()),
+                      list(keys) if keys is not None else None))
+        self.path = os.path.join(cache_dir, f'{name}-{weights_hash({"teacher": teacher}, extra)}.npy')
+        os.makedirs(cache_dir, exist_ok=True)
+        for entry in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, entry)
+            if entry.startswith(name + '-') and entry.endswith('.npy') and path != self.path:
+                print(f'[distill] removing stale teacher logits {path}')
+                os.remove(path)
+        if not os.path.exists(self.path):
+            self._compute(teacher)
+        self.logits = np.load(self.path, mmap_mode='r')
+
+    @property
+    def loader(self):
+        if self._loader is None:
+            # batch_size=1 is DataLoader's required default when a batch sampler is given
+            self._loader = make_loader(self.dataset, batch_size=1, batch_sampler=self._sampler, name='distill')
+        return self._loader
+
+    @torch.no_grad()
+    def _compute(self, teacher):
+        was_training = teacher.training
+        teacher.eval()
+        logits = None
+        start = time.perf_counter()
+        for view in range(self.views):
+            self._sampler.order = list(range(len(self.batches)))
+            for b, (images, _) in zip(self._sampler.order, self.loader):
+                images = augment_view(self.augment, images.to(self.device), view_seed(self.seed, view, b))
+                outputs = teacher(images).float().cpu().numpy()
+                if logits is None:
+                    logits = np.zeros((self.views, len(self.dataset), outputs.shape[1]), dtype=np.float16)
+                logits[view, self.batches[b]] = outputs
+        teacher.train(was_training)
+        np.save(self.path + '.tmp.npy', logits)
+        os.replace(self.path + '.tmp.npy', self.path)  # Complete files only
+        print(f'[distill] teacher logits for {self.views} x {len(self.dataset)} views in '
+              f'{time.perf_counter() - start:.0f}s -> {self.path}')
+
+    def epoch(self, epoch):
+        """``(images, labels, teacher_logits)`` batches of view ``epoch % views``
+        in a shuffled batch order, images augmented on the device."""
+        view = epoch % self.views
+        self._sampler.order = torch.randperm(len(self.batches),
+                                             generator=torch.Generator().manual_seed(self.seed + 1 + epoch)).tolist()
+        order = list(self._sampler.order)  # The loader reads the order when it starts iterating
+        for b, (images, labels) in zip(order, self.loader):
+            images = augment_view(self.augment, images.to(self.device), view_seed(self.seed, view, b))
+            teacher = torch.from_numpy(self.logits[view, self.batches[b]].astype(np.float32)).to(self.device)
+            yield images, labels.to(self.device), teacher
+
+
+def distillation_loss(student_logits, teacher_logits, labels, temperature=4.0, alpha=0.7):
+    soft = F.kl_div(F.log_softmax(student_logits / temperature, dim=1),
+                    F.log_softmax(teacher_logits / temperature, dim=1), log_target=True, reduction='batchmean')
+    return alpha * temperature ** 2 * soft + (1 - alpha) * F.cross_entropy(student_logits, labels)
+
+
+def distill(student, teacher_logits, optimizer, device, epochs, temperature=4.0, alpha=0.7, scheduler=None):
+    """Trains ``student`` on the cached views; returns the mean loss per epoch."""
+    history = []
+    for epoch in range(epochs):
+        student.train()
+        running_loss = torch.zeros((), device=device)
+        metrics = ConfusionMatrix(teacher_logits.logits.shape[-1], device)
+        for images, labels, teacher in teacher_logits.epoch(epoch):
+            optimizer.zero_grad()
+            outputs = student(images)
+            loss = distillation_loss(outputs.float(), teacher, labels, temperature, alpha)
+            loss.backward()
+            optimizer.step()
+
+            running_loss += loss.detach()
+            metrics.update(outputs.argmax(dim=1), labels)
+        if scheduler is not None:
+            scheduler.step()
+        history.append(running_loss.item() / len(teacher_logits.batches))
+        print(f"Distill epoch [{epoch + 1}/{epochs}], Loss: {history[-1]:.4f}, "
+              f"Train accuracy: {100 * metrics.accuracy():.2f}%")
+    return history
+
+
+def _latency_ms(model, batch_size, device, repeats, size=224):
+    x = torch.randn(batch_size, 3, size, size, device=device)
+    with torch.inference_mode():
+        model(x)  # Warm-up
+        times = []
+        for _ in range(repeats):
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            model(x)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            times.append(time.perf_counter() - start)
+    return 1000 * sorted(times)[len(times) // 2] / batch_size
+
+
+def compare(models, loader, device, transform=None, latency_device='cpu', batch_sizes=(1, 32), repeats=5):
+    """Accuracy and weighted F1 on ``loader`` (on ``device``), parameters,
+    fp32 weight and file size, and median latency per image on
+    ``latency_device`` (CPU, where the student is served) at each batch size,
+    for every ``{name: model}``. Returns the rows it prints."""
+    latency_device = torch.device(latency_device)
+    rows = []
+    for name, model in models.items():
+        model.eval()
+        metrics = None
+        with torch.inference_mode():
+            for images, labels in loader:
+                images, labels = images.to(device), labels.to(device)
+                if transform is not None:
+                    images = transform(images)
+                outputs = model(images)
+                if metrics is None:
+                    metrics = ConfusionMatrix(outputs.size(1), device)
+                metrics.update(outputs.argmax(dim=1), labels)
+
+        buffer = io.BytesIO()
+        torch.save(model.state_dict(), buffer)
+        parameters = sum(p.numel() for p in model.parameters())
+        model_device = next(model.parameters()).device
+        model.to(latency_device)
+        latency = {batch_size: _latency_ms(model, batch_size, latency_device, repeats) for batch_size in batch_sizes}
+        model.to(model_device)
+        rows.append({'model': name, 'accuracy': metrics.accuracy(), 'f1': metrics.f1('weighted'),
+                     'parameters': parameters, 'weights_mb': 4 * parameters / 2 ** 20,
+                     'file_mb': buffer.getbuffer().nbytes / 2 ** 20, 'ms_per_image': latency})
+
+    header = ' '.join(f'{f"ms@{batch_size}":>8}' for batch_size in batch_sizes)
+    print(f'{"model":>20} {"accuracy":>9} {"F1":>7} {"params":>12} {"weights MB":>10} {"file MB":>8} {header}'
+          f'   (latency per image on {latency_device})')
+    for row in rows:
+        latency = ' '.join(f'{row["ms_per_image"][batch_size]:>8.2f}' for batch_size in batch_sizes)
+        print(f'{row["model"]:>20} {100 * row["accuracy"]:>8.2f}% {row["f1"]:>7.4f} {row["parameters"]:>12,} '
+              f'{row["weights_mb"]:>10.1f} {row["file_mb"]:>8.1f} {latency}')
+    return rows
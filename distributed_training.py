@@ -0,0 +1,242 @@
+"""Data-parallel training on the CPU cores of one machine.
+
+A single process running swin.py or swim.py cannot keep a many-core box
+busy. The launcher starts the script ``nproc`` times, as a ``torchrun``-style
+job over the gloo backend, and pins each rank to its own set of cores:
+
+    python distributed_training.py launch --nproc 4 swin.py
+
+Inside the script ``init_from_env()`` joins the process group (it does
+nothing when the script is run directly). ``make_loader`` then gives every
+rank its shard of the data, ``Trainer`` wraps the model in
+``DistributedDataParallel`` (gradients are all-reduced on ``backward``) and
+sums the loss and confusion matrices over the ranks, so validation metrics
+cover the whole set, not one rank's share. The global batch is ``nproc``
+times the loader's batch size.
+
+``benchmark`` measures training throughput for 1/2/4/8 ranks on the same box:
+
+    python distributed_training.py benchmark /content/drive/MyDrive/data/train --model efficientnet_b0
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from data_loading import available_cores
+
+
+def world_size():
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def rank():
+    return dist.get_rank() if world_size() > 1 else 0
+
+
+def is_main_process():
+    return rank() == 0
+
+
+def barrier():
+    if world_size() > 1:
+        dist.barrier()
+
+
+@contextlib.contextmanager
+def main_process_first():
+    """Rank 0 runs the block first (e.g. building an image cache), the other
+    ranks wait and then find the result on disk."""
+    if not is_main_process():
+        barrier()
+    yield
+    if is_main_process():
+        barrier()
+
+
+def init_from_env():
+    """Joins the process group described by ``RANK``/``WORLD_SIZE``/``MASTER_*``
+    (set by ``launch``). Returns ``(rank, world_size)``."""
+    size = int(os.environ.get('WORLD_SIZE', 1))
+    if size > 1 and not dist.is_initialized():
+        dist.init_process_group('gloo', rank=int(os.environ['RANK']), world_size=size)
+        torch.set_num_threads(available_cores())  # The cores this rank is pinned to
+    return rank(), world_size()
+
+
+def all_reduce_sum(tensor):
+    """Sums ``tensor`` over all ranks in place (no-op on a single process)."""
+    if world_size() > 1:
+        dist.all_reduce(tensor)
+    return tensor
+
+
+def all_reduce_max(tensor):
+    """Element-wise maximum of ``tensor`` over all ranks, in place."""
+    if world_size() > 1:
+        dist.all_reduce(tensor, op=dist.ReduceOp.MAX)
+    return tensor
+
+
+def broadcast_buffers(model):
+    """Copies rank 0's buffers (e.g. BatchNorm running statistics, which each
+    rank updates from its own batches) to every rank."""
+    if world_size() > 1:
+        for buffer in model.buffers():
+            dist.broadcast(buffer, src=0)
+
+
+def gather_sharded(array):
+    """Reassembles per-rank outputs of a ``ShardSampler`` loader (rank ``r``
+    holds samples ``r, r + world, ...``) into the original sample order."""
+    size = world_size()
+    if size == 1:
+        return array
+    parts = [None] * size
+    dist.all_gather_object(parts, array)
+    merged = np.empty((sum(len(part) for part in parts),) + array.shape[1:], dtype=array.dtype)
+    for r, part in enumerate(parts):
+        merged[r::size] = part
+    return merged
+
+
+def core_sets(nproc, cores=None):
+    """Splits the available cores into ``nproc`` disjoint, contiguous sets
+    (with fewer cores than ranks, the ranks share them round-robin)."""
+    cores = sorted(cores if cores is not None else
+                   (os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else range(os.cpu_count() or 1)))
+    if nproc > len(cores):
+        print(f'[launch] {nproc} ranks on {len(cores)} cores: ranks share cores, expect no speedup')
+        return [[cores[r % len(cores)]] for r in range(nproc)]
+    return [cores[len(cores) * r // nproc:len(cores) * (r + 1) // nproc] for r in range(nproc)]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def launch(command, nproc, env=None):
+    """Runs ``command`` (an argv list) as ranks ``0..nproc-1``, each pinned to
+    its own cores. Returns when all exit; raises if any rank fails."""
+    port = _free_port()
+    processes = []
+    for r, cores in enumerate(core_sets(nproc)):
+        rank_env = dict(os.environ, **(env or {}))
+        rank_env.update(RANK=str(r), LOCAL_RANK=str(r), WORLD_SIZE=str(nproc), MASTER_ADDR='127.0.0.1',
+                        MASTER_PORT=str(port), OMP_NUM_THREADS=str(len(cores)))
+        pin = (lambda cores=cores: os.sched_setaffinity(0, cores)) if hasattr(os, 'sched_setaffinity') else None
+        processes.append(subprocess.Popen(command, env=rank_env, preexec_fn=pin))
+
+    # Polled together: a rank that fails while another waits in a collective
+    # would otherwise only be noticed after the collective times out
+    failed = None
+    while failed is None and any(process.poll() is None for process in processes):
+        failed = next((r for r, process in enumerate(processes) if process.poll() not in (None, 0)), None)
+        if failed is None:
+            time.sleep(0.1)
+    if failed is None:
+        failed = next((r for r, process in enumerate(processes) if process.returncode != 0), None)
+    if failed is not None:
+        for process in processes:  # The others would block in the next collective
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            process.wait()
+        raise RuntimeError(f'rank {failed} of {" ".join(command)} failed')
+
+
+def _build_model(name, num_classes):
+    if name == 'efficientnet_b0':
+        from torchvision.models import efficientnet_b0
+        model = efficientnet_b0(weights=None)
+        model.classifier[1] = torch.nn.Linear(model.classifier[1].in_features, num_classes)
+        return model
+    import timm
+    return timm.create_model(name, pretrained=False, num_classes=num_classes)
+
+
+def _benchmark_worker(args):
+    from augmentation import BatchAugment
+    from data_loading import make_loader
+    from image_cache import CachedImageFolder
+    from training_engine import Trainer
+
+    init_from_env()
+    torch.manual_seed(0)
+    with main_process_first():
+        dataset = CachedImageFolder(args.data, size=224, as_pil=False)
+    samples = min(len(dataset), args.batch_size * args.steps * args.max_ranks)  # Same work for every world size
+    dataset = torch.utils.data.Subset(dataset, range(samples))
+    loader = make_loader(dataset, batch_size=args.batch_size * args.max_ranks // world_size(), shuffle=True,
+                         verbose=False)
+
+    model = _build_model(args.model, len(dataset.dataset.classes))
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    trainer = Trainer(model, optimizer, torch.nn.CrossEntropyLoss(), 'cpu', precision=args.precision,
+                      batch_transform=BatchAugment(hflip=True), name=f'{world_size()} ranks')
+    trainer.train_epoch(loader)  # Warm-up: worker start-up, allocator, oneDNN kernel selection
+    result = trainer.train_epoch(loader)
+    if is_main_process():
+        with open(args.output, 'w') as f:
+            json.dump({'images_per_sec': result['images_per_sec'], 'step_ms': result['step_ms']}, f)
+
+
+def benchmark(args):
+    """Global images/sec for each rank count; the global batch is kept at
+    ``batch_size * max(ranks)`` so only the parallelism changes."""
+    rows = []
+    for nproc in args.ranks:
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            command = [sys.executable, os.path.abspath(__file__), '_worker', args.data, '--model', args.model,
+                       '--batch-size', str(args.batch_size), '--steps', str(args.steps), '--precision',
+                       args.precision, '--max-ranks', str(max(args.ranks)), '--output', output.name]
+            launch(command, nproc)
+            with open(output.name) as f:
+                rows.append((nproc, json.load(f)['images_per_sec']))
+
+    base = rows[0][1] / rows[0][0]
+    print(f'{"ranks":>5} {"img/s":>9} {"speedup":>8} {"efficiency":>10}')
+    for nproc, throughput in rows:
+        print(f'{nproc:>5} {throughput:>9.1f} {throughput / rows[0][1]:>7.2f}x {throughput / (base * nproc):>9.0%}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Multi-process CPU data-parallel training')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    launch_parser = commands.add_parser('launch', help='run a training script on N local ranks')
+    launch_parser.add_argument('--nproc', type=int, default=2)
+    launch_parser.add_argument('script')
+    launch_parser.add_argument('script_args', nargs=argparse.REMAINDER)
+
+    for name in ('benchmark', '_worker'):
+        sub = commands.add_parser(name, help='training throughput for 1/2/4/8 ranks' if name == 'benchmark' else None)
+        sub.add_argument('data', help='ImageFolder root (its 224px image cache is built if missing)')
+        sub.add_argument('--model', default='efficientnet_b0', help="'efficientnet_b0' or a timm model name, "
+                                                                    "e.g. swin_tiny_patch4_window7_224")
+        sub.add_argument('--ranks', type=int, nargs='+', default=[1, 2, 4, 8])
+        sub.add_argument('--batch-size', type=int, default=8, help='per rank at the largest rank count')
+        sub.add_argument('--steps', type=int, default=10, help='optimizer steps per measured epoch')
+        sub.add_argument('--precision', default='bf16', choices=('fp32', 'bf16'))
+        sub.add_argument('--max-ranks', type=int, default=None)
+        sub.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    if args.command == 'launch':
+        launch([sys.executable, args.script] + args.script_args, args.nproc)
+    elif args.command == 'benchmark':
+        benchmark(args)
+    else:
+        _benchmark_worker(args)
@@ -0,0 +1,177 @@
+"""Confidence-gated early exit for the hybrid classifier.
+
+Most images are easy, but ``HybridSkinCancerModel`` always runs both
+backbones. ``EarlyExitCascade`` runs EfficientNet and a small exit head on
+every image, and Swin plus the fused ``fc`` only on the images whose exit
+confidence (top softmax probability) is at most ``threshold``. EfficientNet's
+features are computed once and reused by the fused head, so an image that
+exits costs EfficientNet only, and one that does not costs the same as the
+full model:
+
+    exit_head = make_exit_head(num_classes)
+    train_exit_head(hybrid_model, exit_head, train_loader, criterion, exit_optimizer, device, epochs=3,
+                    transform=batch_transform)
+    cascade = EarlyExitCascade(hybrid_model, exit_head)
+    rows, chosen = calibrate(cascade, val_loader, device, transform=image_transforms['val'], max_cost=0.5)
+    outputs = cascade(images)  # Logits of whichever stage decided each image
+
+``calibrate`` runs both stages on every image of the test split once,
+times them, and derives for a range of thresholds the accuracy, F1, mean
+latency per image and cost relative to the full model. It then sets the
+threshold with the best accuracy whose cost is at most ``max_cost``. The
+threshold is a buffer, so it is saved with the cascade's state dict.
+
+The exit head can also train on the features of an ``EmbeddingCache``
+(HEAD_ONLY in hybrid_model.py), without running EfficientNet at all:
+
+    train_head(lambda eff, swin: exit_head(eff), head_loader, criterion, exit_optimizer, device, epochs)
+"""
+
+import time
+
+import torch
+import torch.nn as nn
+
+from embedding_cache import train_head
+from metrics import ConfusionMatrix
+
+
+def make_exit_head(num_classes, in_features=1280, dropout=0.2):
+    """Pooled EfficientNet features to logits, like EfficientNet-B0's own classifier."""
+    return nn.Sequential(nn.Flatten(), nn.Dropout(dropout), nn.Linear(in_features, num_classes))
+
+
+class EarlyExitCascade(nn.Module):
+    def __init__(self, model, exit_head, threshold=1.0):
+        super(EarlyExitCascade, self).__init__()
+        self.model = model
+        self.exit_head = exit_head
+        self.register_buffer('threshold', torch.tensor(float(threshold)))  # 1.0: no image exits
+
+    def set_threshold(self, threshold):
+        self.threshold.fill_(float(threshold))
+
+    def forward(self, x, return_exits=False):
+        eff_features = self.model.efficientnet(x)
+        logits = self.exit_head(eff_features)
+        exits = torch.softmax(logits.float(), dim=1).amax(dim=1) > self.threshold
+        hard = (~exits).nonzero().squeeze(1)
+        if hard.numel():
+            # Swin and the fused head only for the images the exit head is unsure about
+            fused = self.model.head(eff_features[hard], self.model.swin_transformer(x[hard]))
+            logits = logits.index_copy(0, hard, fused.to(logits.dtype))
+        return (logits, exits) if return_exits else logits
+
+
+def train_exit_head(model, exit_head, loader, criterion, optimizer, device, epochs, transform=None):
+    """Trains ``exit_head`` on the features of the frozen (eval-mode)
+    EfficientNet branch of ``model``; ``optimizer`` holds the exit head only."""
+    model.eval()
+    exit_head.train()
+
+    def head_fn(images):
+        with torch.no_grad():
+            if transform is not None:
+                images = transform(images)
+            eff_features = model.efficientnet(images)
+        return exit_head(eff_features)
+
+    return train_head(head_fn, loader, criterion, optimizer, device, epochs)
+
+
+def _sync(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def _timed(fn, device):
+    _sync(device)
+    start = time.perf_counter()
+    result = fn()
+    _sync(device)
+    return result, time.perf_counter() - start
+
+
+def _predictions(exit_logits, fused_logits, confidence, threshold):
+    exits = confidence > threshold
+    return torch.where(exits, exit_logits.argmax(dim=1), fused_logits.argmax(dim=1)), exits
+
+
+def calibrate(cascade, loader, device, transform=None, thresholds=None, max_cost=0.5, verify=True):
+    """Accuracy/F1 against mean latency per image on ``loader`` (the test
+    split) for each threshold, from one pass that runs and times both stages
+    on every image. Sets the most accurate threshold whose estimated cost is
+    at most ``max_cost`` of the full model (the cheapest one if none is), and
+    with ``verify`` times the cascade at that threshold in a second pass.
+    Returns the rows of the curve and the chosen row."""
+    cascade.eval()
+    model, exit_head = cascade.model, cascade.exit_head
+    exit_logits, fused_logits, labels = [], [], []
+    seconds = {'efficientnet': 0.0, 'exit_head': 0.0, 'swin_and_fc': 0.0}
+    with torch.inference_mode():
+        for images, targets in loader:
+            images = images.to(device)
+            if transform is not None:
+                images = transform(images)
+            eff_features, elapsed = _timed(lambda: model.efficientnet(images), device)
+            seconds['efficientnet'] += elapsed
+            logits, elapsed = _timed(lambda: exit_head(eff_features), device)
+            seconds['exit_head'] += elapsed
+            fused, elapsed = _timed(lambda: model.head(eff_features, model.swin_transformer(images)), device)
+            seconds['swin_and_fc'] += elapsed
+            exit_logits.append(logits.float().cpu())
+            fused_logits.append(fused.float().cpu())
+            labels.append(targets)
+    exit_logits, fused_logits, labels = torch.cat(exit_logits), torch.cat(fused_logits), torch.cat(labels)
+    ms = {name: 1000 * total / len(labels) for name, total in seconds.items()}  # Per image
+    full_ms = ms['efficientnet'] + ms['swin_and_fc']
+
+    confidence = torch.softmax(exit_logits, dim=1).amax(dim=1)
+    if thresholds is None:
+        # Exit fractions from 100% to 0% in 5% steps
+        thresholds = torch.quantile(confidence, torch.linspace(0, 1, 21)).tolist()
+        thresholds = sorted(set([0.0] + thresholds[:-1] + [1.0]))
+
+    num_classes = exit_logits.size(1)
+    rows = []
+    print(f'{"threshold":>9} {"exit %":>7} {"accuracy":>9} {"F1":>7} {"ms/image":>9} {"cost":>6}')
+    for threshold in thresholds:
+        preds, exits = _predictions(exit_logits, fused_logits, confidence, threshold)
+        metrics = ConfusionMatrix(num_classes)
+        metrics.update(preds, labels)
+        exit_rate = exits.float().mean().item()
+        latency = ms['efficientnet'] + ms['exit_head'] + (1 - exit_rate) * ms['swin_and_fc']
+        row = {'threshold': threshold, 'exit_rate': exit_rate, 'accuracy': metrics.accuracy(),
+               'f1': metrics.f1('weighted'), 'ms_per_image': latency, 'cost': latency / full_ms}
+        rows.append(row)
+        print(f'{threshold:>9.4f} {100 * exit_rate:>6.1f}% {100 * row["accuracy"]:>8.2f}% {row["f1"]:>7.4f} '
+              f'{latency:>9.2f} {row["cost"]:>6.2f}')
+
+    full = ConfusionMatrix(num_classes)
+    full.update(fused_logits.argmax(dim=1), labels)
+    affordable = [row for row in rows if row['cost'] <= max_cost]
+    if affordable:
+        chosen = max(affordable, key=lambda row: (row['accuracy'], -row['cost']))
+    else:
+        chosen = min(rows, key=lambda row: row['cost'])
+    cascade.set_threshold(chosen['threshold'])
+    print(f'Full model: {100 * full.accuracy():.2f}% accuracy, {full_ms:.2f} ms/image '
+          f'(EfficientNet {ms["efficientnet"]:.2f}, exit head {ms["exit_head"]:.2f}, Swin + fc {ms["swin_and_fc"]:.2f})')
+    print(f'Chosen threshold {chosen["threshold"]:.4f}: {100 * chosen["exit_rate"]:.1f}% exit early, '
+          f'{100 * chosen["accuracy"]:.2f}% accuracy, estimated {chosen["ms_per_image"]:.2f} ms/image '
+          f'({chosen["cost"]:.2f}x the full model)')
+
+    if verify:
+        total, count = 0.0, 0
+        with torch.inference_mode():
+            for images, _ in loader:
+                images = images.to(device)
+                if transform is not None:
+                    images = transform(images)
+                _, elapsed = _timed(lambda: cascade(images), device)
+                total += elapsed
+                count += images.size(0)
+        chosen['measured_ms_per_image'] = 1000 * total / count
+        print(f'Measured at the chosen threshold: {chosen["measured_ms_per_image"]:.2f} ms/image '
+              f'({chosen["measured_ms_per_image"] / full_ms:.2f}x the full model)')
+    return rows, chosen
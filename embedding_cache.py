@@ -0,0 +1,169 @@
+"""On-disk cache of backbone embeddings for head-only training.
+
+``HybridSkinCancerModel`` recomputes the EfficientNet-B0 and Swin-Tiny
+features of every image every epoch, even when only the fusion head
+(``swin_fc`` + ``fc``) is being trained or redesigned. ``EmbeddingCache`` runs
+the backbones once and keeps their outputs in float16 shards:
+
+    <cache_dir>/<name>-<weights hash>/shard-00000.<field>.npy
+                                      shard-00000.keys.json
+
+Entries are keyed by the image content hash (the sha1 recorded in the
+dataset manifest), and the directory by a hash of the backbone weights.
+Opening a cache with different weights deletes the stale directories of the
+same name, so features from old backbones are never served. Extraction only
+computes images that are not cached yet.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Subset
+
+from data_loading import make_loader
+
+
+def weights_hash(modules, extra=''):
+    digest = hashlib.sha1(extra.encode())
+    for name in sorted(modules):
+        for key, tensor in modules[name].state_dict().items():
+            digest.update(f'{name}.{key}'.encode())
+            digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+class EmbeddingCache:
+    """Sharded feature cache for the named ``backbones``.
+
+    ``extra`` should describe anything else that changes the features, e.g.
+    the input size or normalization.
+    """
+
+    def __init__(self, cache_dir, name, backbones, extra='', shard_size=4096):
+        self.fields = list(backbones)
+        self.shard_size = shard_size
+        self.dir = os.path.join(cache_dir, f'{name}-{weights_hash(backbones, extra)}')
+
+        if os.path.isdir(cache_dir):
+            for entry in os.listdir(cache_dir):
+                path = os.path.join(cache_dir, entry)
+                if entry.startswith(name + '-') and path != self.dir and os.path.isdir(path):
+                    print(f'[embeddings] removing stale cache {path}')
+                    shutil.rmtree(path)
+        os.makedirs(self.dir, exist_ok=True)
+
+        self._index = {}
+        self._shards = []
+        for file_name in sorted(os.listdir(self.dir)):
+            if file_name.endswith('.keys.json'):
+                self._load_shard(file_name[:-len('.keys.json')])
+
+    def _load_shard(self, prefix):
+        with open(os.path.join(self.dir, prefix + '.keys.json')) as f:
+            keys = json.load(f)
+        arrays = {field: np.load(os.path.join(self.dir, f'{prefix}.{field}.npy'), mmap_mode='r')
+                  for field in self.fields}
+        shard = len(self._shards)
+        self._shards.append(arrays)
+        for row, key in enumerate(keys):
+            self._index[key] = (shard, row)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, key):
+        shard, row = self._index[key]
+        return tuple(self._shards[shard][field][row] for field in self.fields)
+
+    def _write_shard(self, keys, outputs):
+        prefix = f'shard-{len(self._shards):05d}'
+        for field, chunks in zip(self.fields, outputs):
+            np.save(os.path.join(self.dir, f'{prefix}.{field}.npy'), np.concatenate(chunks))
+        # The key list is written last, it is what marks a shard as complete
+        with open(os.path.join(self.dir, prefix + '.keys.json'), 'w') as f:
+            json.dump(keys, f)
+        self._load_shard(prefix)
+
+    @torch.no_grad()
+    def extract(self, dataset, keys, feature_fn, device, transform=None, batch_size=64):
+        """Computes and stores the features of every ``dataset[i]`` whose
+        ``keys[i]`` is not cached yet.
+
+        ``feature_fn(images)`` returns one tensor per backbone, in the order
+        the backbones were given; ``transform`` is applied to each batch on
+        the device first (e.g. ``BatchAugment()`` for uint8 datasets).
+        """
+        missing, seen = [], set(self._index)
+        for i, key in enumerate(keys):
+            if key not in seen:
+                missing.append(i)
+                seen.add(key)
+        if not missing:
+            return
+
+        loader = make_loader(Subset(dataset, missing), batch_size=batch_size, shuffle=False, name='embed')
+        pending_keys, pending = [], [[] for _ in self.fields]
+        position = 0
+        for images, _ in loader:
+            images = images.to(device)
+            if transform is not None:
+                images = transform(images)
+            for chunks, output in zip(pending, feature_fn(images)):
+                chunks.append(output.float().cpu().numpy().astype(np.float16))
+            pending_keys.extend(keys[i] for i in missing[position:position + len(images)])
+            position += len(images)
+
+            if len(pending_keys) >= self.shard_size:
+                self._write_shard(pending_keys, pending)
+                pending_keys, pending = [], [[] for _ in self.fields]
+        if pending_keys:
+            self._write_shard(pending_keys, pending)
+        print(f'[embeddings] cached {len(missing)} new images in {self.dir}')
+
+    def dataset(self, keys, targets):
+        return EmbeddingDataset(self, keys, targets)
+
+
+class EmbeddingDataset(Dataset):
+    """``(feature, ..., target)`` samples served from an ``EmbeddingCache``."""
+
+    def __init__(self, cache, keys, targets):
+        self.cache = cache
+        self.keys = list(keys)
+        self.targets = list(targets)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, index):
+        features = self.cache.get(self.keys[index])
+        return tuple(torch.from_numpy(np.asarray(f, dtype=np.float32)) for f in features) + (self.targets[index],)
+
+
+def train_head(head_fn, loader, criterion, optimizer, device, epochs):
+    """Trains ``head_fn(*features)`` on batches from an ``EmbeddingDataset``
+    loader; ``optimizer`` should only hold the head's parameters."""
+    history = []
+    for epoch in range(epochs):
+        running_loss = 0.0
+        for *features, labels in loader:
+            features = [f.to(device) for f in features]
+            labels = labels.to(device)
+
+            optimizer.zero_grad()
+            loss = criterion(head_fn(*features), labels)
+            loss.backward()
+            optimizer.step()
+
+            running_loss += loss.item()
+
+        history.append(running_loss / len(loader))
+        print(f"Head epoch [{epoch + 1}/{epochs}], Loss: {history[-1]:.4f}")
+    return history
@@ -0,0 +1,192 @@
+"""Run inference over an evaluation set once and reuse the outputs.
+
+The scripts print accuracy, F1, a classification report and a confusion
+matrix from separate full passes over the same test set (three in swim.py,
+two in swin.py, ``model.predict`` twice in dccn.py). ``evaluate_cached`` runs
+the pass once per (model weights, dataset, transform) and stores the logits,
+probabilities and labels in a small ``.npz``; every report, plot and
+threshold sweep then reads from the returned ``EvaluationResults``:
+
+    results = evaluate_cached(EVAL_CACHE_DIR, 'swim-test', model.state_dict(), test_data,
+                              lambda: trainer.predict(test_loader, transform=test_transform),
+                              transform=test_transform)
+    results.accuracy(), results.confusion(), results.threshold_sweep()
+    ConfusionMatrix.from_matrix(results.confusion()).report(class_names)
+
+``compute`` returns ``(outputs, labels)``: logits ``(N, C)`` for softmax
+models, or the ``(N, 1)`` sigmoid probabilities ``model.predict`` gives for
+the binary Keras models. Any change of weights, sample list, dataset
+transform or ``transform`` gives a new key, so stale results are never read.
+This module only needs numpy, the Keras scripts use it as well.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+def _update(digest, value):
+    # Tensors (PyTorch) and arrays (Keras get_weights) are hashed by their bytes
+    if hasattr(value, 'detach'):
+        value = value.detach().cpu().numpy()
+    digest.update(np.ascontiguousarray(value).tobytes())
+
+
+def weights_fingerprint(weights):
+    """Hash of a ``state_dict()`` or a ``get_weights()`` list."""
+    digest = hashlib.sha1()
+    if isinstance(weights, dict):
+        for name in sorted(weights):
+            digest.update(name.encode())
+            _update(digest, weights[name])
+    else:
+        for value in weights:
+            _update(digest, value)
+    return digest.hexdigest()
+
+
+def describe(obj):
+    """Text that changes whenever ``obj``'s configuration does.
+
+    ``repr`` covers torchvision transforms; objects whose repr does not show
+    their settings (e.g. ``BatchAugment``) add their plain attributes. The
+    default ``object.__repr__`` (Keras ``ImageDataGenerator``) contains the
+    memory address and would change every run, so such objects are described
+    by their class and plain attributes only.
+    """
+    if obj is None:
+        return 'None'
+    if type(obj).__repr__ is object.__repr__:
+        text = f'{type(obj).__module__}.{type(obj).__qualname__}'
+    else:
+        text = repr(obj)
+    plain = {key: value for key, value in sorted(vars(obj).items())
+             if not key.startswith('_') and isinstance(value, (bool, int, float, str, tuple, list, type(None)))
+             } if hasattr(obj, '__dict__') else {}
+    buffers = {name: np.asarray(buffer.detach().cpu()).tolist() for name, buffer in obj.named_buffers()
+               } if hasattr(obj, 'named_buffers') else {}
+    return json.dumps([text, plain, buffers], default=str)
+
+
+def dataset_fingerprint(data):
+    """Hash of the sample list of a dataset or ``ImagePipeline`` (paths,
+    labels, subset indices, the dataset transform and the modification time
+    of its image cache or shards)."""
+    digest = hashlib.sha1(type(data).__name__.encode())
+    if hasattr(data, 'indices') and hasattr(data, 'dataset'):  # torch Subset
+        digest.update(json.dumps(list(map(int, data.indices))).encode())
+        data = data.dataset
+        digest.update(dataset_fingerprint(data).encode())
+        return digest.hexdigest()
+
+    for name in ('samples', 'filenames', 'targets', 'classes'):
+        value = getattr(data, name, None)
+        if value is not None:
+            digest.update(json.dumps(np.asarray(value).tolist(), default=str).encode())
+    digest.update(describe(getattr(data, 'transform', None)).encode())
+
+    files = [getattr(data, 'images_path', None)] + list(getattr(getattr(data, 'archive', None), 'shards', []))
+    for path in files:
+        if path and os.path.exists(path):
+            digest.update(f'{path}:{os.path.getmtime(path)}'.encode())
+    return digest.hexdigest()
+
+
+class EvaluationResults:
+    """Outputs of one inference pass: ``outputs`` are ``(N, C)`` logits, or
+    ``(N, 1)`` probabilities for sigmoid models (``binary``)."""
+
+    def __init__(self, outputs, labels):
+        self.outputs = np.asarray(outputs, dtype=np.float32)
+        self.labels = np.asarray(labels).reshape(-1).astype(np.int64)
+        self.binary = self.outputs.ndim == 1 or self.outputs.shape[1] == 1
+
+        if self.binary:
+            positive = self.outputs.reshape(-1)
+            self.probs = np.stack([1 - positive, positive], axis=1)
+        else:
+            shifted = self.outputs - self.outputs.max(axis=1, keepdims=True)
+            exp = np.exp(shifted)
+            self.probs = exp / exp.sum(axis=1, keepdims=True)
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def num_classes(self):
+        return self.probs.shape[1]
+
+    def predictions(self, threshold=0.5):
+        """Argmax, or ``probs[:, 1] > threshold`` for two classes (the same
+        as argmax at 0.5, and as ``predict(...) > 0.5`` for sigmoid models)."""
+        if self.num_classes == 2:
+            return (self.probs[:, 1] > threshold).astype(np.int64)
+        return self.probs.argmax(axis=1)
+
+    @property
+    def preds(self):
+        return self.predictions()
+
+    def accuracy(self, threshold=0.5):
+        return float((self.predictions(threshold) == self.labels).mean()) if len(self) else 0.0
+
+    def log_loss(self):
+        """Mean cross-entropy of the labels, like ``nn.CrossEntropyLoss``."""
+        picked = self.probs[np.arange(len(self)), self.labels]
+        return float(-np.log(np.clip(picked, 1e-12, None)).mean()) if len(self) else 0.0
+
+    def confusion(self, threshold=0.5):
+        """``(C, C)`` matrix (rows true, columns predicted), like ``confusion_matrix``."""
+        index = self.labels * self.num_classes + self.predictions(threshold)
+        return np.bincount(index, minlength=self.num_classes ** 2).reshape(self.num_classes, self.num_classes)
+
+    def threshold_sweep(self, thresholds=None, pos_label=1):
+        """Precision, recall, F1 and accuracy of the positive class for each
+        decision threshold on ``probs[:, pos_label]`` (two classes only)."""
+        if self.num_classes != 2:
+            raise ValueError('threshold_sweep needs a two-class model')
+        if thresholds is None:
+            thresholds = np.linspace(0.05, 0.95, 19)
+        scores = self.probs[:, pos_label]
+        positive = self.labels == pos_label
+        rows = []
+        for threshold in thresholds:
+            predicted = scores > threshold
+            tp = int((predicted & positive).sum())
+            precision = tp / predicted.sum() if predicted.sum() else 0.0
+            recall = tp / positive.sum() if positive.sum() else 0.0
+            f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+            rows.append({'threshold': float(threshold), 'precision': precision, 'recall': recall, 'f1': f1,
+                         'accuracy': float((predicted == positive).mean())})
+        return rows
+
+    def save(self, path):
+        tmp = f'{path}.{os.getpid()}.tmp.npz'  # Ranks of a data-parallel job may write the same file
+        np.savez(tmp, outputs=self.outputs, labels=self.labels, probs=self.probs.astype(np.float16))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['outputs'], data['labels'])
+
+
+def evaluate_cached(cache_dir, name, weights, data, compute, transform=None, extra=''):
+    """Returns the ``EvaluationResults`` for ``(weights, data, transform)``,
+    calling ``compute()`` (which must return ``(outputs, labels)``) only if
+    they are not cached in ``cache_dir`` yet."""
+    key = hashlib.sha1('\n'.join([weights_fingerprint(weights), dataset_fingerprint(data), describe(transform),
+                                  extra]).encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, f'{name}-{key}.npz')
+    if os.path.exists(path):
+        print(f'[eval] {name}: reusing {path}')
+        return EvaluationResults.load(path)
+
+    outputs, labels = compute()
+    results = EvaluationResults(outputs, labels)
+    os.makedirs(cache_dir, exist_ok=True)
+    results.save(path)
+    print(f'[eval] {name}: {len(results)} samples evaluated, stored in {path}')
+    return results
@@ -0,0 +1,250 @@
+"""Gradual unfreezing: train the head first, then open the backbone block by block.
+
+Fine-tuning all of a pretrained backbone from the first step pays for
+backward through every layer and for Adam's two moment buffers per weight,
+while the new head is still producing noise gradients. Here the backbone is
+split into blocks, listed from the output side down, and block ``i`` becomes
+trainable at epoch ``unfreeze_at[i]``:
+
+    unfreezer = GradualUnfreezer(model, optimizer, ['features.8', 'features.7', 'features.6', 'features'],
+                                 unfreeze_at=[2, 4, 6, 8])
+    trainer = Trainer(model, optimizer, criterion, device, unfreezer=unfreezer)
+    ...
+    unfreezer.report()
+
+While a block is frozen its parameters have ``requires_grad=False`` and are
+taken out of the optimizer, so autograd neither records nor backpropagates
+the frozen bottom of the network and no optimizer state exists for it. An
+unfrozen block rejoins the optimizer with the hyperparameters of the group it
+came from (e.g. the 1e-5 of ``param_groups``' ``features``). BatchNorm layers
+of frozen blocks stay in eval mode, so their running statistics are frozen
+too. A parameter belongs to the first block that matches it, so a last block
+of ``'features'`` holds whatever the earlier ones left; parameters outside all
+blocks (the head) are never touched.
+
+``fit_unfreezing`` does the same for Keras models, with blocks given as
+lists of layers; it runs one ``fit`` per phase and carries the optimizer
+state of the layers that were already training across the recompile.
+
+Both print, per phase, the trainable parameters, the memory of their
+gradients plus optimizer state, and the mean step time.
+"""
+
+import collections
+import time
+
+try:
+    import torch
+except ImportError:  # Keras-only environments (fit_unfreezing)
+    torch = None
+
+PhaseStats = collections.namedtuple('PhaseStats', ['blocks', 'epochs', 'trainable', 'state_mb', 'step_ms',
+                                                   'backward_ms', 'images_per_sec', 'peak_mb'])
+
+
+def blocks_unfrozen(unfreeze_at, epoch):
+    """Number of blocks trainable in ``epoch`` (0-based)."""
+    return sum(1 for start in unfreeze_at if start <= epoch)
+
+
+def _check_schedule(blocks, unfreeze_at):
+    if len(unfreeze_at) != len(blocks):
+        raise ValueError(f'unfreeze_at needs one epoch per block ({len(blocks)}), got {len(unfreeze_at)}')
+    if list(unfreeze_at) != sorted(unfreeze_at):
+        raise ValueError(f'blocks unfreeze from the output side down, so unfreeze_at must be sorted: {unfreeze_at}')
+
+
+def _print_report(name, phases):
+    print(f'[{name}] {"blocks":>6} {"epochs":>6} {"trainable":>10} {"grad+opt MB":>11} {"ms/step":>8} '
+          f'{"backward":>8} {"img/s":>8} {"peak MB":>8}')
+    for phase in phases:
+        backward = '-' if phase.backward_ms is None else f'{phase.backward_ms:.0f}'
+        images = '-' if phase.images_per_sec is None else f'{phase.images_per_sec:.1f}'
+        peak = '-' if phase.peak_mb is None else f'{phase.peak_mb:.0f}'
+        print(f'[{name}] {phase.blocks:>6} {phase.epochs:>6} {phase.trainable:>10,} {phase.state_mb:>11.1f} '
+              f'{phase.step_ms:>8.0f} {backward:>8} {images:>8} {peak:>8}')
+
+
+class GradualUnfreezer:
+    """Freezes the blocks (module name prefixes, output side first; a tuple of
+    prefixes makes one block of several modules) of a PyTorch model that are
+    not yet due according to ``unfreeze_at``. Call ``update(epoch)`` after
+    ``model.train()`` at the start of every epoch; ``Trainer`` does this when
+    given ``unfreezer=``."""
+
+    def __init__(self, model, optimizer, blocks, unfreeze_at, freeze_norm=True, name='unfreeze'):
+        _check_schedule(blocks, unfreeze_at)
+        self.model = model
+        self.optimizer = optimizer
+        self.unfreeze_at = list(unfreeze_at)
+        self.freeze_norm = freeze_norm
+        self.name = name
+        prefixes = [(block,) if isinstance(block, str) else tuple(block) for block in blocks]
+
+        def block_of(name):
+            # The first block that matches, so a last block of e.g. 'features' takes the rest of the backbone
+            return next((i for i, names in enumerate(prefixes)
+                         if any(name == prefix or name.startswith(prefix + '.') for prefix in names)), None)
+
+        self.blocks = [[] for _ in blocks]  # [[(name, parameter), ...], ...]
+        self.block_modules = [[] for _ in blocks]
+        for name, p in model.named_parameters():
+            if block_of(name) is not None:
+                self.blocks[block_of(name)].append((name, p))
+        for name, module in model.named_modules():
+            if block_of(name) is not None:
+                self.block_modules[block_of(name)].append(module)
+        for block, params in zip(blocks, self.blocks):
+            if not params:
+                raise ValueError(f'block {block!r} matches no parameter of the model')
+
+        self._home = {}  # Parameter -> hyperparameters of the optimizer group it was taken from
+        for group in optimizer.param_groups:
+            settings = {key: value for key, value in group.items() if key != 'params'}
+            for p in group['params']:
+                self._home[p] = settings
+        self.unfrozen = None
+        self.phases = []
+        self._phase = None
+        self.update(0)
+
+    def update(self, epoch):
+        """Applies the phase of ``epoch``. Returns True if the set of
+        trainable parameters changed (a DDP wrapper has to be rebuilt)."""
+        count = blocks_unfrozen(self.unfreeze_at, epoch)
+        changed = count != self.unfrozen
+        if changed:
+            frozen = {p for block in self.blocks[count:] for _, p in block}
+            for group in self.optimizer.param_groups:
+                for p in [p for p in group['params'] if p in frozen]:
+                    self.optimizer.state.pop(p, None)  # Adam's moments of a frozen weight are dropped
+                group['params'] = [p for p in group['params'] if p not in frozen]
+            in_optimizer = {p for group in self.optimizer.param_groups for p in group['params']}
+            # One group per (block, original group), in block order, so resuming at
+            # any epoch rebuilds the groups a checkpointed optimizer state expects
+            for block in self.blocks[:count]:
+                pending = collections.OrderedDict()
+                for _, p in block:
+                    if p not in in_optimizer and p in self._home:
+                        pending.setdefault(id(self._home[p]), (self._home[p], []))[1].append(p)
+                for settings, params in pending.values():
+                    self.optimizer.add_param_group(dict(settings, params=params))
+            for i, block in enumerate(self.blocks):
+                for _, p in block:
+                    p.requires_grad_(i < count)
+                    p.grad = None
+            self.unfrozen = count
+            self._start_phase()
+        if self.freeze_norm and self.model.training:
+            for modules in self.block_modules[count:]:
+                for module in modules:
+                    if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
+                        module.eval()
+        return changed
+
+    def trainable_parameters(self):
+        return sum(p.numel() for p in self.model.parameters() if p.requires_grad)
+
+    def state_bytes(self):
+        """Gradients of the trainable parameters plus the optimizer state."""
+        grads = sum(p.numel() * p.element_size() for p in self.model.parameters() if p.requires_grad)
+        state = sum(value.numel() * value.element_size() for values in self.optimizer.state.values()
+                    for value in values.values() if hasattr(value, 'numel') and value.dim() > 0)
+        return grads + state
+
+    def _start_phase(self):
+        self._phase = {'blocks': self.unfrozen, 'epochs': 0, 'step_ms': 0.0, 'backward_ms': 0.0, 'images_per_sec': 0.0}
+        self.phases.append(None)
+        self._cuda = torch.cuda.is_available() and any(p.is_cuda for p in self.model.parameters())
+        if self._cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def record(self, result):
+        """Adds a ``Trainer.train_epoch`` result to the current phase."""
+        phase = self._phase
+        phase['epochs'] += 1
+        phase['step_ms'] += sum(result['step_ms'].values())
+        phase['backward_ms'] += result['step_ms']['backward']
+        phase['images_per_sec'] += result['images_per_sec']
+        epochs = phase['epochs']
+        self.phases[-1] = PhaseStats(phase['blocks'], epochs, self.trainable_parameters(), self.state_bytes() / 2 ** 20,
+                                     phase['step_ms'] / epochs, phase['backward_ms'] / epochs,
+                                     phase['images_per_sec'] / epochs,
+                                     torch.cuda.max_memory_allocated() / 2 ** 20 if self._cuda else None)
+
+    def report(self):
+        """Prints and returns the ``PhaseStats`` of every phase trained so far."""
+        phases = [phase for phase in self.phases if phase is not None]
+        _print_report(self.name, phases)
+        return phases
+
+
+def _keras_state_bytes(model):
+    grads = sum(int(v.numpy().nbytes) for v in model.trainable_variables)
+    state = sum(int(v.numpy().nbytes) for v in model.optimizer.variables if len(v.shape))
+    return grads + state
+
+
+def fit_unfreezing(model, blocks, unfreeze_at, train_data, epochs, validation_data=None, callbacks=None,
+                   verbose='auto', name='unfreeze', **fit_kwargs):
+    """Keras training with gradual unfreezing: ``blocks`` are lists of layers
+    (output side first), block ``i`` is trainable from epoch ``unfreeze_at[i]``.
+    The model must be compiled; it is recompiled at every phase with a new
+    optimizer of the same configuration that keeps the state (and step
+    count) of the variables trained before. Returns a History-like object with
+    the merged ``.history`` and the ``PhaseStats`` as ``.phases``."""
+    import tensorflow as tf
+
+    from progressive_resizing import _MergedHistory
+
+    _check_schedule(blocks, unfreeze_at)
+    compile_config = model.get_compile_config()
+    if compile_config is None:
+        raise ValueError('fit_unfreezing needs a compiled model')
+
+    class StepTimer(tf.keras.callbacks.Callback):
+        def on_train_batch_begin(self, batch, logs=None):
+            self.start = time.perf_counter()
+
+        def on_train_batch_end(self, batch, logs=None):
+            if self.traced:  # The first step of a phase traces a new train function
+                self.total += time.perf_counter() - self.start
+                self.steps += 1
+            self.traced = True
+
+    starts = sorted({0} | {epoch for epoch in unfreeze_at if 0 < epoch < epochs})
+    merged, phases = _MergedHistory(), []
+    for first, last in zip(starts, starts[1:] + [epochs]):
+        count = blocks_unfrozen(unfreeze_at, first)
+        for i, block in enumerate(blocks):
+            for layer in block:
+                layer.trainable = i < count
+
+        previous = model.optimizer
+        if previous is not None and previous.built:
+            # Fresh optimizer for the new variable set, seeded with the old one's state
+            saved = {v.path: v for v in previous.variables}
+            model.compile_from_config(compile_config)
+            model.optimizer.build(model.trainable_variables)
+            for variable in model.optimizer.variables:
+                if variable.path in saved:
+                    variable.assign(saved[variable.path])
+
+        print(f'[{name}] epochs {first + 1}-{last}: {count}/{len(blocks)} blocks trainable, '
+              f'{sum(int(tf.size(v)) for v in model.trainable_variables):,} parameters')
+        timer = StepTimer()
+        timer.total, timer.steps, timer.traced = 0.0, 0, False
+        history = model.fit(train_data, validation_data=validation_data, initial_epoch=first, epochs=last,
+                            callbacks=list(callbacks or []) + [timer], verbose=verbose, **fit_kwargs)
+        for key, values in history.history.items():
+            merged.history[key].extend(values)
+        merged.epoch.extend(history.epoch)
+        phases.append(PhaseStats(count, len(history.epoch), sum(int(tf.size(v)) for v in model.trainable_variables),
+                                 _keras_state_bytes(model) / 2 ** 20, 1000 * timer.total / max(1, timer.steps),
+                                 None, None, None))
+        if getattr(model, 'stop_training', False):
+            break
+    merged.history = dict(merged.history)
+    merged.phases = phases
+    _print_report(name, phases)
+    return merged
@@ -7,26 +7,101 @@ Original file is located at
     https://colab.research.google.com/drive/1g24MZ6YWdPZFcMu4tM1BXpk7IA4Ai-M2
 """
 
+import shutil
+
 import torch
 import torch.nn as nn
 from torchvision import datasets, transforms
-from torchvision.models import efficientnet_b0
-import timm
 from torch.utils.data import DataLoader
 
-# EfficientNet feature extractor
-efficientnet = efficientnet_b0(pretrained=True)
-efficientnet_feature_extractor = nn.Sequential(*list(efficientnet.children())[:-1])  # Remove the classification head
+from hybrid_network import HybridSkinCancerModel, benchmark_concurrency, feature_extractors
 
-# Swin Transformer feature extractor
-swin_transformer = timm.create_model('swin_tiny_patch4_window7_224', pretrained=True)
-swin_feature_extractor = nn.Sequential(*list(swin_transformer.children())[:-1])  # Remove the classification head
+# EfficientNet and Swin Transformer feature extractors (classification heads removed)
+efficientnet_feature_extractor, swin_feature_extractor = feature_extractors(pretrained=True)
 
 from google.colab import drive
 
+import image_loading
+from activation_checkpointing import enable_activation_checkpointing, memory_report
+from augmentation import BatchAugment
+from checkpointing import CheckpointManager
+from data_loading import make_loader
+from distillation import TeacherLogits, build_student, compare, distill
+from early_exit import EarlyExitCascade, calibrate, make_exit_head, train_exit_head
+from embedding_cache import EmbeddingCache, train_head
+from gradual_unfreezing import GradualUnfreezer
+from image_cache import CachedImageFolder
+from metrics import ConfusionMatrix
+from retrieval_index import RetrievalIndex, benchmark, embed, pooled_features
+from training_engine import Trainer
+
 # Mount Google Drive
 drive.mount('/content/drive')
 
+# Decode JPEGs at reduced resolution (DCT scaling) before the final resize,
+# set to False to decode at full resolution
+image_loading.FAST_DECODE = True
+
+# Training engine settings: bfloat16 autocast (also on CPU), gradient accumulation
+# up to EFFECTIVE_BATCH_SIZE (None = one step per batch), optional torch.compile
+PRECISION = 'bf16'
+EFFECTIVE_BATCH_SIZE = None
+COMPILE_MODEL = False
+
+# Checkpoints (checkpointing.py) are written in the background every CHECKPOINT_EVERY_STEPS
+# optimizer steps and at the end of each epoch; a restarted run resumes from the latest one
+CHECKPOINT_DIR = '/content/drive/MyDrive/checkpoints/hybrid'
+CHECKPOINT_EVERY_STEPS = 200
+
+# Activation checkpointing (activation_checkpointing.py): recompute the Swin branch in
+# backward instead of storing its activations, per 'stage' or per 'block' (None = off),
+# optionally the EfficientNet MBConv stages/blocks too. MEMORY_REPORT prints memory and
+# throughput of these settings at batch sizes 16-128 before training.
+ACTIVATION_CHECKPOINT_SWIN = None
+ACTIVATION_CHECKPOINT_EFFICIENTNET = None
+MEMORY_REPORT = False
+
+# Gradual unfreezing (gradual_unfreezing.py): the fusion head (swin_fc + fc) trains alone,
+# then the top of each backbone (EfficientNet stages 7-8, the last Swin stage), the stages
+# below them and finally the rest of both backbones join at the epochs in UNFREEZE_AT.
+# Frozen parts get no backward pass and no Adam state. None trains everything from the start
+UNFREEZE_AT = None  # e.g. [2, 4, 6]
+UNFREEZE_BLOCKS = [
+    ('efficientnet.0.8', 'efficientnet.0.7', 'swin_transformer.1.3', 'swin_transformer.2'),
+    ('efficientnet.0.6', 'efficientnet.0.5', 'swin_transformer.1.2'),
+    ('efficientnet', 'swin_transformer'),
+]
+
+# Fusion head for the Swin features (hybrid_network.py): 'flatten' is the original
+# Linear(7 * 7 * 768, 768) with 28.9M parameters; 'pool', 'attention' (0.6M) and 'low_rank'
+# (2.5M at rank 64) are compact. `python hybrid_network.py fusion` compares them and
+# `python hybrid_network.py convert` turns a flatten checkpoint into a compact one
+FUSION = 'flatten'
+FUSION_RANK = 64
+
+# Early-exit cascade (early_exit.py): after training, a small head on the EfficientNet
+# features is trained for EXIT_EPOCHS and its confidence threshold calibrated on the test
+# split; Swin and the fused fc then only run on images it is unsure about. The threshold
+# is the most accurate one costing at most EXIT_MAX_COST of the full model
+EARLY_EXIT = False
+EXIT_EPOCHS = 3
+EXIT_MAX_COST = 0.5
+
+# Distillation (distillation.py): the trained model's logits on TEACHER_VIEWS seeded augmented
+# copies of the training set are cached in TEACHER_LOGIT_DIR once, then each student in
+# DISTILL_STUDENTS ('dccn', 'mobilenet_v3_small', 'mobilenet_v3_large') trains on them and is
+# compared with the teacher (accuracy, CPU latency, size). Empty: no distillation
+DISTILL_STUDENTS = []
+TEACHER_VIEWS = 4
+DISTILL_EPOCHS = 10
+TEACHER_LOGIT_DIR = '/content/drive/MyDrive/teacher_logits'
+
+# Run the EfficientNet and Swin branches concurrently, each in its own thread with a share
+# of the CPU threads (hybrid_network.py). CONCURRENCY_BENCHMARK prints sequential vs
+# concurrent latency at batch sizes 1, 8 and 32 before training
+CONCURRENT_BRANCHES = False
+CONCURRENCY_BENCHMARK = False
+
 from torchvision import datasets, transforms
 from torch.utils.data import DataLoader
 
@@ -34,80 +109,41 @@ from torch.utils.data import DataLoader
 train_dir = '/content/drive/MyDrive/data/train'
 val_dir = '/content/drive/MyDrive/data/test'
 
-# Define image transformations
+# Define image transformations (the decoded image cache already resizes to 224x224).
+# They run on whole uint8 batches on the training device, after collation.
 image_transforms = {
-    'train': transforms.Compose([
-        transforms.Resize((224, 224)),  # Resize images for EfficientNet and Swin
-        transforms.RandomHorizontalFlip(),  # Data augmentation
-        transforms.RandomRotation(10),     # Data augmentation
-        transforms.ToTensor(),             # Convert to Tensor
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])  # Normalize
-    ]),
-    'val': transforms.Compose([
-        transforms.Resize((224, 224)),  # Resize images
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-    ])
+    'train': BatchAugment(hflip=True, rotation=10),  # Data augmentation, then ImageNet normalization
+    'val': BatchAugment()                            # Convert to float and normalize only
 }
 
-# Load datasets
-train_dataset = datasets.ImageFolder(root=train_dir, transform=image_transforms['train'])
-val_dataset = datasets.ImageFolder(root=val_dir, transform=image_transforms['val'])
+# Load datasets (raw uint8 images, augmentation happens per batch)
+train_dataset = CachedImageFolder(root=train_dir, size=224, as_pil=False)
+val_dataset = CachedImageFolder(root=val_dir, size=224, as_pil=False)
 
 # DataLoaders
 batch_size = 32
-train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False)
+train_loader = make_loader(train_dataset, batch_size=batch_size, shuffle=True, name='train')
+val_loader = make_loader(val_dataset, batch_size=batch_size, shuffle=False, name='val')
 
 # Print dataset sizes
 print(f"Training samples: {len(train_dataset)}")
 print(f"Validation samples: {len(val_dataset)}")
 
-class HybridSkinCancerModel(nn.Module):
-    def __init__(self, efficientnet, swin_transformer, num_classes):
-        super(HybridSkinCancerModel, self).__init__()
-        self.efficientnet = efficientnet
-        self.swin_transformer = swin_transformer
-
-        # Swin Transformer output adjustment
-        self.swin_fc = nn.Linear(7 * 7 * 768, 768)  # Flatten and reduce Swin Transformer output
-
-        # Fully connected layer for combined features
-        self.fc = nn.Linear(1280 + 768, num_classes)  # Adjust dimensions accordingly
-
-    def forward(self, x):
-        # EfficientNet features
-        eff_features = self.efficientnet(x)  # Shape: (batch_size, 1280, 1, 1)
-        eff_features = eff_features.view(eff_features.size(0), -1)  # Flatten: (batch_size, 1280)
-
-        # Swin Transformer features
-        swin_features = self.swin_transformer(x)  # Shape: (batch_size, 768, 7, 7)
-        swin_features = swin_features.view(swin_features.size(0), -1)  # Flatten: (batch_size, 768 * 7 * 7)
-        swin_features = self.swin_fc(swin_features)  # Reduce: (batch_size, 768)
-
-        # Concatenate features
-        combined_features = torch.cat((eff_features, swin_features), dim=1)  # Shape: (batch_size, 1280 + 768)
-
-        # Fully connected layer
-        out = self.fc(combined_features)  # Shape: (batch_size, num_classes)
-        return out
+# The network (HybridSkinCancerModel) is defined in hybrid_network.py
 
 # Define image transformations
-image_transforms = transforms.Compose([
-    transforms.Resize((224, 224)),  # Resize images to 224x224 for both models
-    transforms.ToTensor(),          # Convert images to tensors
-    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])  # Normalize based on ImageNet
-])
+batch_transform = BatchAugment()  # Convert uint8 batches to tensors and normalize based on ImageNet
 
-# Load the dataset
-train_dataset = datasets.ImageFolder(root='/content/drive/MyDrive/data/train', transform=image_transforms)
+# Load the dataset (already 224x224 from the cache)
+train_dataset = CachedImageFolder(root='/content/drive/MyDrive/data/train', size=224, as_pil=False)
 
 # DataLoader
-train_loader = DataLoader(train_dataset, batch_size=32, shuffle=True)
+train_loader = make_loader(train_dataset, batch_size=32, shuffle=True, name='train')
 
 # Instantiate the hybrid model
 num_classes = 2  # Example: benign and malignant
-hybrid_model = HybridSkinCancerModel(efficientnet_feature_extractor, swin_feature_extractor, num_classes)
+hybrid_model = HybridSkinCancerModel(efficientnet_feature_extractor, swin_feature_extractor, num_classes,
+                                     fusion=FUSION, rank=FUSION_RANK)
 
 # Loss function and optimizer
 criterion = nn.CrossEntropyLoss()
@@ -116,82 +152,99 @@ optimizer = torch.optim.Adam(hybrid_model.parameters(), lr=0.001)
 # Training setup
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 hybrid_model.to(device)
+batch_transform.to(device)
+image_transforms['val'].to(device)
+
+if MEMORY_REPORT:
+    memory_report(hybrid_model, batch_sizes=(16, 32, 64, 128), device=device, precision=PRECISION)
+if ACTIVATION_CHECKPOINT_SWIN or ACTIVATION_CHECKPOINT_EFFICIENTNET:
+    enable_activation_checkpointing(hybrid_model, swin=ACTIVATION_CHECKPOINT_SWIN,
+                                    efficientnet=ACTIVATION_CHECKPOINT_EFFICIENTNET)
+if CONCURRENCY_BENCHMARK:
+    benchmark_concurrency(hybrid_model, batch_sizes=(1, 8, 32), precision=PRECISION)
+    benchmark_concurrency(hybrid_model, batch_sizes=(8, 32), precision=PRECISION, train=True)
+hybrid_model.set_concurrent(CONCURRENT_BRANCHES)
+
+# Train only the fusion head (swin_fc + fc) on cached backbone features (see embedding_cache.py).
+# The backbones run once per image; the cache is rebuilt when their weights change.
+HEAD_ONLY = False
+EMBEDDING_DIR = '/content/drive/MyDrive/embeddings'
 
 # Training loop
 epochs = 10
-for epoch in range(epochs):
-    hybrid_model.train()
-    running_loss = 0.0
-    for images, labels in train_loader:
-        images, labels = images.to(device), labels.to(device)
-
-        # Zero gradients
-        optimizer.zero_grad()
-
-        # Forward pass
-        outputs = hybrid_model(images)
-        loss = criterion(outputs, labels)
-
-        # Backward pass and optimization
-        loss.backward()
-        optimizer.step()
-
-        running_loss += loss.item()
-
-    # Log the epoch's average loss
-    print(f"Epoch [{epoch + 1}/{epochs}], Loss: {running_loss / len(train_loader):.4f}")
-
-# Save the trained model
+if HEAD_ONLY:
+    hybrid_model.eval()  # Backbones in inference mode while extracting
+    embedding_cache = EmbeddingCache(EMBEDDING_DIR, 'hybrid',
+                                     {'efficientnet': efficientnet_feature_extractor, 'swin': swin_feature_extractor},
+                                     extra='224-imagenet-norm')
+    keys = train_dataset.keys  # Image content hashes, in cache order
+    embedding_cache.extract(train_dataset, keys, hybrid_model.extract_features, device, transform=batch_transform)
+
+    head_loader = make_loader(embedding_cache.dataset(keys, train_dataset.targets), batch_size=32, shuffle=True,
+                              name='train-head')
+    head_optimizer = torch.optim.Adam(list(hybrid_model.swin_fc.parameters()) + list(hybrid_model.fc.parameters()),
+                                      lr=0.001)
+    head_losses = train_head(hybrid_model.head, head_loader, criterion, head_optimizer, device, epochs)
+else:
+    # Shared loop (training_engine.py): autocast, gradient accumulation, throughput report
+    checkpoints = CheckpointManager(CHECKPOINT_DIR, every_steps=CHECKPOINT_EVERY_STEPS)
+    unfreezer = GradualUnfreezer(hybrid_model, optimizer, UNFREEZE_BLOCKS, UNFREEZE_AT) if UNFREEZE_AT else None
+    trainer = Trainer(hybrid_model, optimizer, criterion, device, precision=PRECISION,
+                      effective_batch_size=EFFECTIVE_BATCH_SIZE, compile=COMPILE_MODEL,
+                      batch_transform=batch_transform, checkpoint=checkpoints, unfreezer=unfreezer)
+    for epoch in range(trainer.resume(), epochs):
+        train = trainer.train_epoch(train_loader)
+
+        # Log the epoch's average loss
+        print(f"Epoch [{epoch + 1}/{epochs}], Loss: {train['loss']:.4f}")
+        trainer.save_checkpoint()
+    checkpoints.close()
+    if unfreezer is not None:
+        unfreezer.report()  # Step time and gradient + optimizer memory per phase
+
+# Save the trained model (serialized once, then copied to Drive)
 torch.save(hybrid_model.state_dict(), "hybrid_skin_cancer_model.pth")
-
-torch.save(hybrid_model.state_dict(), '/content/drive/MyDrive/hybrid_skin_cancer_model.pth')
+shutil.copyfile("hybrid_skin_cancer_model.pth", '/content/drive/MyDrive/hybrid_skin_cancer_model.pth')
 
 from sklearn.metrics import confusion_matrix, classification_report, ConfusionMatrixDisplay
 import numpy as np
 import matplotlib.pyplot as plt
 
-# Initialize placeholders for evaluation
-all_labels = []
-all_preds = []
+# Running confusion matrix on the device, all metrics are derived from it
+metrics = ConfusionMatrix(num_classes, device)
 
 # Validation Phase (with metrics collection)
 hybrid_model.eval()
-val_loss = 0.0
-correct = 0
-total = 0
+val_loss = torch.zeros((), device=device)
 
 with torch.no_grad():
     for images, labels in val_loader:
-        images, labels = images.to(device), labels.to(device)
+        images, labels = image_transforms['val'](images.to(device)), labels.to(device)
         outputs = hybrid_model(images)
         loss = criterion(outputs, labels)
-        val_loss += loss.item()
+        val_loss += loss  # Read back once, after the loop
 
         # Predictions and ground truth
         _, predicted = torch.max(outputs, 1)
-        total += labels.size(0)
-        correct += (predicted == labels).sum().item()
+        metrics.update(predicted, labels)
 
-        # Store labels for metrics
-        all_labels.extend(labels.cpu().numpy())
-        all_preds.extend(predicted.cpu().numpy())
+val_loss = val_loss.item()
 
 # Calculate accuracy
-accuracy = 100 * correct / total
+accuracy = 100 * metrics.accuracy()
 print(f"Validation Accuracy: {accuracy:.2f}%")
 
 # Calculate F1 score
-from sklearn.metrics import f1_score
-f1 = f1_score(all_labels, all_preds, average='weighted')
+f1 = metrics.f1('weighted')
 print(f"F1 Score: {f1:.4f}")
 
 # Confusion Matrix
-conf_matrix = confusion_matrix(all_labels, all_preds)
+conf_matrix = metrics.matrix
 print("Confusion Matrix:")
 print(conf_matrix)
 
 # Classification Report
-class_report = classification_report(all_labels, all_preds, target_names=train_dataset.classes)
+class_report = metrics.report(train_dataset.classes)
 print("Classification Report:")
 print(class_report)
 
@@ -210,6 +263,47 @@ with open('/content/drive/MyDrive/metrics.txt', 'w') as f:
     f.write("\nClassification Report:\n")
     f.write(class_report)
 
+if EARLY_EXIT:
+    exit_head = make_exit_head(num_classes).to(device)
+    exit_optimizer = torch.optim.Adam(exit_head.parameters(), lr=0.001)
+    train_exit_head(hybrid_model, exit_head, train_loader, criterion, exit_optimizer, device, EXIT_EPOCHS,
+                    transform=batch_transform)
+    cascade = EarlyExitCascade(hybrid_model, exit_head)
+    exit_curve, exit_choice = calibrate(cascade, val_loader, device, transform=image_transforms['val'],
+                                        max_cost=EXIT_MAX_COST)
+    torch.save(cascade.state_dict(), "hybrid_early_exit.pth")  # Model, exit head and threshold
+    shutil.copyfile("hybrid_early_exit.pth", '/content/drive/MyDrive/hybrid_early_exit.pth')
+
+if DISTILL_STUDENTS:
+    # The views are augmented (flips, rotation); batch_transform only normalizes
+    teacher_logits = TeacherLogits(TEACHER_LOGIT_DIR, hybrid_model, train_dataset, image_transforms['train'].to(device),
+                                   device, views=TEACHER_VIEWS, keys=train_dataset.keys)
+    students = {}
+    for kind in DISTILL_STUDENTS:
+        student = build_student(kind, num_classes).to(device)
+        distill(student, teacher_logits, torch.optim.Adam(student.parameters(), lr=0.001), device, DISTILL_EPOCHS)
+        torch.save(student.state_dict(), f"student_{kind}.pth")
+        shutil.copyfile(f"student_{kind}.pth", f'/content/drive/MyDrive/student_{kind}.pth')
+        students[kind] = student
+    compare(dict({'hybrid (teacher)': hybrid_model}, **students), val_loader, device,
+            transform=image_transforms['val'])
+
+# "Similar past cases" index over the pooled backbone features, and a kNN baseline (see retrieval_index.py)
+BUILD_RETRIEVAL_INDEX = False
+if BUILD_RETRIEVAL_INDEX:
+    hybrid_model.eval()
+    # EfficientNet's map is (B, 1280, 1, 1), Swin's (B, 7, 7, 768)
+    embed_fn = pooled_features(hybrid_model.extract_features, ('channels_first', 'channels_last'), dim=1280 + 768)
+    retrieval_index = RetrievalIndex(nprobe=8)
+    retrieval_index.add(embed(train_dataset, embed_fn, device, transform=batch_transform), train_dataset.targets,
+                        ids=[path for path, _ in train_dataset.samples])
+    retrieval_index.save('/content/drive/MyDrive/retrieval_hybrid.npz')
+
+    val_vectors = embed(val_dataset, embed_fn, device, transform=image_transforms['val'])
+    knn_preds = retrieval_index.knn_predict(val_vectors, k=5)
+    print(f"kNN (k=5) Validation Accuracy: {100 * np.mean(knn_preds == np.array(val_dataset.targets)):.2f}%")
+    benchmark(retrieval_index, retrieval_index.vectors, val_vectors[:200], k=5)
+
 # Example lists to track loss
 train_losses = []  # Populate with running_loss / len(train_loader) from each epoch
 val_losses = []    # Populate with val_loss / len(val_loader) from each epoch
@@ -0,0 +1,343 @@
+"""The EfficientNet-B0 + Swin-Tiny hybrid classifier of hybrid_model.py.
+
+hybrid_model.py is a notebook export that trains as soon as it is imported,
+so the network lives here for the code that needs to build it elsewhere
+(e.g. co_training.py):
+
+    efficientnet, swin = feature_extractors(pretrained=True)
+    model = HybridSkinCancerModel(efficientnet, swin, num_classes=2)
+
+``fusion`` picks how the 7x7x768 Swin feature map is reduced to 768 before
+it is concatenated with EfficientNet's 1280 features:
+
+    'flatten'    Linear(7 * 7 * 768, 768), the original (28.9M parameters)
+    'pool'       mean over the 49 tokens, Linear(768, 768) (0.59M)
+    'attention'  learned softmax weights over the tokens, Linear(768, 768) (0.59M)
+    'low_rank'   Linear(7 * 7 * 768, rank) then Linear(rank, 768) (2.5M at rank 64)
+
+``fusion_report`` compares their parameters, training memory and latency;
+``compact_state_dict`` turns a 'flatten' state dict into one of the compact
+heads: exactly for 'low_rank' up to the truncated SVD, and for the pooling
+heads with the weight that is exact when all tokens are equal (fine-tune the
+head afterwards, e.g. HEAD_ONLY in hybrid_model.py):
+
+    python hybrid_network.py convert best.pt compact.pt --fusion low_rank --rank 64
+    python hybrid_network.py fusion
+
+The two backbones are independent until their features are concatenated.
+``model.set_concurrent(True)`` runs them at the same time, each in its own
+worker thread with its own share of the intra-op threads (by default a
+quarter for EfficientNet, which costs about a tenth of Swin-Tiny's FLOPs),
+instead of one after the other with all threads. Grad mode, inference mode
+and autocast are carried into the workers, so it works for training as well
+as inference; backward still runs on the calling thread, with all of its
+threads. Stochastic depth draws from the one global generator in whichever
+order the threads reach it, so training is not bitwise reproducible with a
+seed (eval-mode outputs and gradients are identical). On a GPU both threads
+share the default stream, so the gain there is mostly on CPU.
+``benchmark_concurrency`` compares both modes:
+
+    python hybrid_network.py concurrency --batch-sizes 1 8 32
+"""
+
+import argparse
+import contextlib
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import timm
+import torch
+import torch.nn as nn
+from torchvision.models import efficientnet_b0
+
+
+def feature_extractors(pretrained=True):
+    """EfficientNet-B0 and Swin-Tiny without their classification heads."""
+    efficientnet = efficientnet_b0(pretrained=pretrained)
+    efficientnet_feature_extractor = nn.Sequential(*list(efficientnet.children())[:-1])  # Remove the classification head
+
+    swin_transformer = timm.create_model('swin_tiny_patch4_window7_224', pretrained=pretrained)
+    swin_feature_extractor = nn.Sequential(*list(swin_transformer.children())[:-1])  # Remove the classification head
+    return efficientnet_feature_extractor, swin_feature_extractor
+
+
+def default_split(threads=None, efficientnet_share=0.25):
+    """``(efficientnet_threads, swin_threads)`` out of ``threads`` (default: all)."""
+    threads = threads or torch.get_num_threads()
+    efficientnet_threads = max(1, round(threads * efficientnet_share))
+    return efficientnet_threads, max(1, threads - efficientnet_threads)
+
+
+@functools.lru_cache(maxsize=None)
+def _branch_executor(slot, threads):
+    # One persistent thread per (branch, thread count); torch.set_num_threads is per thread for OpenMP
+    own_threads = torch.get_num_threads()
+    executor = ThreadPoolExecutor(1, thread_name_prefix=f'hybrid-{slot}', initializer=torch.set_num_threads,
+                                  initargs=(threads,))
+    executor.submit(lambda: None).result()
+    torch.set_num_threads(own_threads)  # Pins the caller's own count, which otherwise follows the last set
+    return executor
+
+
+def _run_in_state(module, x, grad, inference, autocast_dtype):
+    # Grad mode, inference mode and autocast are thread-local; the caller's apply here too
+    autocast = (torch.autocast(x.device.type, dtype=autocast_dtype) if autocast_dtype is not None
+                else contextlib.nullcontext())
+    with torch.inference_mode(inference), torch.set_grad_enabled(grad), autocast:
+        return module(x)
+
+
+FUSIONS = ('flatten', 'pool', 'attention', 'low_rank')
+
+
+class TokenPooling(nn.Module):
+    """Mean of the tokens, or with ``attention`` a softmax-weighted mean with
+    one learned score per token, followed by ``Linear(channels, out_features)``."""
+
+    def __init__(self, channels, out_features, attention=False):
+        super(TokenPooling, self).__init__()
+        self.score = nn.Linear(channels, 1) if attention else None
+        if self.score is not None:
+            # Uniform weights at first, so a converted head starts out as the plain mean
+            nn.init.zeros_(self.score.weight)
+            nn.init.zeros_(self.score.bias)
+        self.proj = nn.Linear(channels, out_features)
+
+    def forward(self, tokens):  # (batch_size, tokens, channels)
+        if self.score is None:
+            pooled = tokens.mean(dim=1)
+        else:
+            weights = torch.softmax(self.score(tokens), dim=1)  # (batch_size, tokens, 1)
+            pooled = (weights * tokens).sum(dim=1)
+        return self.proj(pooled)
+
+
+class LowRankLinear(nn.Module):
+    """``Linear(in_features, out_features)`` factorized through ``rank``."""
+
+    def __init__(self, in_features, out_features, rank):
+        super(LowRankLinear, self).__init__()
+        self.reduce = nn.Linear(in_features, rank, bias=False)
+        self.expand = nn.Linear(rank, out_features)
+
+    def forward(self, x):
+        return self.expand(self.reduce(x))
+
+
+def fusion_layer(fusion, tokens=7 * 7, channels=768, out_features=768, rank=64):
+    if fusion == 'flatten':
+        return nn.Linear(tokens * channels, out_features)
+    if fusion in ('pool', 'attention'):
+        return TokenPooling(channels, out_features, attention=fusion == 'attention')
+    if fusion == 'low_rank':
+        return LowRankLinear(tokens * channels, out_features, rank)
+    raise ValueError(f'fusion must be one of {FUSIONS}, got {fusion!r}')
+
+
+class HybridSkinCancerModel(nn.Module):
+    def __init__(self, efficientnet, swin_transformer, num_classes, fusion='flatten', rank=64):
+        super(HybridSkinCancerModel, self).__init__()
+        self.efficientnet = efficientnet
+        self.swin_transformer = swin_transformer
+        self.concurrent_threads = None  # (efficientnet, swin) intra-op threads when the branches run concurrently
+        self.fusion = fusion
+
+        # Swin Transformer output adjustment: reduce the 7x7x768 feature map to 768
+        self.swin_fc = fusion_layer(fusion, rank=rank)
+
+        # Fully connected layer for combined features
+        self.fc = nn.Linear(1280 + 768, num_classes)  # Adjust dimensions accordingly
+
+    def set_concurrent(self, enabled=True, threads=None):
+        """Runs the two backbones concurrently; ``threads`` is the
+        ``(efficientnet, swin)`` split, by default ``default_split()``."""
+        self.concurrent_threads = tuple(threads or default_split()) if enabled else None
+        return self
+
+    def extract_features(self, x):
+        # Backbone outputs, the part that embedding_cache.py stores
+        if self.concurrent_threads is not None:
+            return self._extract_concurrently(x)
+        eff_features = self.efficientnet(x)  # Shape: (batch_size, 1280, 1, 1)
+        swin_features = self.swin_transformer(x)  # Shape: (batch_size, 7, 7, 768)
+        return eff_features, swin_features
+
+    def _extract_concurrently(self, x):
+        device_type = x.device.type
+        autocast_dtype = torch.get_autocast_dtype(device_type) if torch.is_autocast_enabled(device_type) else None
+        state = (torch.is_grad_enabled(), torch.is_inference_mode_enabled(), autocast_dtype)
+        futures = [_branch_executor(slot, threads).submit(_run_in_state, module, x, *state)
+                   for slot, module, threads in zip(('efficientnet', 'swin'), (self.efficientnet, self.swin_transformer),
+                                                    self.concurrent_threads)]
+        return tuple(future.result() for future in futures)
+
+    def head(self, eff_features, swin_features):
+        # EfficientNet features
+        eff_features = eff_features.reshape(eff_features.size(0), -1)  # Flatten: (batch_size, 1280)
+
+        # Swin Transformer features
+        if self.fusion in ('pool', 'attention'):
+            # Tokens: (batch_size, 49, 768)
+            swin_features = swin_features.reshape(swin_features.size(0), -1, swin_features.size(-1))
+        else:
+            swin_features = swin_features.reshape(swin_features.size(0), -1)  # Flatten: (batch_size, 7 * 7 * 768)
+        swin_features = self.swin_fc(swin_features)  # Reduce: (batch_size, 768)
+
+        # Concatenate features
+        combined_features = torch.cat((eff_features, swin_features), dim=1)  # Shape: (batch_size, 1280 + 768)
+
+        # Fully connected layer
+        out = self.fc(combined_features)  # Shape: (batch_size, num_classes)
+        return out
+
+    def forward(self, x):
+        return self.head(*self.extract_features(x))
+
+
+def compact_state_dict(state_dict, fusion, rank=64, channels=768):
+    """A copy of a 'flatten' model's ``state_dict`` with ``swin_fc`` replaced
+    by the ``fusion`` head. 'low_rank' keeps the best rank-``rank``
+    approximation of the weight (truncated SVD); 'pool' and 'attention' sum
+    the weight over the 49 token positions, which gives the same output when
+    all tokens are equal."""
+    if fusion == 'flatten':
+        return dict(state_dict)
+    weight, bias = state_dict['swin_fc.weight'].float(), state_dict['swin_fc.bias']
+    converted = {key: value for key, value in state_dict.items() if not key.startswith('swin_fc.')}
+    if fusion in ('pool', 'attention'):
+        # Flatten order is (position, channel), the features being channels-last
+        per_position = weight.reshape(weight.size(0), -1, channels)
+        converted['swin_fc.proj.weight'] = per_position.sum(dim=1).to(bias.dtype)
+        converted['swin_fc.proj.bias'] = bias.clone()
+        if fusion == 'attention':
+            converted['swin_fc.score.weight'] = torch.zeros(1, channels, dtype=bias.dtype)
+            converted['swin_fc.score.bias'] = torch.zeros(1, dtype=bias.dtype)
+        return converted
+    if fusion == 'low_rank':
+        u, singular, vh = torch.linalg.svd(weight, full_matrices=False)
+        root = singular[:rank].sqrt()
+        converted['swin_fc.reduce.weight'] = (root[:, None] * vh[:rank]).to(bias.dtype)
+        converted['swin_fc.expand.weight'] = (u[:, :rank] * root).to(bias.dtype)
+        converted['swin_fc.expand.bias'] = bias.clone()
+        kept = singular[:rank].square().sum() / singular.square().sum()
+        print(f'[fusion] rank {rank} keeps {kept.item():.1%} of the swin_fc weight energy')
+        return converted
+    raise ValueError(f'fusion must be one of {FUSIONS}, got {fusion!r}')
+
+
+def convert_checkpoint(source, destination, fusion, rank=64):
+    """Writes the model weights of ``source`` (a state dict or a Trainer
+    checkpoint) with a compact ``fusion`` head as a plain state dict. The
+    optimizer state is not carried over: its swin_fc moments have the old shape."""
+    state = torch.load(source, map_location='cpu', weights_only=False)
+    state_dict = state['model'] if 'model' in state else state
+    converted = compact_state_dict(state_dict, fusion, rank)
+    torch.save(converted, destination)
+    size = lambda weights: sum(v.numel() * v.element_size() for v in weights.values()) / 2 ** 20
+    print(f'[fusion] {source} ({size(state_dict):.0f} MB) -> {destination} ({size(converted):.0f} MB), '
+          f'load with HybridSkinCancerModel(..., fusion={fusion!r}, rank={rank})')
+    return converted
+
+
+def fusion_report(num_classes=2, rank=64, batch_size=32, repeats=20, device='cpu'):
+    """Parameters, fp32 training memory (weights, gradients and Adam's two
+    moments) and latency of the fusion head (swin_fc + fc) for every fusion.
+    The backbones are the same for all of them and are left out."""
+    print(f'{"fusion":>9} {"swin_fc":>11} {"head":>11} {"weights MB":>10} {"train MB":>9} '
+          f'{"infer ms":>9} {"train ms":>9}   (batch {batch_size})')
+    rows = []
+    for fusion in FUSIONS:
+        model = HybridSkinCancerModel(nn.Identity(), nn.Identity(), num_classes, fusion=fusion, rank=rank).to(device)
+        eff_features = torch.randn(batch_size, 1280, 1, 1, device=device)
+        swin_features = torch.randn(batch_size, 7, 7, 768, device=device)
+
+        def infer():
+            with torch.inference_mode():
+                model.head(eff_features, swin_features)
+
+        def train_step():
+            model.head(eff_features, swin_features).sum().backward()
+            model.zero_grad(set_to_none=True)
+
+        swin_fc = sum(p.numel() for p in model.swin_fc.parameters())
+        head = sum(p.numel() for p in model.parameters())
+        row = {'fusion': fusion, 'swin_fc_params': swin_fc, 'head_params': head,
+               'weights_mb': 4 * head / 2 ** 20, 'train_mb': 4 * 4 * head / 2 ** 20,
+               'infer_ms': _time(infer, repeats), 'train_ms': _time(train_step, repeats)}
+        rows.append(row)
+        print(f'{fusion:>9} {swin_fc:>11,} {head:>11,} {row["weights_mb"]:>10.1f} {row["train_mb"]:>9.1f} '
+              f'{row["infer_ms"]:>9.2f} {row["train_ms"]:>9.2f}')
+    return rows
+
+
+def _time(fn, repeats):
+    fn()  # Warm-up: oneDNN kernel selection, allocator, worker start-up
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return 1000 * times[len(times) // 2]  # Median, in ms
+
+
+def benchmark_concurrency(model, batch_sizes=(1, 8, 32), repeats=10, threads=None, precision='fp32', train=False, size=224):
+    """Median latency of a forward pass (``train=True``: forward, backward and
+    no optimizer step) at each batch size, sequential vs concurrent
+    branches. Returns the rows it prints."""
+    dtype = {'fp32': None, 'bf16': torch.bfloat16}[precision]
+    device = next(model.parameters()).device
+    previous = model.concurrent_threads
+    model.train(train)
+    rows = []
+    print(f'{"batch":>5} {"sequential ms":>14} {"concurrent ms":>14} {"speedup":>8}   '
+          f'threads {torch.get_num_threads()} -> {tuple(threads or default_split())}')
+    for batch_size in batch_sizes:
+        x = torch.randn(batch_size, 3, size, size, device=device)
+
+        def step():
+            with torch.autocast(device.type, dtype=dtype or torch.float32, enabled=dtype is not None):
+                if not train:
+                    with torch.inference_mode():
+                        return model(x)
+                outputs = model(x)
+            outputs.float().sum().backward()
+            model.zero_grad(set_to_none=True)
+
+        latencies = []
+        for concurrent in (False, True):
+            model.set_concurrent(concurrent, threads)
+            latencies.append(_time(step, repeats))
+        rows.append({'batch_size': batch_size, 'sequential_ms': latencies[0], 'concurrent_ms': latencies[1]})
+        print(f'{batch_size:>5} {latencies[0]:>14.1f} {latencies[1]:>14.1f} {latencies[0] / latencies[1]:>7.2f}x')
+    model.concurrent_threads = previous
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks and checkpoint conversion for the hybrid model')
+    commands = parser.add_subparsers(dest='command', required=True)
+    concurrency = commands.add_parser('concurrency', help='sequential vs concurrent backbones')
+    concurrency.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32])
+    concurrency.add_argument('--repeats', type=int, default=10)
+    concurrency.add_argument('--threads', type=int, nargs=2, default=None, metavar=('EFFICIENTNET', 'SWIN'))
+    concurrency.add_argument('--precision', default='fp32', choices=('fp32', 'bf16'))
+    concurrency.add_argument('--train', action='store_true', help='forward + backward instead of inference')
+    fusion = commands.add_parser('fusion', help='parameters, memory and latency of the fusion heads')
+    fusion.add_argument('--rank', type=int, default=64)
+    fusion.add_argument('--batch-size', type=int, default=32)
+    convert = commands.add_parser('convert', help="replace a checkpoint's flatten head by a compact one")
+    convert.add_argument('source')
+    convert.add_argument('destination')
+    convert.add_argument('--fusion', default='low_rank', choices=FUSIONS[1:])
+    convert.add_argument('--rank', type=int, default=64)
+    args = parser.parse_args()
+
+    if args.command == 'concurrency':
+        model = HybridSkinCancerModel(*feature_extractors(pretrained=False), num_classes=2)
+        benchmark_concurrency(model, args.batch_sizes, args.repeats, args.threads, args.precision, args.train)
+    elif args.command == 'fusion':
+        fusion_report(rank=args.rank, batch_size=args.batch_size)
+    else:
+        convert_checkpoint(args.source, args.destination, args.fusion, args.rank)
@@ -0,0 +1,246 @@
+"""Hyperparameter search with successive halving over a local process pool.
+
+Every configuration drawn from a search space is first trained for a few
+epochs; only the best ``1/eta`` of them are trained further, and so on until
+the survivors reach ``max_epochs``:
+
+    space = {'learning_rate': LogUniform(1e-5, 1e-2), 'dense_units': Choice([128, 256, 512])}
+    best = successive_halving(train_dccn, space, '/content/drive/MyDrive/search.db', 'dccn',
+                              n_trials=27, min_epochs=1, max_epochs=9, eta=3,
+                              fixed={'train_dir': train_dir})
+    best['config'], best['score']
+
+``objective(config, epochs, workdir)`` trains ``config`` (the sampled values
+plus ``fixed``) up to ``epochs`` epochs in total and returns the validation
+score. ``workdir`` is private to the trial and kept between rungs, so an
+objective that saves its model there continues training instead of starting
+over. Trials run in ``spawn``-ed worker processes (the objective must be a
+module-level function), ``workers`` at a time with ``threads_per_trial``
+threads each, by default as many as the cores allow.
+
+Configurations and every finished (trial, rung) result are stored in SQLite.
+Running the same study again reuses them and only trains what is missing, so
+an interrupted search resumes where it stopped. With 27 trials, eta=3 and
+1 -> 3 -> 9 epochs the search costs 27 + 9 * 2 + 3 * 6 = 63 epochs instead
+of the 243 needed to train every configuration to 9 epochs.
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+
+class Choice:
+    def __init__(self, values):
+        self.values = list(values)
+
+    def sample(self, rng):
+        return self.values[rng.integers(len(self.values))]
+
+    def __repr__(self):
+        return f'Choice({self.values!r})'
+
+
+class Uniform:
+    def __init__(self, low, high):
+        self.low, self.high = low, high
+
+    def sample(self, rng):
+        return float(rng.uniform(self.low, self.high))
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.low!r}, {self.high!r})'
+
+
+class LogUniform(Uniform):
+    """Uniform in log space, for learning rates and weight decays."""
+
+    def sample(self, rng):
+        return float(math.exp(rng.uniform(math.log(self.low), math.log(self.high))))
+
+
+class IntUniform(Uniform):
+    """Integer in ``[low, high]``, both ends included."""
+
+    def sample(self, rng):
+        return int(rng.integers(self.low, self.high + 1))
+
+
+def sample_config(space, rng):
+    # Through JSON, so fresh and resumed configs are identical (tuples become lists)
+    return json.loads(json.dumps({name: dist.sample(rng) for name, dist in space.items()}))
+
+
+def rung_schedule(n_trials, min_epochs, max_epochs, eta):
+    """``[(trials, epochs), ...]`` for each rung of successive halving."""
+    rungs, trials, epochs = [], n_trials, min_epochs
+    while True:
+        rungs.append((max(1, trials), min(epochs, max_epochs)))
+        if epochs >= max_epochs or trials <= 1:
+            return rungs
+        trials, epochs = trials // eta, epochs * eta
+
+
+class TrialStore:
+    """SQLite file with the studies, their sampled configs and the result of
+    every (trial, rung). Only the parent process writes to it."""
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS studies (name TEXT PRIMARY KEY, space TEXT, settings TEXT);
+            CREATE TABLE IF NOT EXISTS trials (study TEXT, trial INTEGER, config TEXT,
+                                               PRIMARY KEY (study, trial));
+            CREATE TABLE IF NOT EXISTS results (study TEXT, trial INTEGER, rung INTEGER, epochs INTEGER,
+                                                score REAL, seconds REAL, error TEXT,
+                                                PRIMARY KEY (study, trial, rung));
+        """)
+
+    def open_study(self, study, space, settings):
+        """Registers ``study``; an existing study must have the same space and settings."""
+        space, settings = json.dumps({k: repr(v) for k, v in sorted(space.items())}), json.dumps(settings)
+        row = self.db.execute('SELECT space, settings FROM studies WHERE name = ?', (study,)).fetchone()
+        if row is None:
+            with self.db:
+                self.db.execute('INSERT INTO studies VALUES (?, ?, ?)', (study, space, settings))
+        elif row != (space, settings):
+            raise ValueError(f'study {study!r} in {self.path} was run with a different space or settings')
+
+    def configs(self, study):
+        rows = self.db.execute('SELECT trial, config FROM trials WHERE study = ? ORDER BY trial', (study,))
+        return {trial: json.loads(config) for trial, config in rows}
+
+    def add_config(self, study, trial, config):
+        with self.db:
+            self.db.execute('INSERT INTO trials VALUES (?, ?, ?)', (study, trial, json.dumps(config)))
+
+    def results(self, study, rung):
+        """``{trial: score}`` of a rung; failed trials have score None."""
+        rows = self.db.execute('SELECT trial, score FROM results WHERE study = ? AND rung = ?', (study, rung))
+        return dict(rows.fetchall())
+
+    def add_result(self, study, trial, rung, epochs, score, seconds, error=None):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (study, trial, rung, epochs, score, seconds, error))
+
+    def leaderboard(self, study, mode='max'):
+        """Each trial's furthest rung, best first."""
+        rows = self.db.execute("""
+            SELECT r.trial, r.rung, r.epochs, r.score, r.seconds, t.config FROM results r
+            JOIN trials t ON t.study = r.study AND t.trial = r.trial
+            WHERE r.study = ? AND r.rung = (SELECT MAX(rung) FROM results WHERE study = r.study AND trial = r.trial)
+        """, (study,)).fetchall()
+        sign = -1 if mode == 'max' else 1
+        rows.sort(key=lambda row: (-row[1], row[3] is None, sign * (row[3] or 0)))
+        return [{'trial': trial, 'rung': rung, 'epochs': epochs, 'score': score, 'seconds': seconds,
+                 'config': json.loads(config)} for trial, rung, epochs, score, seconds, config in rows]
+
+    def close(self):
+        self.db.close()
+
+
+def _init_worker(threads):
+    # Runs before the objective's module (and its framework) is imported in the worker
+    for name in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS'):
+        os.environ[name] = str(threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    os.environ['TF_FORCE_GPU_ALLOW_GROWTH'] = 'true'  # Trials share the GPU instead of the first taking it all
+
+
+def _run_trial(objective, config, epochs, workdir):
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(int(os.environ.get('OMP_NUM_THREADS', 1)))
+    os.makedirs(workdir, exist_ok=True)
+    start = time.time()
+    try:
+        score = objective(config, epochs, workdir)
+        return float(score), time.time() - start, None
+    except Exception:
+        return None, time.time() - start, traceback.format_exc()
+
+
+def successive_halving(objective, space, store_path, study, n_trials=27, min_epochs=1, max_epochs=9, eta=3,
+                       mode='max', workers=None, threads_per_trial=None, fixed=None, workdir=None, seed=0):
+    """Runs (or resumes) ``study`` and returns the best entry of
+    ``TrialStore.leaderboard``: ``{'trial', 'config', 'score', 'epochs', ...}``."""
+    if mode not in ('max', 'min'):
+        raise ValueError(f"mode must be 'max' or 'min', got {mode!r}")
+    cores = os.cpu_count() or 1
+    threads_per_trial = threads_per_trial or max(1, cores // (workers or max(1, cores // 4)))
+    workers = workers or max(1, cores // threads_per_trial)
+    workdir = workdir or os.path.splitext(store_path)[0] + f'-{study}'
+    fixed = fixed or {}
+
+    store = TrialStore(store_path)
+    store.open_study(study, space, {'n_trials': n_trials, 'min_epochs': min_epochs, 'max_epochs': max_epochs,
+                                    'eta': eta, 'mode': mode, 'seed': seed})
+    configs = store.configs(study)
+    rng = np.random.default_rng(seed)
+    for trial in range(n_trials):
+        config = sample_config(space, rng)  # Drawn even when stored, to keep the sequence reproducible
+        if trial not in configs:
+            store.add_config(study, trial, config)
+            configs[trial] = config
+
+    rungs = rung_schedule(n_trials, min_epochs, max_epochs, eta)
+    print(f'[search] {study}: {n_trials} trials, rungs {rungs}, {workers} workers x {threads_per_trial} threads')
+    survivors, spent, previous = list(range(n_trials)), 0, 0
+    executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker, initargs=(threads_per_trial,))
+    try:
+        for rung, (_, epochs) in enumerate(rungs):
+            done = store.results(study, rung)
+            futures = {executor.submit(_run_trial, objective, dict(configs[trial], **fixed), epochs,
+                                       os.path.join(workdir, f'trial-{trial:04d}')): trial
+                       for trial in survivors if trial not in done}
+            for future in as_completed(futures):
+                trial = futures[future]
+                score, seconds, error = future.result()
+                store.add_result(study, trial, rung, epochs, score, seconds, error)
+                done[trial] = score
+                print(f'[search] rung {rung} ({epochs} epochs) trial {trial}: '
+                      + (f'{score:.4f} in {seconds:.0f}s' if error is None else f'failed\n{error}'))
+            spent += len(survivors) * (epochs - previous)
+            previous = epochs
+
+            scored = [trial for trial in survivors if done.get(trial) is not None]
+            scored.sort(key=lambda trial: done[trial], reverse=mode == 'max')
+            if rung + 1 < len(rungs):
+                survivors = scored[:rungs[rung + 1][0]]
+    finally:
+        executor.shutdown()
+
+    best = store.leaderboard(study, mode)
+    store.close()
+    print(f'[search] {study}: {spent} trial-epochs instead of {n_trials * max_epochs} for training every '
+          f'configuration to {max_epochs} epochs')
+    if not best or best[0]['score'] is None:
+        raise RuntimeError(f'every trial of {study!r} failed, see {store_path}')
+    print(f"[search] best trial {best[0]['trial']}: {best[0]['score']:.4f} {best[0]['config']}")
+    return best[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Leaderboard of a stored hyperparameter search')
+    parser.add_argument('store', help='SQLite file passed to successive_halving')
+    parser.add_argument('study')
+    parser.add_argument('--mode', default='max', choices=('max', 'min'))
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    for row in TrialStore(args.store).leaderboard(args.study, args.mode)[:args.top]:
+        score = 'failed' if row['score'] is None else f"{row['score']:.4f}"
+        print(f"trial {row['trial']:4d}  {row['epochs']:3d} epochs  {score:>8}  {row['config']}")
@@ -0,0 +1,186 @@
+"""Decoded image cache for the ImageFolder datasets.
+
+Every image under an ImageFolder-style root (``data/train/<class>/*.jpg``) is
+decoded once and resized to each requested square size. The pixels are stored
+as a uint8 NHWC memory-mapped array next to a JSON index holding the classes
+and per-sample labels, so later epochs never touch the JPEGs again.
+
+Build the cache once per data root:
+
+    python image_cache.py /content/drive/MyDrive/data --sizes 150 224
+
+The index also records the content hash of every sample and the
+fingerprint of the dataset manifest it was built from. When images are
+added, removed or replaced, the manifest changes and the cache is rebuilt,
+so ``CachedImageFolder.keys`` and ``split`` always describe the cached
+samples.
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+from torch.utils.data import Dataset
+
+from dataset_manifest import DatasetManifest, split_by_hash
+from image_loading import open_image
+
+
+def default_cache_dir(root):
+    # data/train -> data/cache/train
+    root = os.path.normpath(root)
+    return os.path.join(os.path.dirname(root), 'cache', os.path.basename(root))
+
+
+def _cache_paths(cache_dir, size):
+    return (os.path.join(cache_dir, f'images_{size}.u8'),
+            os.path.join(cache_dir, f'index_{size}.json'))
+
+
+def _index_fingerprint(cache_dir, size):
+    # Manifest fingerprint the index was built from, None if there is no index
+    index_path = _cache_paths(cache_dir, size)[1]
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as f:
+        return json.load(f).get('manifest')
+
+
+def _decode_resized(path, sizes):
+    # Decode once (at reduced JPEG resolution, still at least the largest
+    # size), then resize to every target size exactly like
+    # transforms.Resize((size, size)) does on a PIL image
+    image = open_image(path, max(sizes))
+    return [np.asarray(image.resize((size, size), Image.BILINEAR)) for size in sizes]
+
+
+def build_image_cache(root, sizes=(224,), cache_dir=None, num_workers=None, overwrite=False):
+    """Builds the sizes whose index is missing or was built from a different
+    version of the dataset (or all of them with ``overwrite``)."""
+    cache_dir = cache_dir or default_cache_dir(root)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Same class discovery and sample order as ImageFolder, from the manifest
+    folder = DatasetManifest(root)
+    fingerprint = folder.fingerprint()
+    sizes = [size for size in sizes if overwrite or _index_fingerprint(cache_dir, size) != fingerprint]
+    if not sizes:
+        return cache_dir
+
+    paths = [path for path, _ in folder.samples]
+    targets = [target for _, target in folder.samples]
+
+    arrays = {
+        size: np.memmap(_cache_paths(cache_dir, size)[0], dtype=np.uint8, mode='w+',
+                        shape=(len(paths), size, size, 3))
+        for size in sizes
+    }
+
+    def fill(i):
+        for size, pixels in zip(sizes, _decode_resized(paths[i], sizes)):
+            arrays[size][i] = pixels
+
+    # PIL releases the GIL while decoding and resizing, so threads scale
+    with ThreadPoolExecutor(max_workers=num_workers or os.cpu_count()) as pool:
+        list(pool.map(fill, range(len(paths))))
+
+    for size, array in arrays.items():
+        array.flush()
+        # The index is written last so a half-built cache is never picked up
+        with open(_cache_paths(cache_dir, size)[1], 'w') as f:
+            json.dump({
+                'root': os.path.abspath(root),
+                'size': size,
+                'classes': folder.classes,
+                'class_to_idx': folder.class_to_idx,
+                'paths': paths,
+                'targets': targets,
+                'sha1s': [entry['sha1'] for entry in folder.entries],
+                'manifest': fingerprint,
+            }, f)
+
+    return cache_dir
+
+
+class CachedImageFolder(Dataset):
+    """Drop-in replacement for ``datasets.ImageFolder(root, transform)`` that
+    serves pre-resized images from the memory-mapped cache.
+
+    The transform only needs the augmentation part of the chain, the
+    ``Resize((size, size))`` has already been applied. With ``as_pil=False``
+    samples are returned as zero-copy HWC uint8 views into the cache.
+    """
+
+    def __init__(self, root, size, transform=None, target_transform=None, cache_dir=None, as_pil=True):
+        self.root = root
+        self.size = size
+        self.transform = transform
+        self.target_transform = target_transform
+        self.as_pil = as_pil
+        self.cache_dir = cache_dir or default_cache_dir(root)
+
+        self.images_path, index_path = _cache_paths(self.cache_dir, size)
+        build_image_cache(root, (size,), self.cache_dir)  # Only if missing or stale
+
+        with open(index_path) as f:
+            index = json.load(f)
+
+        self.classes = index['classes']
+        self.class_to_idx = index['class_to_idx']
+        self.targets = index['targets']
+        self.samples = list(zip(index['paths'], self.targets))
+        self.imgs = self.samples
+        self.keys = index['sha1s']  # Content hash of each cached sample
+        self._images = None
+
+    @property
+    def images(self):
+        # Opened lazily so DataLoader workers map the file themselves instead
+        # of receiving a pickled copy of the whole array
+        if self._images is None:
+            self._images = np.memmap(self.images_path, dtype=np.uint8, mode='c',
+                                     shape=(len(self.samples), self.size, self.size, 3))
+        return self._images
+
+    def split(self, val_fraction, seed=0):
+        """``(train_indices, val_indices)`` by content hash, like ``DatasetManifest.split``."""
+        return split_by_hash(self.keys, val_fraction, seed)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        image = self.images[index]
+        target = self.targets[index]
+
+        if self.as_pil:
+            image = Image.fromarray(image)
+        if self.transform is not None:
+            image = self.transform(image)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+
+        return image, target
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the decoded image cache for data/train and data/test')
+    parser.add_argument('data_dir', help='directory holding the train/ and test/ ImageFolder roots')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[150, 224])
+    parser.add_argument('--splits', nargs='+', default=['train', 'test'])
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+
+    for split in args.splits:
+        cache_dir = build_image_cache(os.path.join(args.data_dir, split), args.sizes,
+                                      num_workers=args.workers, overwrite=args.overwrite)
+        print(f'{split}: cached {args.sizes} in {cache_dir}')
@@ -0,0 +1,112 @@
+"""Reduced-resolution JPEG decoding.
+
+Dermoscopy photos are often several megapixels, but every pipeline here
+shrinks them to 150x150 or 224x224 straight away. ``open_image`` asks libjpeg
+to do most of that shrink inside the DCT (``Image.draft``): the image is
+decoded at the smallest 1/2, 1/4 or 1/8 scale that is still at least the
+target size, so the full-resolution bitmap is never materialised, and the
+usual resize then finishes the job on a much smaller image. Other formats
+are decoded normally.
+
+The fast path is on by default. Set ``image_loading.FAST_DECODE = False`` (or
+``FAST_DECODE=0`` in the environment, which DataLoader workers inherit) to go
+back to full-resolution decoding.
+
+Compare both paths on a folder of images:
+
+    python image_loading.py /content/drive/MyDrive/data/train --size 224
+"""
+
+import argparse
+import functools
+import glob
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+from PIL import Image
+
+FAST_DECODE = os.environ.get('FAST_DECODE', '1') != '0'
+
+
+def _as_pil_size(size):
+    # An int means a square target, tuples are (width, height) like PIL
+    if isinstance(size, int):
+        return size, size
+    return tuple(size)
+
+
+def open_image(source, size=None, fast=None):
+    """Opens ``source`` (a path or file object) as an RGB PIL image.
+
+    With ``size`` and the fast path enabled, JPEGs come back already reduced
+    to the smallest DCT scale whose width and height are both at least the
+    target; callers still apply their own final resize.
+    """
+    fast = FAST_DECODE if fast is None else fast
+    image = Image.open(source)
+    if size is not None and fast:
+        image.draft('RGB', _as_pil_size(size))
+    return image.convert('RGB')
+
+
+def pil_loader(size):
+    """``loader=`` for ``datasets.ImageFolder`` whose transform resizes to ``size``."""
+    return functools.partial(open_image, size=size)
+
+
+def load_img(path, target_size=None, interpolation='nearest'):
+    """Same result as ``keras.preprocessing.image.load_img`` for RGB images,
+    decoding through the reduced-resolution path. ``target_size`` is
+    ``(height, width)`` as in Keras."""
+    size = None if target_size is None else (target_size[1], target_size[0])
+    image = open_image(path, size)
+    if size is not None and image.size != size:
+        resample = {'nearest': Image.NEAREST, 'bilinear': Image.BILINEAR, 'bicubic': Image.BICUBIC}[interpolation]
+        image = image.resize(size, resample)
+    return image
+
+
+def _peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Kilobytes on Linux
+
+
+def _measure_decode(paths, size, fast):
+    baseline = _peak_rss()
+    start = time.perf_counter()
+    for path in paths:
+        open_image(path, size, fast=fast).resize(_as_pil_size(size), Image.BILINEAR)
+    elapsed = time.perf_counter() - start
+    return len(paths) / elapsed, _peak_rss() - baseline
+
+
+def measure_decode(paths, size, fast):
+    """Decodes and resizes every path in a fresh process; returns images per
+    second and the peak memory in bytes that decoding added to the process.
+    PIL allocates its bitmaps outside the Python heap, so the peak is read
+    from the process's maximum resident set size."""
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(_measure_decode, (paths, size, fast))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare full and reduced-resolution JPEG decoding')
+    parser.add_argument('image_dir', help='directory searched recursively for .jpg/.jpeg files')
+    parser.add_argument('--size', type=int, nargs='+', default=[150, 224])
+    parser.add_argument('--limit', type=int, default=500)
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.image_dir, '**', '*.jp*g'), recursive=True))[:args.limit]
+    if not paths:
+        raise SystemExit(f'no JPEGs found under {args.image_dir}')
+
+    for size in args.size:
+        full_rate, full_peak = measure_decode(paths, size, fast=False)
+        fast_rate, fast_peak = measure_decode(paths, size, fast=True)
+        print(f'{size}x{size} over {len(paths)} images:')
+        print(f'  full decode:    {full_rate:8.1f} img/s, {full_peak / 2**20:6.2f} MiB peak memory')
+        print(f'  reduced decode: {fast_rate:8.1f} img/s, {fast_peak / 2**20:6.2f} MiB peak memory'
+              f' ({fast_rate / full_rate:.1f}x faster, {full_peak / max(fast_peak, 1):.1f}x less memory)')
@@ -0,0 +1,418 @@
+"""Local HTTP inference service with dynamic micro-batching.
+
+``predict_image`` in swim.py and the single-image block of vgg16.py run one
+image per forward pass, which leaves most of the CPU's matmul throughput
+unused. Here concurrent requests are queued and run together: the batching
+thread takes the first waiting image, then keeps collecting until it has
+``max_batch_size`` images or ``max_wait_ms`` have passed, and runs one
+forward pass for all of them. JPEG decoding (reduced-resolution, see
+image_loading.py) runs in a pool of ``decode_workers`` threads, so it
+overlaps with the model.
+
+    python inference_server.py serve --kind hybrid --weights hybrid_skin_cancer_model.pth --port 8080
+    curl --data-binary @lesion.jpg http://127.0.0.1:8080/predict
+    curl http://127.0.0.1:8080/stats
+
+``POST /predict`` takes the encoded image as the request body and returns
+the class probabilities. ``GET /stats`` returns p50/p90/p99 of the request
+latency (decode, queue wait and total) and of the batch run time, plus the
+histogram of batch sizes. Kinds (``KINDS``), with the weights they load:
+
+    'swin'            swim.py's Hugging Face Swin-Tiny, state dict or Trainer checkpoint
+    'swin_tiny'       timm Swin-Tiny, likewise
+    'efficientnet_b0' swin.py's EfficientNet-B0, likewise
+    'hybrid'          hybrid_model.py, likewise (the fusion head is read from the weights)
+    'mobilenet_v3_small', 'mobilenet_v3_large', 'dccn_student'  distillation.py students
+    'vgg16', 'dccn'   vgg16.py / dccn.py Keras models (.h5 or .keras)
+
+The load generator sends ``--requests`` images from ``--concurrency`` client
+threads and reports throughput and client-side latency percentiles. With
+``--compare`` it runs an in-process server with ``max_batch_size=1`` first,
+as a baseline:
+
+    python inference_server.py bench --kind hybrid --weights hybrid_skin_cancer_model.pth \\
+        --images /content/drive/MyDrive/data/test --concurrency 16 --compare
+"""
+
+import argparse
+import collections
+import glob
+import http.server
+import io
+import json
+import os
+import queue
+import threading
+import time
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import image_loading
+
+CLASSES = ('benign', 'malignant')  # ImageFolder order of the training scripts
+KINDS = ('swin', 'swin_tiny', 'efficientnet_b0', 'hybrid', 'mobilenet_v3_small', 'mobilenet_v3_large',
+         'dccn_student', 'vgg16', 'dccn')
+
+
+def _state_dict(path):
+    import torch
+
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    return state['model'] if isinstance(state, dict) and 'model' in state else state
+
+
+def _hybrid_fusion(state_dict):
+    # The compact fusion heads of hybrid_network.py have their own parameter names
+    if 'swin_fc.reduce.weight' in state_dict:
+        return {'fusion': 'low_rank', 'rank': state_dict['swin_fc.reduce.weight'].shape[0]}
+    if 'swin_fc.score.weight' in state_dict:
+        return {'fusion': 'attention'}
+    if 'swin_fc.proj.weight' in state_dict:
+        return {'fusion': 'pool'}
+    return {'fusion': 'flatten'}
+
+
+class Predictor:
+    """Class probabilities for a uint8 ``(N, size, size, 3)`` batch of
+    already resized images, for a PyTorch (ImageNet-normalized) or Keras
+    (``[0, 1]``, sigmoid or softmax output) model."""
+
+    def __init__(self, model, size, framework, device='cpu'):
+        self.model = model
+        self.size = size
+        self.framework = framework
+        self.device = device
+        if framework == 'torch':
+            from augmentation import BatchAugment
+
+            self.model.eval()
+            self.normalize = BatchAugment(size=size).to(device).normalize
+
+    def __call__(self, images):
+        if self.framework == 'torch':
+            import torch
+
+            from training_engine import logits_of
+
+            with torch.inference_mode():
+                logits = logits_of(self.model(self.normalize(torch.from_numpy(images).to(self.device))))
+                return torch.softmax(logits.float(), dim=1).cpu().numpy()
+        outputs = np.asarray(self.model(images.astype(np.float32) / 255.0, training=False))
+        if outputs.shape[1] == 1:  # Sigmoid output: probability of the positive (malignant) class
+            return np.concatenate([1.0 - outputs, outputs], axis=1)
+        return outputs
+
+
+def load_predictor(kind, weights=None, num_classes=2, device='cpu'):
+    """A ``Predictor`` for one of ``KINDS``; ``weights`` None keeps the
+    ImageNet (or random) initialization, for benchmarking."""
+    if kind in ('vgg16', 'dccn'):
+        if weights is None:
+            from co_training import build_member
+
+            model = build_member(kind, num_classes, pretrained=False).model
+        else:
+            import tensorflow as tf
+
+            model = tf.keras.models.load_model(weights)
+        return Predictor(model, 150 if kind == 'dccn' else 224, 'keras')
+
+    state_dict = _state_dict(weights) if weights is not None else None
+    if kind == 'swin':
+        from transformers import SwinForImageClassification
+
+        model = SwinForImageClassification.from_pretrained('microsoft/swin-tiny-patch4-window7-224',
+                                                           num_labels=num_classes, ignore_mismatched_sizes=True)
+    elif kind == 'hybrid':
+        from hybrid_network import HybridSkinCancerModel, feature_extractors
+
+        fusion = _hybrid_fusion(state_dict) if state_dict is not None else {}
+        model = HybridSkinCancerModel(*feature_extractors(pretrained=state_dict is None), num_classes, **fusion)
+    elif kind in ('mobilenet_v3_small', 'mobilenet_v3_large', 'dccn_student'):
+        from distillation import build_student
+
+        model = build_student('dccn' if kind == 'dccn_student' else kind, num_classes, pretrained=state_dict is None)
+    elif kind in ('swin_tiny', 'efficientnet_b0'):
+        from co_training import build_member
+
+        model = build_member(kind, num_classes, pretrained=state_dict is None).model
+    else:
+        raise ValueError(f'kind must be one of {KINDS}, got {kind!r}')
+    if state_dict is not None:
+        model.load_state_dict(state_dict)
+    return Predictor(model.to(device), 224, 'torch', device)
+
+
+def decode(data, size):
+    """Encoded image bytes -> uint8 ``(size, size, 3)`` array."""
+    image = image_loading.open_image(io.BytesIO(data), size=size)
+    if image.size != (size, size):
+        image = image.resize((size, size), Image.BILINEAR)
+    return np.asarray(image, dtype=np.uint8)
+
+
+class LatencyStats:
+    """Thread-safe percentiles over the last ``window`` samples of each series,
+    and a histogram of batch sizes."""
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.series = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.batch_sizes = collections.Counter()
+        self.requests = 0
+
+    def record(self, **milliseconds):
+        with self.lock:
+            for name, value in milliseconds.items():
+                self.series[name].append(value)
+
+    def record_batch(self, size, milliseconds):
+        with self.lock:
+            self.batch_sizes[size] += 1
+            self.requests += size
+            self.series['batch_ms'].append(milliseconds)
+
+    def summary(self):
+        with self.lock:
+            percentiles = {name: {f'p{q}': float(np.percentile(values, q)) for q in (50, 90, 99)}
+                           for name, values in self.series.items() if values}
+            batches = sum(self.batch_sizes.values())
+            return {'requests': self.requests, 'batches': batches,
+                    'mean_batch_size': self.requests / batches if batches else 0.0,
+                    'batch_size_histogram': dict(sorted(self.batch_sizes.items())), 'latency_ms': percentiles}
+
+
+class MicroBatcher:
+    """Merges concurrent ``submit(image)`` calls into batches for ``predictor``."""
+
+    def __init__(self, predictor, max_batch_size=32, max_wait_ms=5.0, stats=None):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = stats or LatencyStats()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self.thread.start()
+
+    def submit(self, image):
+        """A Future with the ``(probabilities, queue_ms)`` of one image."""
+        future = Future()
+        self.queue.put((image, future, time.perf_counter()))
+        return future
+
+    def _run(self):
+        while True:
+            first = self.queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                try:
+                    item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)  # Stop after this batch
+                    break
+                batch.append(item)
+
+            start = time.perf_counter()
+            try:
+                probabilities = self.predictor(np.stack([image for image, _, _ in batch]))
+            except Exception as error:  # One failed batch fails its requests, not the server
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                continue
+            elapsed = time.perf_counter() - start
+            self.stats.record_batch(len(batch), 1000 * elapsed)
+            for row, (_, future, queued) in zip(probabilities, batch):
+                future.set_result((row, 1000 * (start - queued)))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class InferenceServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, predictor, classes=CLASSES, max_batch_size=32, max_wait_ms=5.0,
+                 decode_workers=None):
+        super(InferenceServer, self).__init__(address, _Handler)
+        self.predictor = predictor
+        self.classes = list(classes)
+        self.stats = LatencyStats()
+        self.batcher = MicroBatcher(predictor, max_batch_size, max_wait_ms, self.stats)
+        self.decoders = ThreadPoolExecutor(decode_workers or os.cpu_count(), thread_name_prefix='decode')
+
+    def predict(self, data):
+        start = time.perf_counter()
+        image = self.decoders.submit(decode, data, self.predictor.size).result()
+        decoded = time.perf_counter()
+        probabilities, queue_ms = self.batcher.submit(image).result()
+        total_ms = 1000 * (time.perf_counter() - start)
+        self.stats.record(decode_ms=1000 * (decoded - start), queue_ms=queue_ms, total_ms=total_ms)
+        best = int(np.argmax(probabilities))
+        return {'class': self.classes[best], 'probabilities': dict(zip(self.classes, map(float, probabilities))),
+                'latency_ms': total_ms}
+
+    def server_close(self):
+        super(InferenceServer, self).server_close()
+        self.batcher.close()
+        self.decoders.shutdown()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, so clients reuse their connection
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.server.stats.summary())
+        elif self.path == '/health':
+            self._reply(200, {'status': 'ok'})
+        else:
+            self._reply(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != '/predict':
+            self._reply(404, {'error': f'unknown path {self.path}'})
+        elif not data:
+            self._reply(400, {'error': 'the request body must be an encoded image'})
+        else:
+            try:
+                self._reply(200, self.server.predict(data))
+            except OSError as error:  # PIL cannot decode the body
+                self._reply(400, {'error': f'not a readable image: {error}'})
+            except Exception as error:
+                self._reply(500, {'error': f'{type(error).__name__}: {error}'})
+
+    def log_message(self, format, *args):
+        pass  # One line per request would dominate the output under load
+
+
+def load_test(url, images, requests=500, concurrency=16):
+    """Posts ``requests`` of the encoded ``images`` (cycled) from
+    ``concurrency`` threads; returns throughput and latency percentiles."""
+    latencies, errors, lock = [], [], threading.Lock()
+    counter = iter(range(requests))
+
+    def client():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            try:
+                request = urllib.request.Request(url + '/predict', data=images[i % len(images)], method='POST')
+                with urllib.request.urlopen(request, timeout=300) as response:
+                    response.read()
+                with lock:
+                    latencies.append(1000 * (time.perf_counter() - start))
+            except Exception as error:
+                with lock:
+                    errors.append(repr(error))
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    result = {'requests': len(latencies), 'errors': len(errors), 'images_per_sec': len(latencies) / elapsed}
+    if latencies:
+        result.update({f'p{q}_ms': float(np.percentile(latencies, q)) for q in (50, 90, 99)})
+    if errors:
+        print(f'[bench] {len(errors)} failed requests, e.g. {errors[0]}')
+    return result
+
+
+def benchmark(predictor, images, configs, requests=500, concurrency=16, decode_workers=None):
+    """Starts an in-process server per ``(max_batch_size, max_wait_ms)`` in
+    ``configs``, loads it and prints client and server-side numbers."""
+    rows = []
+    print(f'{"max batch":>9} {"wait ms":>7} {"img/s":>8} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} '
+          f'{"mean batch":>10}  batch sizes')
+    for max_batch_size, max_wait_ms in configs:
+        server = InferenceServer(('127.0.0.1', 0), predictor, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms,
+                                 decode_workers=decode_workers)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+        load_test(url, images, requests=min(requests, 2 * concurrency), concurrency=concurrency)  # Warm-up
+        server.stats = server.batcher.stats = LatencyStats()
+        result = load_test(url, images, requests=requests, concurrency=concurrency)
+        summary = server.stats.summary()
+        server.shutdown()
+        server.server_close()
+        rows.append(dict(result, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, server=summary))
+        print(f'{max_batch_size:>9} {max_wait_ms:>7.1f} {result["images_per_sec"]:>8.1f} '
+              f'{result.get("p50_ms", float("nan")):>8.1f} {result.get("p90_ms", float("nan")):>8.1f} '
+              f'{result.get("p99_ms", float("nan")):>8.1f} {summary["mean_batch_size"]:>10.1f}  '
+              f'{summary["batch_size_histogram"]}')
+    return rows
+
+
+def _image_files(root, limit):
+    paths = sorted(path for pattern in ('*.jpg', '*.jpeg', '*.png', '*/*.jpg', '*/*.jpeg', '*/*.png')
+                   for path in glob.glob(os.path.join(root, pattern)))[:limit]
+    if not paths:
+        raise SystemExit(f'no images found under {root}')
+    images = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            images.append(f.read())
+    return images
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-batching HTTP inference for the skin cancer models')
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name in ('serve', 'bench'):
+        command = commands.add_parser(name)
+        command.add_argument('--kind', required=True, choices=KINDS)
+        command.add_argument('--weights', default=None, help='trained weights (untrained model if omitted)')
+        command.add_argument('--device', default='cpu')
+        command.add_argument('--max-batch-size', type=int, default=32)
+        command.add_argument('--max-wait-ms', type=float, default=5.0)
+        command.add_argument('--decode-workers', type=int, default=None)
+    serve, bench = commands.choices['serve'], commands.choices['bench']
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8080)
+    bench.add_argument('--images', required=True, help='directory (or ImageFolder root) of test images')
+    bench.add_argument('--limit', type=int, default=200, help='distinct images to send')
+    bench.add_argument('--requests', type=int, default=500)
+    bench.add_argument('--concurrency', type=int, default=16)
+    bench.add_argument('--compare', action='store_true', help='also run with max_batch_size=1 (no batching)')
+    args = parser.parse_args()
+
+    predictor = load_predictor(args.kind, args.weights, device=args.device)
+    if args.command == 'serve':
+        server = InferenceServer((args.host, args.port), predictor, max_batch_size=args.max_batch_size,
+                                 max_wait_ms=args.max_wait_ms, decode_workers=args.decode_workers)
+        print(f'[serve] {args.kind} on http://{args.host}:{args.port} (POST /predict, GET /stats), '
+              f'batches of up to {args.max_batch_size}, {args.max_wait_ms} ms wait')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+    else:
+        configs = ([(1, 0.0)] if args.compare else []) + [(args.max_batch_size, args.max_wait_ms)]
+        benchmark(predictor, _image_files(args.images, args.limit), configs, args.requests, args.concurrency,
+                  args.decode_workers)
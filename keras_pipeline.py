@@ -0,0 +1,258 @@
+"""tf.data input pipelines for the Keras models (vgg16.py, dccn.py).
+
+``ImageDataGenerator.flow_from_directory`` reads, decodes and augments one
+image at a time in a single Python thread and cannot overlap any of it with
+training. ``flow_from_directory`` here builds the same batches with tf.data:
+files are read and decoded in parallel, augmentation runs on whole batches
+with one projective-transform op, and batches are prefetched while the model
+trains. Deterministic pipelines (no shuffling, no augmentation, e.g. the
+validation split) are cached after the first pass. JPEGs are decoded at
+reduced resolution unless ``image_loading.FAST_DECODE`` is off.
+
+The existing ``ImageDataGenerator`` objects are kept as the description of
+the augmentation, so a script only changes the call:
+
+    train_generator = flow_from_directory(train_datagen, train_dir, target_size=(150, 150),
+                                          batch_size=32, class_mode='binary')
+    model.fit(train_generator.dataset, validation_data=validation_generator.dataset)
+
+The returned ``ImagePipeline`` keeps ``classes``, ``class_indices``,
+``samples`` and ``batch_size`` so metric and class-weight code works as before.
+"""
+
+import hashlib
+import math
+
+import numpy as np
+import tensorflow as tf
+
+import image_loading
+from dataset_manifest import DatasetManifest
+from shard_archive import ShardArchive
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+_FILL_MODES = {'nearest': 'NEAREST', 'constant': 'CONSTANT', 'reflect': 'REFLECT', 'wrap': 'WRAP'}
+_UNSUPPORTED = ('featurewise_center', 'samplewise_center', 'featurewise_std_normalization',
+                'samplewise_std_normalization', 'zca_whitening', 'preprocessing_function',
+                'brightness_range', 'channel_shift_range')
+
+
+def augmentation_from_datagen(datagen):
+    """Reads the augmentation settings of a Keras ``ImageDataGenerator``."""
+    if datagen is None:
+        return {}, None
+    for name in _UNSUPPORTED:
+        if getattr(datagen, name, None):
+            raise ValueError(f'ImageDataGenerator option {name!r} is not supported by the tf.data pipeline')
+
+    zoom_range = getattr(datagen, 'zoom_range', (1.0, 1.0))
+    settings = {
+        'rotation_range': float(datagen.rotation_range or 0.0),
+        'width_shift_range': float(datagen.width_shift_range or 0.0),
+        'height_shift_range': float(datagen.height_shift_range or 0.0),
+        'shear_range': float(datagen.shear_range or 0.0),
+        'zoom_range': (float(zoom_range[0]), float(zoom_range[1])),
+        'horizontal_flip': bool(datagen.horizontal_flip),
+        'vertical_flip': bool(datagen.vertical_flip),
+        'fill_mode': datagen.fill_mode,
+        'cval': float(datagen.cval),
+    }
+    is_random = (settings['rotation_range'] or settings['width_shift_range'] or settings['height_shift_range']
+                 or settings['shear_range'] or settings['zoom_range'] != (1.0, 1.0)
+                 or settings['horizontal_flip'] or settings['vertical_flip'])
+    return (settings if is_random else {}), datagen.rescale
+
+
+def _stack_matrices(rows):
+    # rows: 3x3 nested list of (n,) tensors -> (n, 3, 3)
+    return tf.stack([tf.stack(row, axis=-1) for row in rows], axis=-2)
+
+
+def random_affine(images, rotation_range=0.0, width_shift_range=0.0, height_shift_range=0.0,
+                  shear_range=0.0, zoom_range=(1.0, 1.0), horizontal_flip=False, vertical_flip=False,
+                  fill_mode='nearest', cval=0.0):
+    """Applies ``ImageDataGenerator.random_transform`` to a float batch
+    ``(N, H, W, C)``, each image with its own random parameters.
+
+    Rotation and shear are in degrees, shifts are fractions of the side and
+    zoom factors are drawn independently for x and y, exactly as Keras does.
+    """
+    n = tf.shape(images)[0]
+    height = tf.cast(tf.shape(images)[1], tf.float32)
+    width = tf.cast(tf.shape(images)[2], tf.float32)
+    zeros, ones = tf.zeros([n]), tf.ones([n])
+
+    def uniform(low, high):
+        return tf.random.uniform([n], low, high)
+
+    angle = uniform(-rotation_range, rotation_range) * (math.pi / 180) if rotation_range else zeros
+    tx = uniform(-width_shift_range, width_shift_range) * width if width_shift_range else zeros
+    ty = uniform(-height_shift_range, height_shift_range) * height if height_shift_range else zeros
+    shear = uniform(-shear_range, shear_range) * (math.pi / 180) if shear_range else zeros
+    if zoom_range[0] == 1 and zoom_range[1] == 1:
+        zx = zy = ones
+    else:
+        zx, zy = uniform(zoom_range[0], zoom_range[1]), uniform(zoom_range[0], zoom_range[1])
+
+    def flip_sign(enabled):
+        if not enabled:
+            return ones
+        return tf.where(tf.random.uniform([n]) < 0.5, -ones, ones)
+
+    # Maps output pixel coordinates, centred on the image, to input coordinates
+    cx, cy = (width - 1) / 2, (height - 1) / 2
+    to_centre = _stack_matrices([[ones, zeros, zeros - cx], [zeros, ones, zeros - cy], [zeros, zeros, ones]])
+    from_centre = _stack_matrices([[ones, zeros, zeros + cx], [zeros, ones, zeros + cy], [zeros, zeros, ones]])
+    rotate = _stack_matrices([[tf.cos(angle), -tf.sin(angle), zeros], [tf.sin(angle), tf.cos(angle), zeros],
+                              [zeros, zeros, ones]])
+    shift = _stack_matrices([[ones, zeros, tx], [zeros, ones, ty], [zeros, zeros, ones]])
+    shear_m = _stack_matrices([[ones, -tf.sin(shear), zeros], [zeros, tf.cos(shear), zeros], [zeros, zeros, ones]])
+    zoom = _stack_matrices([[zx, zeros, zeros], [zeros, zy, zeros], [zeros, zeros, ones]])
+    flip = _stack_matrices([[flip_sign(horizontal_flip), zeros, zeros], [zeros, flip_sign(vertical_flip), zeros],
+                            [zeros, zeros, ones]])
+
+    matrix = from_centre @ rotate @ shift @ shear_m @ zoom @ flip @ to_centre
+    transforms = tf.concat([tf.reshape(matrix, [n, 9])[:, :6], tf.zeros([n, 2])], axis=1)
+
+    return tf.raw_ops.ImageProjectiveTransformV3(
+        images=images, transforms=transforms, output_shape=tf.shape(images)[1:3],
+        fill_value=tf.constant(cval, tf.float32), interpolation='BILINEAR',
+        fill_mode=_FILL_MODES[fill_mode])
+
+
+def decode_jpeg_reduced(data, target_size):
+    """tf.data counterpart of ``image_loading.open_image``: decodes a JPEG at
+    the smallest 1/2, 1/4 or 1/8 DCT scale still covering ``target_size``."""
+    shape = tf.image.extract_jpeg_shape(data)
+    scale = tf.minimum(shape[0] // target_size[0], shape[1] // target_size[1])
+    index = tf.where(scale >= 8, 3, tf.where(scale >= 4, 2, tf.where(scale >= 2, 1, 0)))
+    return tf.switch_case(index, [lambda ratio=ratio: tf.io.decode_jpeg(data, channels=3, ratio=ratio)
+                                  for ratio in (1, 2, 4, 8)])
+
+
+class ImagePipeline:
+    """A batched, prefetched ``tf.data.Dataset`` plus the bookkeeping of a
+    Keras ``DirectoryIterator``. Pass ``.dataset`` to ``fit``/``evaluate``/``predict``."""
+
+    def __init__(self, dataset, classes, class_indices, filenames, batch_size, config=None, fingerprint=None):
+        self.dataset = dataset
+        self.classes = np.asarray(classes, dtype=np.int32)
+        self.class_indices = class_indices
+        self.filenames = filenames
+        self.samples = len(self.classes)
+        self.num_classes = len(class_indices)
+        self.batch_size = batch_size
+        self.config = config  # Augmentation, rescale and output settings, as JSON-compatible values
+        self.augmented = bool(config and config['augmentation'])
+        self.fingerprint = fingerprint  # Content hash of the images, from the dataset manifest
+
+    def __len__(self):
+        return math.ceil(self.samples / self.batch_size)
+
+    def reset(self):
+        # Every pass over a tf.data.Dataset starts from the beginning already;
+        # kept so code written against DirectoryIterator keeps working
+        pass
+
+
+def _config(datagen, target_size, class_mode, interpolation):
+    augmentation, rescale = augmentation_from_datagen(datagen)
+    return {'augmentation': augmentation, 'rescale': rescale, 'target_size': list(target_size),
+            'class_mode': class_mode, 'interpolation': interpolation}
+
+
+def _build(encoded, num_classes, datagen, target_size, batch_size, class_mode, deterministic, cache,
+           interpolation):
+    # encoded yields (encoded image bytes, integer label)
+    augmentation, rescale = augmentation_from_datagen(datagen)
+
+    def decode(data, label):
+        if image_loading.FAST_DECODE:
+            image = tf.cond(tf.io.is_jpeg(data), lambda: decode_jpeg_reduced(data, target_size),
+                            lambda: tf.io.decode_image(data, channels=3, expand_animations=False))
+        else:
+            image = tf.io.decode_image(data, channels=3, expand_animations=False)
+        image = tf.image.resize(image, target_size, method=interpolation)
+        image = tf.cast(tf.round(image) if interpolation != 'nearest' else image, tf.uint8)
+        image.set_shape((target_size[0], target_size[1], 3))
+        if class_mode == 'binary':
+            label = tf.cast(label, tf.float32)
+        elif class_mode == 'categorical':
+            label = tf.one_hot(label, num_classes)
+        return image, label
+
+    dataset = encoded.map(decode, num_parallel_calls=AUTOTUNE, deterministic=deterministic)
+
+    if cache is None:
+        cache = deterministic and not augmentation
+    if cache:
+        # Cache the decoded, resized uint8 images (in memory, or in a file if a path is given)
+        dataset = dataset.cache(cache if isinstance(cache, str) else '')
+
+    dataset = dataset.batch(batch_size)
+
+    def finish(images, labels):
+        images = tf.cast(images, tf.float32)
+        if augmentation:
+            images = random_affine(images, **augmentation)
+        if rescale:
+            images = images * rescale
+        return images, labels
+
+    dataset = dataset.map(finish, num_parallel_calls=AUTOTUNE, deterministic=deterministic)
+    return dataset.prefetch(AUTOTUNE)
+
+
+def flow_from_directory(datagen, directory, target_size=(256, 256), batch_size=32, class_mode='categorical',
+                        shuffle=True, seed=None, cache=None, interpolation='nearest', indices=None):
+    """tf.data equivalent of ``datagen.flow_from_directory(directory, ...)``.
+
+    Samples are listed in the same order as Keras lists them, so with
+    ``shuffle=False`` predictions line up with ``pipeline.classes``.
+    ``indices`` restricts the pipeline to those samples, e.g. one side of
+    ``DatasetManifest(directory).split(0.2)``.
+    """
+    manifest = DatasetManifest(directory)
+    classes, class_to_idx, samples = manifest.classes, manifest.class_to_idx, manifest.samples
+    fingerprint = manifest.fingerprint()
+    if indices is not None:
+        samples = [samples[i] for i in indices]
+        fingerprint = hashlib.sha1(f'{fingerprint}:{list(indices)}'.encode()).hexdigest()
+    paths = [path for path, _ in samples]
+    labels = [label for _, label in samples]
+    print(f'Found {len(paths)} images belonging to {len(classes)} classes.')
+
+    files = tf.data.Dataset.from_tensor_slices((paths, labels))
+    if shuffle:
+        files = files.shuffle(len(paths), seed=seed, reshuffle_each_iteration=True)
+    # Reads run in parallel with each other and with decoding
+    encoded = files.map(lambda path, label: (tf.io.read_file(path), label), num_parallel_calls=AUTOTUNE,
+                        deterministic=not shuffle)
+
+    dataset = _build(encoded, len(classes), datagen, target_size, batch_size, class_mode, not shuffle, cache,
+                     interpolation)
+    return ImagePipeline(dataset, labels, class_to_idx, paths, batch_size,
+                         config=_config(datagen, target_size, class_mode, interpolation), fingerprint=fingerprint)
+
+
+def flow_from_archive(datagen, archive_dir, split, target_size=(256, 256), batch_size=32,
+                      class_mode='categorical', shuffle=True, buffer_size=1000, cache=None,
+                      interpolation='nearest'):
+    """Same pipeline fed from a shard archive (see shard_archive.py): shards
+    are read sequentially and shuffled as in ``ShardArchive.records``, decoding
+    and augmentation run in parallel as above."""
+    archive = ShardArchive(archive_dir, split)
+
+    def records():
+        yield from archive.records(shuffle=shuffle, buffer_size=buffer_size)
+
+    encoded = tf.data.Dataset.from_generator(
+        records, output_signature=(tf.TensorSpec((), tf.string), tf.TensorSpec((), tf.int32)))
+    encoded = encoded.apply(tf.data.experimental.assert_cardinality(len(archive)))
+
+    dataset = _build(encoded, len(archive.classes), datagen, target_size, batch_size, class_mode, not shuffle,
+                     cache, interpolation)
+    return ImagePipeline(dataset, archive.targets, archive.class_to_idx, None, batch_size,
+                         config=_config(datagen, target_size, class_mode, interpolation),
+                         fingerprint=archive.fingerprint)
@@ -0,0 +1,126 @@
+"""Streaming classification metrics from a running confusion matrix.
+
+Instead of collecting every prediction in Python lists and calling the sklearn
+metric functions one after another, evaluation loops keep a C x C confusion
+matrix as a tensor on the model's device:
+
+    metrics = ConfusionMatrix(num_classes, device)
+    for inputs, labels in loader:
+        metrics.update(model(inputs).argmax(dim=1), labels)
+    metrics.accuracy(), metrics.f1('weighted'), metrics.report(class_names)
+
+``update`` is one ``bincount`` on the device and never synchronizes with the
+host; the matrix is read back once when a metric is asked for. Memory is
+O(C^2) whatever the dataset size. The numbers match ``sklearn.metrics``
+(``accuracy_score``, ``precision/recall/f1_score`` with ``average`` =
+'weighted', 'macro', 'binary' or None, ``confusion_matrix`` and
+``classification_report``), with zero_division=0.
+"""
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+AVERAGES = ('weighted', 'macro', 'binary', None)
+
+
+def _safe_divide(numerator, denominator):
+    return np.divide(numerator, denominator, out=np.zeros(len(numerator)), where=denominator != 0)
+
+
+class ConfusionMatrix:
+    """Running confusion matrix; rows are true classes, columns predictions."""
+
+    def __init__(self, num_classes, device='cpu'):
+        self.num_classes = num_classes
+        self.counts = torch.zeros(num_classes * num_classes, dtype=torch.long, device=device)
+
+    @classmethod
+    def from_matrix(cls, matrix, device='cpu'):
+        """Wraps an existing ``(C, C)`` count matrix, e.g. from cached results."""
+        matrix = torch.as_tensor(np.asarray(matrix), dtype=torch.long, device=device)
+        metrics = cls(matrix.size(0), device)
+        metrics.counts += matrix.reshape(-1)
+        return metrics
+
+    def update(self, preds, labels):
+        """Adds a batch of predicted and true class indices (any shape)."""
+        index = labels.reshape(-1).to(self.counts.device) * self.num_classes + preds.reshape(-1).to(self.counts.device)
+        self.counts += torch.bincount(index, minlength=self.num_classes ** 2)
+
+    def reset(self):
+        self.counts.zero_()
+
+    def all_reduce(self):
+        """Sums the counts over the ranks of a data-parallel job (no-op otherwise)."""
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.counts)
+        return self
+
+    @property
+    def matrix(self):
+        """The matrix as a ``(C, C)`` numpy array, like ``confusion_matrix``."""
+        return self.counts.view(self.num_classes, self.num_classes).cpu().numpy()
+
+    @property
+    def total(self):
+        return int(self.matrix.sum())
+
+    def accuracy(self):
+        matrix = self.matrix
+        return float(np.trace(matrix) / matrix.sum()) if matrix.sum() else 0.0
+
+    def per_class(self):
+        """``(precision, recall, f1, support)`` arrays, one entry per class."""
+        matrix = self.matrix.astype(np.float64)
+        true_positives = np.diag(matrix)
+        support = matrix.sum(axis=1)
+        precision = _safe_divide(true_positives, matrix.sum(axis=0))
+        recall = _safe_divide(true_positives, support)
+        f1 = _safe_divide(2 * precision * recall, precision + recall)
+        return precision, recall, f1, support.astype(np.int64)
+
+    def _average(self, values, support, average, pos_label):
+        if average not in AVERAGES:
+            raise ValueError(f'average must be one of {AVERAGES}, got {average!r}')
+        if average is None:
+            return values
+        if average == 'binary':
+            return float(values[pos_label])
+        if average == 'macro':
+            return float(values.mean())
+        return float((values * support).sum() / support.sum()) if support.sum() else 0.0
+
+    def precision(self, average='weighted', pos_label=1):
+        precision, _, _, support = self.per_class()
+        return self._average(precision, support, average, pos_label)
+
+    def recall(self, average='weighted', pos_label=1):
+        _, recall, _, support = self.per_class()
+        return self._average(recall, support, average, pos_label)
+
+    def f1(self, average='weighted', pos_label=1):
+        _, _, f1, support = self.per_class()
+        return self._average(f1, support, average, pos_label)
+
+    def report(self, target_names=None, digits=2):
+        """Text table in the format of ``sklearn.metrics.classification_report``."""
+        names = list(target_names) if target_names is not None else [str(i) for i in range(self.num_classes)]
+        precision, recall, f1, support = self.per_class()
+        headers = ['precision', 'recall', 'f1-score', 'support']
+        width = max(max(len(name) for name in names), len('weighted avg'), digits)
+
+        head_fmt = '{:>{width}s} ' + ' {:>9}' * len(headers)
+        row_fmt = '{:>{width}s} ' + ' {:>9.{digits}f}' * 3 + ' {:>9}\n'
+        lines = head_fmt.format('', *headers, width=width) + '\n\n'
+        for row in zip(names, precision, recall, f1, support):
+            lines += row_fmt.format(*row, width=width, digits=digits)
+        lines += '\n'
+
+        total = int(support.sum())
+        lines += ('{:>{width}s} ' + ' {:>9.{digits}}' * 2 + ' {:>9.{digits}f}' + ' {:>9}\n').format(
+            'accuracy', '', '', self.accuracy(), total, width=width, digits=digits)
+        for average in ('macro', 'weighted'):
+            lines += row_fmt.format(f'{average} avg', self.precision(average), self.recall(average),
+                                    self.f1(average), total, width=width, digits=digits)
+        return lines.rstrip('\n') + '\n'
@@ -0,0 +1,182 @@
+"""Progressive-resolution training: small images and large batches first.
+
+Early epochs learn coarse features that a low resolution already shows, at a
+fraction of the cost per image. ``ResolutionSchedule`` starts at
+``start_size``, steps up to ``final_size`` over the first ``ramp`` fraction
+of the run and trains the remaining epochs at full size. At a lower
+resolution the batch grows by ``(final_size / size) ** 2`` (same pixels per
+step), which keeps the cores busy:
+
+    schedule = ResolutionSchedule(final_size=224, epochs=15, start_size=128, base_batch_size=32)
+    for epoch in range(15):
+        stage = schedule.stage(epoch)              # .size, .batch_size
+        train_transform.size = stage.size          # BatchAugment resizes on the device
+        set_resolution(model, stage.size)
+        loader = loaders.get(stage.batch_size)
+        ...
+        set_resolution(model, schedule.final_size)  # Validate at full size
+        tracker.record(val_accuracy)
+
+Sizes are multiples of ``multiple``; 32 suits EfficientNet and Swin (patch 4
+and three 2x patch mergings, so every stage has an even, integer feature
+map). Windows that no longer tile a stage are padded by the model itself for
+Hugging Face Swin; for timm Swin ``set_resolution`` switches to padded
+partitioning below the training size, which keeps every relative-position
+table (and so every parameter) unchanged. Models with a flattening head tied
+to one resolution (the hybrid model's default ``swin_fc``) cannot use a
+schedule; its 'pool' and 'attention' fusions can.
+
+``fit_progressive`` does the same for Keras models built with a variable
+input size. ``TimeToAccuracy`` measures wall time until a target validation
+accuracy, to compare a schedule with a fixed-resolution run.
+"""
+
+import collections
+import time
+
+Stage = collections.namedtuple('Stage', ['first_epoch', 'last_epoch', 'size', 'batch_size'])
+
+
+class ResolutionSchedule:
+    """Resolution and batch size per epoch (0-based)."""
+
+    def __init__(self, final_size, epochs, start_size=128, ramp=0.5, multiple=32, base_batch_size=32,
+                 max_batch_size=None, batch_multiple=8):
+        if not 0 < start_size <= final_size:
+            raise ValueError(f'start_size must be in (0, final_size], got {start_size}')
+        self.final_size = final_size
+        self.epochs = epochs
+        self.base_batch_size = base_batch_size
+
+        ramp_epochs = int(round(ramp * epochs)) if start_size < final_size else 0
+        stages = []
+        for epoch in range(epochs):
+            if epoch < ramp_epochs:
+                # Linear in the side length, rounded down to the size multiple
+                size = start_size + (final_size - start_size) * epoch / ramp_epochs
+                size = min(final_size, max(multiple, int(size) // multiple * multiple))
+            else:
+                size = final_size
+            batch_size = max(base_batch_size, int(base_batch_size * (final_size / size) ** 2)
+                             // batch_multiple * batch_multiple)
+            if max_batch_size:
+                batch_size = min(batch_size, max_batch_size)
+            if stages and stages[-1].size == size:
+                stages[-1] = stages[-1]._replace(last_epoch=epoch)
+            else:
+                stages.append(Stage(epoch, epoch, size, batch_size))
+        self.stages = stages
+
+    def stage(self, epoch):
+        for stage in self.stages:
+            if stage.first_epoch <= epoch <= stage.last_epoch:
+                return stage
+        return self.stages[-1]
+
+    def relative_cost(self):
+        """Pixels processed relative to training every epoch at ``final_size``."""
+        pixels = sum((s.last_epoch - s.first_epoch + 1) * s.size ** 2 for s in self.stages)
+        return pixels / (self.epochs * self.final_size ** 2)
+
+    def __str__(self):
+        parts = [f'epochs {s.first_epoch + 1}-{s.last_epoch + 1}: {s.size}px x {s.batch_size}' for s in self.stages]
+        return '; '.join(parts) + f' ({100 * self.relative_cost():.0f}% of the fixed-resolution pixels)'
+
+
+def set_resolution(model, size):
+    """Prepares ``model`` for ``size`` x ``size`` inputs. Only timm Swin
+    models need it (their attention masks depend on the feature map size);
+    convolutional and Hugging Face models accept any size as they are."""
+    for module in model.modules():
+        if type(module).__name__ != 'SwinTransformer' or not hasattr(module, 'set_input_size'):
+            continue
+        if not hasattr(module, '_base_input_size'):
+            module._base_input_size = tuple(module.patch_embed.img_size)
+            module._base_window_size = tuple(module.layers[0].blocks[0].window_size)
+        module.set_input_size(img_size=(size, size), window_size=module._base_window_size,
+                              always_partition=(size, size) != module._base_input_size)
+
+
+class ProgressiveLoaders:
+    """One shuffled ``make_loader`` loader per batch size; the previous one is
+    dropped (and its workers stopped) when the batch size changes."""
+
+    def __init__(self, dataset, **loader_kwargs):
+        self.dataset = dataset
+        self.loader_kwargs = dict(loader_kwargs, shuffle=True)
+        self.loader = None
+
+    def get(self, batch_size):
+        from data_loading import make_loader
+
+        if self.loader is None or self.loader.batch_size != batch_size:
+            self.loader = None
+            self.loader = make_loader(self.dataset, batch_size=batch_size, **self.loader_kwargs)
+        return self.loader
+
+
+class TimeToAccuracy:
+    """Wall time from creation until each recorded validation accuracy."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.points = []  # (seconds, accuracy)
+
+    def record(self, accuracy):
+        self.points.append((time.perf_counter() - self.start, float(accuracy)))
+
+    def time_to(self, target):
+        """Seconds until ``accuracy >= target`` first, None if never reached."""
+        return next((seconds for seconds, accuracy in self.points if accuracy >= target), None)
+
+    def report(self, target, name='run'):
+        seconds = self.time_to(target)
+        best = max((accuracy for _, accuracy in self.points), default=0.0)
+        if seconds is None:
+            print(f'[{name}] did not reach {target:.2%} validation accuracy (best {best:.2%})')
+        else:
+            print(f'[{name}] reached {target:.2%} validation accuracy after {seconds:.0f}s (best {best:.2%})')
+        return seconds
+
+    def keras_callback(self, monitor='val_accuracy'):
+        """Keras callback recording ``logs[monitor]`` at the end of every epoch."""
+        import tensorflow as tf
+
+        tracker = self
+
+        class RecordAccuracy(tf.keras.callbacks.Callback):
+            def on_epoch_end(self, epoch, logs=None):
+                if logs and monitor in logs:
+                    tracker.record(logs[monitor])
+
+        return RecordAccuracy()
+
+
+class _MergedHistory:
+    # Looks like the keras History returned by fit: .history and .epoch
+    def __init__(self):
+        self.history = collections.defaultdict(list)
+        self.epoch = []
+
+
+def fit_progressive(model, schedule, make_dataset, validation_data=None, callbacks=None, verbose='auto'):
+    """Keras training following ``schedule``: one ``model.fit`` per stage on
+    ``make_dataset(size, batch_size)``, epochs numbered continuously. The
+    model needs a variable input size (e.g. ``build_dccn`` with
+    ``variable_input=True``). Callbacks see each stage as its own ``fit``,
+    so EarlyStopping/ReduceLROnPlateau patience restarts at a new
+    resolution. Returns a History-like object with the merged ``.history``."""
+    merged = _MergedHistory()
+    for stage in schedule.stages:
+        print(f'[progressive] epochs {stage.first_epoch + 1}-{stage.last_epoch + 1}: '
+              f'{stage.size}x{stage.size}, batch {stage.batch_size}')
+        history = model.fit(make_dataset(stage.size, stage.batch_size), validation_data=validation_data,
+                            initial_epoch=stage.first_epoch, epochs=stage.last_epoch + 1, callbacks=callbacks,
+                            verbose=verbose)
+        for key, values in history.history.items():
+            merged.history[key].extend(values)
+        merged.epoch.extend(history.epoch)
+        if getattr(model, 'stop_training', False):
+            break  # Early stopping inside a stage ends the run
+    merged.history = dict(merged.history)
+    return merged
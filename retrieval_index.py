@@ -0,0 +1,308 @@
+"""Nearest-neighbour index over backbone embeddings ("similar past cases").
+
+The pooled backbone features (EfficientNet-B0 1280-d, Swin-Tiny 768-d, or
+both concatenated as in hybrid_model.py) of every training image are stored
+once and searched by cosine similarity. ``RetrievalIndex`` is an inverted-file
+index: k-means splits the training vectors into ``nlist`` cells and a query
+only scores the vectors in its ``nprobe`` closest cells. Vectors are kept as
+float16, or product-quantized to ``pq_m`` bytes each with ``pq_m`` set.
+
+    embed_fn = pooled_features(hybrid_model.extract_features, ('channels_first', 'channels_last'), dim=1280 + 768)
+    vectors = embed(train_dataset, embed_fn, device, transform)
+    index = RetrievalIndex(nprobe=8)
+    index.add(vectors, train_dataset.targets, ids=[path for path, _ in train_dataset.samples])
+    index.save('/content/drive/MyDrive/retrieval/hybrid.npz')
+
+    scores, neighbours = index.search(query_vectors, k=5)   # positions, see index.ids
+    predictions = index.knn_predict(query_vectors, k=5)
+
+New labelled images are added with ``add`` at any time; they go into the
+existing cells without retraining. Recall against brute-force search and
+per-query latency, for a range of ``nprobe``:
+
+    python retrieval_index.py /content/drive/MyDrive/retrieval/hybrid.npz --k 5
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from data_loading import make_loader
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+_SPATIAL_DIMS = {'channels_first': (2, 3), 'channels_last': (1, 2)}
+
+
+def pooled_features(feature_fn, layouts, dim=None):
+    """Wraps a function returning backbone feature maps (e.g.
+    ``HybridSkinCancerModel.extract_features``) so it returns one
+    average-pooled, concatenated vector per image.
+
+    ``layouts`` gives each output's layout: ``'channels_first'`` for
+    ``(B, C, H, W)`` (EfficientNet) or ``'channels_last'`` for
+    ``(B, H, W, C)`` (timm's Swin); 2-d outputs are used as they are. With
+    ``dim`` the length of the concatenated vector is checked.
+    """
+    if isinstance(layouts, str):
+        layouts = (layouts,)
+    for layout in layouts:
+        if layout not in _SPATIAL_DIMS:
+            raise ValueError(f'layout must be one of {sorted(_SPATIAL_DIMS)}, got {layout!r}')
+
+    def embed_fn(images):
+        outputs = feature_fn(images)
+        if torch.is_tensor(outputs):
+            outputs = (outputs,)
+        if len(outputs) != len(layouts):
+            raise ValueError(f'{len(outputs)} feature maps but {len(layouts)} layouts')
+        pooled = [output.mean(dim=_SPATIAL_DIMS[layout]) if output.dim() == 4 else output.flatten(1)
+                  for output, layout in zip(outputs, layouts)]
+        vectors = torch.cat(pooled, dim=1)
+        if dim is not None and vectors.size(1) != dim:
+            raise ValueError(f'pooled features have {vectors.size(1)} dimensions, expected {dim}')
+        return vectors
+    return embed_fn
+
+
+@torch.no_grad()
+def embed(dataset, embed_fn, device, transform=None, batch_size=64):
+    """Runs ``embed_fn`` over ``dataset`` in order and returns the float32
+    vectors as an ``(N, dim)`` array."""
+    loader = make_loader(dataset, batch_size=batch_size, shuffle=False, name='embed')
+    chunks = []
+    for images, _ in loader:
+        images = images.to(device)
+        if transform is not None:
+            images = transform(images)
+        chunks.append(embed_fn(images).float().cpu().numpy())
+    return np.concatenate(chunks)
+
+
+def kmeans(vectors, k, iterations=20, seed=0):
+    """Spherical k-means (cosine), returns ``(k, dim)`` unit centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for c in range(k):
+            members = vectors[assignment == c]
+            # Empty cells are re-seeded with a random vector
+            centroids[c] = members.sum(axis=0) if len(members) else vectors[rng.integers(len(vectors))]
+        centroids = normalize(centroids)
+    return centroids
+
+
+def _train_codebooks(vectors, m, iterations=20, seed=0):
+    # One 256-entry codebook per subspace (plain k-means, L2)
+    rng = np.random.default_rng(seed)
+    codebooks = []
+    for sub in np.array_split(vectors, m, axis=1):
+        k = min(256, len(sub))
+        centroids = sub[rng.choice(len(sub), k, replace=False)].copy()
+        for _ in range(iterations):
+            distances = (sub ** 2).sum(1, keepdims=True) - 2 * sub @ centroids.T + (centroids ** 2).sum(1)
+            assignment = np.argmin(distances, axis=1)
+            for c in range(k):
+                members = sub[assignment == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+        codebooks.append(centroids)
+    return codebooks
+
+
+class RetrievalIndex:
+    """Inverted-file (IVF) cosine-similarity index with incremental inserts.
+
+    The cells are trained on the first ``add`` (``nlist`` defaults to about
+    ``4 * sqrt(N)``). ``pq_m`` stores each vector as ``pq_m`` one-byte codes
+    instead of float16; ``search`` then scores with per-query lookup tables.
+    """
+
+    def __init__(self, nlist=None, nprobe=8, pq_m=None, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.pq_m = pq_m
+        self.seed = seed
+        self.centroids = None
+        self.codebooks = None
+        self.vectors = None  # float16 (N, dim), or uint8 (N, pq_m) codes with pq_m
+        self.cells = np.zeros(0, dtype=np.int32)
+        self.labels = np.zeros(0, dtype=np.int64)
+        self.ids = []
+        self._lists = None
+
+    def __len__(self):
+        return len(self.cells)
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def train(self, vectors):
+        vectors = normalize(vectors)
+        nlist = self.nlist or max(1, min(len(vectors) // 8, int(4 * np.sqrt(len(vectors)))))
+        # k-means on a sample is plenty for the cell layout
+        sample = vectors[np.random.default_rng(self.seed).permutation(len(vectors))[:256 * nlist]]
+        self.centroids = kmeans(sample, nlist, seed=self.seed)
+        if self.pq_m:
+            # Codes describe the offset from the cell centroid, which is much
+            # smaller than the vector itself
+            residuals = sample - self.centroids[np.argmax(sample @ self.centroids.T, axis=1)]
+            self.codebooks = _train_codebooks(residuals, self.pq_m, seed=self.seed)
+
+    def _encode(self, vectors, cells):
+        if not self.pq_m:
+            return vectors.astype(np.float16)
+        codes = []
+        residuals = vectors - self.centroids[cells]
+        for sub, codebook in zip(np.array_split(residuals, self.pq_m, axis=1), self.codebooks):
+            distances = -2 * sub @ codebook.T + (codebook ** 2).sum(1)
+            codes.append(np.argmin(distances, axis=1).astype(np.uint8))
+        return np.stack(codes, axis=1)
+
+    def add(self, vectors, labels, ids=None):
+        """Inserts ``vectors`` with their integer ``labels`` and optional
+        ``ids`` (e.g. image paths). Trains the cells first if needed."""
+        vectors = normalize(vectors)
+        if not self.trained:
+            self.train(vectors)
+        cells = np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+        encoded = self._encode(vectors, cells)
+
+        self.vectors = encoded if self.vectors is None else np.concatenate([self.vectors, encoded])
+        self.cells = np.concatenate([self.cells, cells])
+        self.labels = np.concatenate([self.labels, np.asarray(labels, dtype=np.int64)])
+        start = len(self.ids)
+        self.ids.extend(ids if ids is not None else range(start, start + len(vectors)))
+        self._lists = None
+
+    def _inverted_lists(self):
+        if self._lists is None:
+            order = np.argsort(self.cells, kind='stable')
+            bounds = np.searchsorted(self.cells[order], np.arange(len(self.centroids) + 1))
+            self._lists = [order[bounds[c]:bounds[c + 1]] for c in range(len(self.centroids))]
+        return self._lists
+
+    def _scores(self, query, tables, cell, candidates):
+        if not self.pq_m:
+            return self.vectors[candidates].astype(np.float32) @ query
+        # query . (centroid + residual), the residual part from the lookup tables
+        return query @ self.centroids[cell] + tables[np.arange(self.pq_m), self.vectors[candidates]].sum(axis=1)
+
+    def search(self, queries, k=5, nprobe=None):
+        """Returns ``(scores, positions)``, both ``(Q, k)``; positions index
+        ``labels`` and ``ids`` and are -1 where fewer than k were found."""
+        queries = normalize(np.atleast_2d(queries))
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        lists = self._inverted_lists()
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        positions = np.full((len(queries), k), -1, dtype=np.int64)
+
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+        for q, query in enumerate(queries):
+            candidates = np.concatenate([lists[c] for c in probes[q]])
+            if not len(candidates):
+                continue
+            tables = None
+            if self.pq_m:
+                # Inner products of the query with every codeword, once per query
+                tables = np.stack([codebook @ sub for sub, codebook
+                                   in zip(np.array_split(query, self.pq_m), self.codebooks)])
+            candidate_scores = np.concatenate([self._scores(query, tables, c, lists[c]) for c in probes[q]])
+            top = min(k, len(candidates))
+            best = np.argpartition(-candidate_scores, top - 1)[:top]
+            best = best[np.argsort(-candidate_scores[best])]
+            scores[q, :top] = candidate_scores[best]
+            positions[q, :top] = candidates[best]
+        return scores, positions
+
+    def knn_predict(self, queries, k=5, nprobe=None):
+        """Similarity-weighted vote of the k nearest labelled cases."""
+        scores, positions = self.search(queries, k, nprobe)
+        num_classes = int(self.labels.max()) + 1
+        votes = np.zeros((len(positions), num_classes), dtype=np.float32)
+        for q in range(len(positions)):
+            found = positions[q] >= 0
+            np.add.at(votes[q], self.labels[positions[q][found]], np.maximum(scores[q][found], 0) + 1e-6)
+        return votes.argmax(axis=1)
+
+    def save(self, path):
+        arrays = {'vectors': self.vectors, 'cells': self.cells, 'labels': self.labels, 'centroids': self.centroids,
+                  'ids': np.asarray([str(i) for i in self.ids]),
+                  'config': np.asarray([self.nprobe, self.pq_m or 0, self.seed])}
+        if self.codebooks is not None:
+            arrays.update({f'codebook{j}': codebook for j, codebook in enumerate(self.codebooks)})
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            nprobe, pq_m, seed = (int(v) for v in data['config'])
+            index = cls(nlist=len(data['centroids']), nprobe=nprobe, pq_m=pq_m or None, seed=seed)
+            index.centroids = data['centroids']
+            index.vectors, index.cells, index.labels = data['vectors'], data['cells'], data['labels']
+            index.ids = data['ids'].tolist()
+            if pq_m:
+                index.codebooks = [data[f'codebook{j}'] for j in range(pq_m)]
+        return index
+
+
+def brute_force(vectors, queries, k):
+    """Exact top-k positions by cosine similarity, the benchmark reference.
+    ``vectors`` must already be normalized."""
+    similarities = normalize(queries) @ vectors.T
+    top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(similarities, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def benchmark(index, vectors, queries, k=5, nprobes=(1, 2, 4, 8, 16, 32)):
+    """Recall@k of ``index`` against exact search over ``vectors`` (the
+    vectors the index holds) and mean latency per single query."""
+    vectors = normalize(vectors)
+    start = time.perf_counter()
+    exact = np.concatenate([brute_force(vectors, query[None], k) for query in queries])
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    print(f'brute force: {exact_ms:.2f} ms/query over {len(vectors)} vectors')
+
+    results = []
+    for nprobe in nprobes:
+        if nprobe > len(index.centroids):
+            break
+        start = time.perf_counter()
+        found = np.concatenate([index.search(query, k, nprobe)[1] for query in queries])
+        ms = (time.perf_counter() - start) * 1000 / len(queries)
+        recall = np.mean([len(set(f) & set(e)) / k for f, e in zip(found, exact)])
+        results.append((nprobe, recall, ms))
+        print(f'nprobe={nprobe:3d}  recall@{k}={recall:.3f}  {ms:.2f} ms/query')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recall vs latency of a retrieval index against brute force')
+    parser.add_argument('index', help='index saved with RetrievalIndex.save')
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--queries', type=int, default=200, help='held-out vectors used as queries')
+    parser.add_argument('--pq-m', type=int, default=None, help='also benchmark product quantization')
+    args = parser.parse_args()
+
+    stored = RetrievalIndex.load(args.index)
+    if stored.pq_m:
+        parser.error('benchmark needs a float16 index (the exact vectors)')
+    vectors = stored.vectors.astype(np.float32)
+    order = np.random.default_rng(0).permutation(len(vectors))
+    queries, database = vectors[order[:args.queries]], vectors[order[args.queries:]]
+
+    for pq_m in [None] + ([args.pq_m] if args.pq_m else []):
+        index = RetrievalIndex(pq_m=pq_m)
+        index.add(database, stored.labels[order[args.queries:]])
+        print(f'-- {"float16" if not pq_m else f"PQ {pq_m} bytes"}, {len(index.centroids)} cells')
+        benchmark(index, database, queries, k=args.k)
@@ -0,0 +1,323 @@
+"""Sharded sequential archive of the skin-lesion dataset.
+
+Reading tens of thousands of small JPEGs through ``ImageFolder`` or
+``flow_from_directory`` costs one open/stat round trip per image, which is
+what dominates on the Drive mount. ``pack_split`` copies the encoded bytes of
+every image under ``data/<split>/<class>/`` into a few large shard files that
+are read front to back:
+
+    [image bytes][image bytes]...[index JSON][index length: 8 bytes][MAGIC]
+
+The per-shard index holds the offset, length and label of every record. A
+``<split>.json`` manifest next to the shards lists them with their sample
+counts and the class mapping, so readers never have to scan the directory.
+It also records the fingerprint of the dataset manifest the split was packed
+from; ``pack_split`` repacks the split when the images have changed.
+
+Pack once per data root:
+
+    python shard_archive.py /content/drive/MyDrive/data /content/shards
+
+``ShardedImageDataset`` streams the archive into a PyTorch DataLoader and
+``keras_batches`` feeds ``model.fit``. Both shuffle the shard order every
+epoch and shuffle records inside a bounded buffer while streaming.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import struct
+
+import numpy as np
+from PIL import Image
+
+from dataset_manifest import DatasetManifest
+from image_loading import open_image
+
+MAGIC = b'SKSHARD1'
+_FOOTER = struct.Struct('<Q8s')
+
+
+def _manifest_path(archive_dir, split):
+    return os.path.join(archive_dir, f'{split}.json')
+
+
+def _packed_split(manifest_path):
+    # The split manifest written by pack_split, None if there is none
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def pack_split(root, archive_dir, split=None, shard_size=256 * 1024 * 1024, seed=0, overwrite=False):
+    split = split or os.path.basename(os.path.normpath(root))
+    os.makedirs(archive_dir, exist_ok=True)
+    manifest_path = _manifest_path(archive_dir, split)
+    folder = DatasetManifest(root)
+    fingerprint = folder.fingerprint()
+    packed = _packed_split(manifest_path)
+    if packed is not None and not overwrite and packed.get('fingerprint') == fingerprint:
+        return manifest_path
+    if packed is not None:
+        # Removed first so a half-repacked split is never picked up
+        os.remove(manifest_path)
+        print(f'[shards] {split}: images changed since packing, repacking')
+
+    # Same class discovery and sample order as torchvision's ImageFolder, without importing torch
+    classes, class_to_idx, samples = folder.classes, folder.class_to_idx, folder.samples
+    # Mix the classes across shards so shard-level shuffling alone already
+    # gives class-balanced streams
+    samples = list(samples)
+    random.Random(seed).shuffle(samples)
+
+    shards = []
+    writer, index = None, None
+
+    def close_shard():
+        payload = json.dumps(index).encode()
+        writer.write(payload)
+        writer.write(_FOOTER.pack(len(payload), MAGIC))
+        writer.close()
+        shards[-1]['samples'] = len(index['labels'])
+
+    for path, target in samples:
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        if writer is None or (index['lengths'] and writer.tell() + len(data) > shard_size):
+            if writer is not None:
+                close_shard()
+            name = f'{split}-{len(shards):05d}.shard'
+            shards.append({'file': name})
+            writer = open(os.path.join(archive_dir, name), 'wb')
+            index = {'offsets': [], 'lengths': [], 'labels': [], 'paths': []}
+
+        index['offsets'].append(writer.tell())
+        index['lengths'].append(len(data))
+        index['labels'].append(target)
+        index['paths'].append(os.path.relpath(path, root))
+        writer.write(data)
+
+    if writer is not None:
+        close_shard()
+    if packed is not None:
+        # Shards of the previous packing that were not overwritten
+        for shard in packed['shards']:
+            if shard['file'] not in {new['file'] for new in shards}:
+                os.remove(os.path.join(archive_dir, shard['file']))
+
+    # The manifest is written last so a half-packed split is never picked up
+    with open(manifest_path, 'w') as f:
+        json.dump({
+            'root': os.path.abspath(root),
+            'split': split,
+            'classes': classes,
+            'class_to_idx': class_to_idx,
+            'samples': len(samples),
+            'shards': shards,
+            'fingerprint': fingerprint,
+        }, f)
+    return manifest_path
+
+
+def read_shard_index(path):
+    with open(path, 'rb') as f:
+        f.seek(-_FOOTER.size, os.SEEK_END)
+        length, magic = _FOOTER.unpack(f.read(_FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a shard file')
+        f.seek(-_FOOTER.size - length, os.SEEK_END)
+        return json.loads(f.read(length))
+
+
+class ShardArchive:
+    """One split of a packed archive, described by its manifest."""
+
+    def __init__(self, archive_dir, split):
+        self.archive_dir = archive_dir
+        self.split = split
+        with open(_manifest_path(archive_dir, split)) as f:
+            manifest = json.load(f)
+        self.classes = manifest['classes']
+        self.class_to_idx = manifest['class_to_idx']
+        self.shards = [os.path.join(archive_dir, shard['file']) for shard in manifest['shards']]
+        self.shard_sizes = [shard['samples'] for shard in manifest['shards']]
+        self.fingerprint = manifest.get('fingerprint')  # Of the dataset manifest it was packed from
+        self._targets = None
+
+    def __len__(self):
+        return sum(self.shard_sizes)
+
+    @property
+    def targets(self):
+        # Labels in archive order, read from the shard footers on first use
+        if self._targets is None:
+            self._targets = [label for path in self.shards for label in read_shard_index(path)['labels']]
+        return self._targets
+
+    def class_counts(self):
+        return np.bincount(self.targets, minlength=len(self.classes)).tolist()
+
+    def records(self, shards=None, shuffle=False, buffer_size=1000, rng=None, part=None):
+        """Yields ``(encoded_bytes, label)`` reading each shard sequentially.
+
+        With ``shuffle`` the shard order is permuted and records pass through
+        a ``buffer_size`` reservoir that emits them in random order.
+        ``part=(k, n)`` reads only the k-th of n contiguous slices of every
+        shard, so n readers can share the same shards.
+        """
+        rng = rng or random.Random()
+        shards = list(self.shards if shards is None else shards)
+        if shuffle:
+            rng.shuffle(shards)
+
+        def sequential():
+            for path in shards:
+                index = read_shard_index(path)
+                entries = list(zip(index['offsets'], index['lengths'], index['labels']))
+                if part is not None:
+                    k, n = part
+                    entries = entries[len(entries) * k // n:len(entries) * (k + 1) // n]
+                with open(path, 'rb') as f:
+                    # Records are contiguous, so one forward pass reads the shard
+                    for offset, length, label in entries:
+                        f.seek(offset)
+                        yield f.read(length), label
+
+        if not shuffle or buffer_size <= 1:
+            yield from sequential()
+            return
+
+        buffer = []
+        for record in sequential():
+            if len(buffer) < buffer_size:
+                buffer.append(record)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = record
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+def decode_image(data, size=None):
+    # size is the (width, height) the caller resizes to next, so JPEGs can be
+    # decoded at reduced resolution
+    return open_image(io.BytesIO(data), size)
+
+
+try:
+    from torch.utils.data import IterableDataset, get_worker_info
+except ImportError:  # Keras-only environments
+    IterableDataset, get_worker_info = object, None
+
+
+class ShardedImageDataset(IterableDataset):
+    """Streaming replacement for ``datasets.ImageFolder(root, transform)``.
+
+    Use with ``shuffle=False`` on the DataLoader, shuffling happens here. Every
+    DataLoader worker reads a disjoint subset of the shards (with fewer shards
+    than workers, a disjoint slice of every shard), and the shard order
+    changes every epoch. ``decode_size`` is the size the transform resizes to;
+    JPEGs are then decoded at the smallest reduced resolution that covers it.
+    """
+
+    def __init__(self, archive_dir, split, transform=None, target_transform=None, shuffle=False,
+                 buffer_size=1000, seed=0, decode_size=None):
+        self.archive = ShardArchive(archive_dir, split)
+        self.classes = self.archive.classes
+        self.class_to_idx = self.archive.class_to_idx
+        self.transform = transform
+        self.target_transform = target_transform
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.decode_size = decode_size
+        self.epoch = 0
+
+    @property
+    def targets(self):
+        return self.archive.targets
+
+    def __len__(self):
+        return len(self.archive)
+
+    def __iter__(self):
+        # All workers derive the same shard permutation from (seed, epoch) and
+        # then take every num_workers-th shard of it
+        epoch, self.epoch = self.epoch, self.epoch + 1
+        shards = list(self.archive.shards)
+        if self.shuffle:
+            random.Random(self.seed + epoch).shuffle(shards)
+
+        worker = get_worker_info() if get_worker_info is not None else None
+        worker_id, part = 0, None
+        if worker is not None:
+            if len(shards) >= worker.num_workers:
+                shards = shards[worker.id::worker.num_workers]
+            else:
+                # Too few shards to go round: every worker reads its own slice of each one
+                part = (worker.id, worker.num_workers)
+            worker_id = worker.id
+        rng = random.Random((self.seed + epoch) * 1000 + worker_id)
+
+        for data, target in self.archive.records(shards, shuffle=self.shuffle, buffer_size=self.buffer_size,
+                                                 rng=rng, part=part):
+            image = decode_image(data, self.decode_size)
+            if self.transform is not None:
+                image = self.transform(image)
+            if self.target_transform is not None:
+                target = self.target_transform(target)
+            yield image, target
+
+
+def keras_batches(archive_dir, split, target_size, batch_size=32, datagen=None, shuffle=True,
+                  buffer_size=1000, seed=None, loop=True, interpolation=Image.NEAREST):
+    """Generator of ``(images, labels)`` numpy batches for ``model.fit``.
+
+    Mirrors ``datagen.flow_from_directory(..., class_mode='binary')``: images
+    are resized to ``target_size`` with the same nearest-neighbour resampling
+    Keras' ``load_img`` uses, then passed through ``datagen.random_transform``
+    and ``datagen.standardize`` when an ``ImageDataGenerator`` is given.
+    Loops over the archive forever unless ``loop=False``; pass
+    ``steps_per_epoch=len(archive) // batch_size`` to ``fit``.
+    """
+    archive = ShardArchive(archive_dir, split)
+    rng = random.Random(seed)
+
+    while True:
+        images, labels = [], []
+        for data, label in archive.records(shuffle=shuffle, buffer_size=buffer_size, rng=rng):
+            size = (target_size[1], target_size[0])
+            image = decode_image(data, size).resize(size, interpolation)
+            x = np.asarray(image, dtype=np.float32)
+            if datagen is not None:
+                x = datagen.standardize(datagen.random_transform(x))
+            images.append(x)
+            labels.append(label)
+            if len(images) == batch_size:
+                yield np.stack(images), np.asarray(labels, dtype=np.float32)
+                images, labels = [], []
+        if images:
+            yield np.stack(images), np.asarray(labels, dtype=np.float32)
+        if not loop:
+            return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack data/train and data/test into sequential shard files')
+    parser.add_argument('data_dir', help='directory holding the train/ and test/ ImageFolder roots')
+    parser.add_argument('archive_dir', help='output directory for the shards and manifests')
+    parser.add_argument('--splits', nargs='+', default=['train', 'test'])
+    parser.add_argument('--shard-size-mb', type=int, default=256)
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+
+    for split in args.splits:
+        manifest = pack_split(os.path.join(args.data_dir, split), args.archive_dir, split,
+                              shard_size=args.shard_size_mb * 1024 * 1024, overwrite=args.overwrite)
+        archive = ShardArchive(args.archive_dir, split)
+        print(f'{split}: {len(archive)} images in {len(archive.shards)} shards ({manifest})')
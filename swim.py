@@ -17,11 +17,50 @@ from sklearn.metrics import accuracy_score
 import numpy as np
 from google.colab import drive
 
+import image_loading
+from augmentation import BatchAugment
+from checkpointing import CheckpointManager
+from data_loading import make_loader
+from distributed_training import init_from_env, main_process_first
+from evaluation_cache import evaluate_cached
+from image_cache import CachedImageFolder
+from metrics import ConfusionMatrix
+from progressive_resizing import ProgressiveLoaders, ResolutionSchedule, TimeToAccuracy, set_resolution
+from training_engine import Trainer
+
 drive.mount('/content/drive')
 
-# Define image transformations
+# Decode JPEGs at reduced resolution (DCT scaling) before the final resize,
+# set to False to decode at full resolution
+image_loading.FAST_DECODE = True
+
+# Training engine settings: bfloat16 autocast (also on CPU), gradient accumulation
+# up to EFFECTIVE_BATCH_SIZE (None = one step per batch), optional torch.compile
+PRECISION = 'bf16'
+EFFECTIVE_BATCH_SIZE = None
+COMPILE_MODEL = False
+
+# Model outputs on the test set are computed once per weights and reused by every report
+EVAL_CACHE_DIR = '/content/drive/MyDrive/eval_cache'
+
+# Checkpoints (checkpointing.py) are written in the background every CHECKPOINT_EVERY_STEPS
+# optimizer steps and at the end of each epoch; a restarted run resumes from the latest one
+CHECKPOINT_DIR = '/content/drive/MyDrive/checkpoints/swim'
+CHECKPOINT_EVERY_STEPS = 200
+
+# Progressive resizing (progressive_resizing.py) for the fine-tuning run: 128px with larger
+# batches up to 224px over the first 10 epochs (Swin pads its windows at the smaller sizes);
+# validation is always at 224px. The time until TARGET_ACCURACY is printed either way
+PROGRESSIVE_RESIZING = False
+TARGET_ACCURACY = 0.85
+
+# Data-parallel training on N local CPU processes:
+#   python distributed_training.py launch --nproc N swim.py
+# Each rank trains on its shard of the data; without the launcher this does nothing
+init_from_env()
+
+# Define image transformations (images are pre-resized to 224x224 by the cache)
 transform = transforms.Compose([
-    transforms.Resize((224, 224)),
     transforms.ToTensor(),
     transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
 ])
@@ -30,16 +69,17 @@ transform = transforms.Compose([
 DATA_DIR = '/content/drive/MyDrive/data'  # Ensure this path matches your Google Drive setup
 
 # Load dataset (use corrected paths)
-train_data = datasets.ImageFolder(root=DATA_DIR + '/train', transform=transform)
-test_data = datasets.ImageFolder(root=DATA_DIR + '/test', transform=transform)
+with main_process_first():  # Rank 0 builds the image caches, the other ranks reuse them
+    train_data = CachedImageFolder(root=DATA_DIR + '/train', size=224, transform=transform)
+    test_data = CachedImageFolder(root=DATA_DIR + '/test', size=224, transform=transform)
 
 
 
 # Ensure this path matches your Google Drive setup
 MODEL_NAME = "microsoft/swin-tiny-patch4-window7-224"
 
-train_loader = DataLoader(train_data, batch_size=16, shuffle=True) # small no of epochs replicate
-test_loader = DataLoader(test_data, batch_size=16, shuffle=False)
+train_loader = make_loader(train_data, batch_size=16, shuffle=True, name='train') # small no of epochs replicate
+test_loader = make_loader(test_data, batch_size=16, shuffle=False, name='test')
 
 # Load Swin Transformer model with ignore_mismatched_sizes=True
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -56,55 +96,36 @@ model.classifier = nn.Linear(model.classifier.in_features, len(train_data.classe
 criterion = nn.CrossEntropyLoss()
 optimizer = optim.Adam(model.parameters(), lr=1e-4)
 
-# Training loop
+# Training loop (training_engine.py)
+checkpoints = CheckpointManager(CHECKPOINT_DIR, every_steps=CHECKPOINT_EVERY_STEPS)
+trainer = Trainer(model, optimizer, criterion, device, precision=PRECISION,
+                  effective_batch_size=EFFECTIVE_BATCH_SIZE, compile=COMPILE_MODEL, checkpoint=checkpoints)
 num_epochs = 50
-for epoch in range(num_epochs):
-    model.train()
-    running_loss = 0.0
-    for images, labels in train_loader:
-        images, labels = images.to(device), labels.to(device)
-
-        optimizer.zero_grad()
-        outputs = model(images).logits
-        loss = criterion(outputs, labels)
-        loss.backward()
-        optimizer.step()
-
-        running_loss += loss.item()
-
-    print(f"Epoch [{epoch+1}/{num_epochs}], Loss: {running_loss / len(train_loader):.4f}")
+for epoch in range(trainer.resume(), num_epochs):
+    train = trainer.train_epoch(train_loader)
+    print(f"Epoch [{epoch+1}/{num_epochs}], Loss: {train['loss']:.4f}")
+    trainer.save_checkpoint()
+checkpoints.wait()
 
 # Evaluation
-model.eval()
-all_preds, all_labels = [], []
-with torch.no_grad():
-    for images, labels in test_loader:
-        images, labels = images.to(device), labels.to(device)
-        outputs = model(images).logits
-        _, preds = torch.max(outputs, 1)
-        all_preds.extend(preds.cpu().numpy())
-        all_labels.extend(labels.cpu().numpy())
-
-accuracy = accuracy_score(all_labels, all_preds)
+results = evaluate_cached(EVAL_CACHE_DIR, 'swim-test', model.state_dict(), test_data,
+                          lambda: trainer.predict(test_loader), extra=PRECISION)  # One pass per weights
+metrics = ConfusionMatrix.from_matrix(results.confusion())
+
+accuracy = metrics.accuracy()
 print(f"Test Accuracy: {accuracy:.4f}")
 
 # Import necessary libraries for metrics
 from sklearn.metrics import accuracy_score, f1_score
 
 # Evaluation
-model.eval()
-all_preds, all_labels = [], []
-with torch.no_grad():
-    for images, labels in test_loader:
-        images, labels = images.to(device), labels.to(device)
-        outputs = model(images).logits
-        _, preds = torch.max(outputs, 1)
-        all_preds.extend(preds.cpu().numpy())
-        all_labels.extend(labels.cpu().numpy())
+results = evaluate_cached(EVAL_CACHE_DIR, 'swim-test', model.state_dict(), test_data,
+                          lambda: trainer.predict(test_loader), extra=PRECISION)  # One pass per weights
+metrics = ConfusionMatrix.from_matrix(results.confusion())
 
 # Calculate Accuracy and F1 Score
-accuracy = accuracy_score(all_labels, all_preds)
-f1 = f1_score(all_labels, all_preds, average='weighted')  # Use 'weighted' for multi-class, 'binary' for binary classification
+accuracy = metrics.accuracy()
+f1 = metrics.f1('weighted')  # Use 'weighted' for multi-class, 'binary' for binary classification
 
 print(f"Test Accuracy: {accuracy:.4f}")
 print(f"Test F1 Score: {f1:.4f}")
@@ -115,25 +136,19 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 
 # Evaluation
-model.eval()
-all_preds, all_labels = [], []
-with torch.no_grad():
-    for images, labels in test_loader:
-        images, labels = images.to(device), labels.to(device)
-        outputs = model(images).logits
-        _, preds = torch.max(outputs, 1)
-        all_preds.extend(preds.cpu().numpy())
-        all_labels.extend(labels.cpu().numpy())
+results = evaluate_cached(EVAL_CACHE_DIR, 'swim-test', model.state_dict(), test_data,
+                          lambda: trainer.predict(test_loader), extra=PRECISION)  # One pass per weights
+metrics = ConfusionMatrix.from_matrix(results.confusion())
 
 # Calculate Accuracy and F1 Score
-accuracy = accuracy_score(all_labels, all_preds)
-f1 = f1_score(all_labels, all_preds, average='weighted')  # Use 'weighted' for multi-class
+accuracy = metrics.accuracy()
+f1 = metrics.f1('weighted')  # Use 'weighted' for multi-class
 
 print(f"Test Accuracy: {accuracy:.4f}")
 print(f"Test F1 Score: {f1:.4f}")
 
 # Generate Confusion Matrix
-conf_matrix = confusion_matrix(all_labels, all_preds)
+conf_matrix = metrics.matrix
 
 # Plot the Confusion Matrix
 plt.figure(figsize=(8, 6))
@@ -163,7 +178,7 @@ model.eval()
 # Function to predict class of a single image
 def predict_image(image_path, model):
     # Load image
-    image = Image.open(image_path).convert('RGB')
+    image = image_loading.open_image(image_path, size=224)
 
     # Apply transformations
     image = test_transform(image)
@@ -200,30 +215,25 @@ from transformers import SwinForImageClassification
 from PIL import Image
 
 # Define transformations with data augmentation for training
-train_transform = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.RandomHorizontalFlip(),
-    transforms.RandomRotation(10),
-    transforms.ColorJitter(brightness=0.2, contrast=0.2, saturation=0.2, hue=0.1),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-])
+# (the 224x224 resize is already done by the decoded image cache). They run on
+# whole uint8 batches on the device and end with the ImageNet normalization.
+train_transform = BatchAugment(
+    hflip=True,
+    rotation=10,
+    brightness=0.2, contrast=0.2, saturation=0.2, hue=0.1,
+)
 
 # Transform for validation/testing
-test_transform = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-])
+cached_test_transform = BatchAugment()
 
 # Load datasets
 DATA_DIR = '/content/drive/MyDrive/data'
-train_data = datasets.ImageFolder(root=DATA_DIR + '/train', transform=train_transform)
-test_data = datasets.ImageFolder(root=DATA_DIR + '/test', transform=test_transform)
+train_data = CachedImageFolder(root=DATA_DIR + '/train', size=224, as_pil=False)
+test_data = CachedImageFolder(root=DATA_DIR + '/test', size=224, as_pil=False)
 
 # Data loaders
-train_loader = DataLoader(train_data, batch_size=16, shuffle=True)
-test_loader = DataLoader(test_data, batch_size=16, shuffle=False)
+train_loader = make_loader(train_data, batch_size=16, shuffle=True, name='train')
+test_loader = make_loader(test_data, batch_size=16, shuffle=False, name='test')
 
 # Load Swin Transformer model
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -236,6 +246,8 @@ model = SwinForImageClassification.from_pretrained(
 
 # Update classifier layer to match number of classes
 model.classifier = nn.Linear(model.classifier.in_features, len(train_data.classes)).to(device)
+train_transform.to(device)
+cached_test_transform.to(device)
 
 # Define loss function and optimizer with lower learning rate
 criterion = nn.CrossEntropyLoss()
@@ -244,49 +256,51 @@ scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=10, gamma=0.5)  # Hal
 
 # Training loop with accuracy and early stopping
 num_epochs = 50
-best_val_accuracy = 0.0
 patience = 5  # Early stopping patience
-stopping_counter = 0
-
-for epoch in range(num_epochs):
-    model.train()
-    running_loss = 0.0
-    correct, total = 0, 0
-
-    for images, labels in train_loader:
-        images, labels = images.to(device), labels.to(device)
 
-        optimizer.zero_grad()
-        outputs = model(images).logits
-        loss = criterion(outputs, labels)
-        loss.backward()
-        optimizer.step()
-
-        running_loss += loss.item()
-        _, predicted = torch.max(outputs, 1)
-        correct += (predicted == labels).sum().item()
-        total += labels.size(0)
-
-    train_accuracy = 100 * correct / total
-    avg_loss = running_loss / len(train_loader)
-    scheduler.step()  # Update learning rate
+checkpoints = CheckpointManager(CHECKPOINT_DIR + '-finetune', every_steps=CHECKPOINT_EVERY_STEPS)
+trainer = Trainer(model, optimizer, criterion, device, precision=PRECISION,
+                  effective_batch_size=EFFECTIVE_BATCH_SIZE, compile=COMPILE_MODEL,
+                  batch_transform=train_transform, scheduler=scheduler,  # Steps the scheduler every epoch
+                  checkpoint=checkpoints)
+start_epoch = trainer.resume()
+best_val_accuracy = checkpoints.best_metric or 0.0
+stopping_counter = trainer.extra or 0
+tracker = TimeToAccuracy()
+if PROGRESSIVE_RESIZING:
+    schedule = ResolutionSchedule(final_size=224, epochs=num_epochs, start_size=128, ramp=0.2, base_batch_size=16)
+    print(f'Progressive resizing: {schedule}')
+    loaders = ProgressiveLoaders(train_data, name='train')
+
+for epoch in range(start_epoch, num_epochs):
+    if PROGRESSIVE_RESIZING:
+        stage = schedule.stage(epoch)
+        train_transform.size = stage.size
+        set_resolution(model, stage.size)
+        train_loader = loaders.get(stage.batch_size)
+    train = trainer.train_epoch(train_loader)
+    train_accuracy = 100 * train['accuracy']
+    avg_loss = train['loss']
 
     print(f"Epoch [{epoch+1}/{num_epochs}], Loss: {avg_loss:.4f}, Train Accuracy: {train_accuracy:.2f}%")
 
     # Validation
+    if PROGRESSIVE_RESIZING:
+        set_resolution(model, schedule.final_size)
     model.eval()
-    all_preds, all_labels = [], []
+    metrics = ConfusionMatrix(len(train_data.classes), device)  # Running confusion matrix on the device
     with torch.no_grad():
         for images, labels in test_loader:
-            images, labels = images.to(device), labels.to(device)
+            images, labels = cached_test_transform(images.to(device)), labels.to(device)
             outputs = model(images).logits
             _, preds = torch.max(outputs, 1)
-            all_preds.extend(preds.cpu().numpy())
-            all_labels.extend(labels.cpu().numpy())
+            metrics.update(preds, labels)
+    metrics.all_reduce()  # Counts of every rank's shard of the test set
 
     # Calculate metrics
-    val_accuracy = accuracy_score(all_labels, all_preds)
-    val_f1 = f1_score(all_labels, all_preds, average='weighted')
+    val_accuracy = metrics.accuracy()
+    val_f1 = metrics.f1('weighted')
+    tracker.record(val_accuracy)
 
     print(f"Validation Accuracy: {val_accuracy:.4f}, Validation F1 Score: {val_f1:.4f}")
 
@@ -296,30 +310,28 @@ for epoch in range(num_epochs):
         stopping_counter = 0  # Reset counter if validation accuracy improves
     else:
         stopping_counter += 1
-        if stopping_counter >= patience:
-            print("Early stopping triggered.")
-            break
+    trainer.save_checkpoint(metric=val_accuracy, extra=stopping_counter)
+    if stopping_counter >= patience:
+        print("Early stopping triggered.")
+        break
+checkpoints.wait()
+tracker.report(TARGET_ACCURACY, 'progressive' if PROGRESSIVE_RESIZING else 'fixed resolution')
 
 # Final evaluation on the test set with confusion matrix
-model.eval()
-all_preds, all_labels = [], []
-with torch.no_grad():
-    for images, labels in test_loader:
-        images, labels = images.to(device), labels.to(device)
-        outputs = model(images).logits
-        _, preds = torch.max(outputs, 1)
-        all_preds.extend(preds.cpu().numpy())
-        all_labels.extend(labels.cpu().numpy())
+results = evaluate_cached(EVAL_CACHE_DIR, 'swim-test', model.state_dict(), test_data,
+                          lambda: trainer.predict(test_loader, transform=cached_test_transform),
+                          transform=cached_test_transform, extra=PRECISION)
+metrics = ConfusionMatrix.from_matrix(results.confusion())
 
 # Final test metrics
-test_accuracy = accuracy_score(all_labels, all_preds)
-test_f1 = f1_score(all_labels, all_preds, average='weighted')
+test_accuracy = metrics.accuracy()
+test_f1 = metrics.f1('weighted')
 
 print(f"Test Accuracy: {test_accuracy:.4f}")
 print(f"Test F1 Score: {test_f1:.4f}")
 
 # Confusion Matrix
-conf_matrix = confusion_matrix(all_labels, all_preds)
+conf_matrix = metrics.matrix
 plt.figure(figsize=(8, 6))
 sns.heatmap(conf_matrix, annot=True, fmt='d', cmap='Blues', cbar=False,
             xticklabels=train_data.classes, yticklabels=train_data.classes)
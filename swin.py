@@ -27,7 +27,7 @@ import torch
 import torch.nn as nn
 import torchvision.models as models
 from torch.optim import Adam
-from torch.utils.data import random_split
+from torch.utils.data import Subset
 
 import torch
 import torch.nn as nn
@@ -46,19 +46,67 @@ from sklearn.metrics import accuracy_score
 import numpy as np
 from google.colab import drive
 
+import image_loading
+from augmentation import BatchAugment
+from checkpointing import CheckpointManager
+from data_loading import make_loader
+from distributed_training import init_from_env, is_main_process, main_process_first
+from evaluation_cache import evaluate_cached
+from gradual_unfreezing import GradualUnfreezer
+from image_cache import CachedImageFolder
+from metrics import ConfusionMatrix
+from progressive_resizing import ProgressiveLoaders, ResolutionSchedule, TimeToAccuracy, set_resolution
+from shard_archive import ShardedImageDataset, pack_split
+from training_engine import Trainer, param_groups
+
 drive.mount('/content/drive')
 
+# Decode JPEGs at reduced resolution (DCT scaling) before the final resize,
+# set to False to decode at full resolution
+image_loading.FAST_DECODE = True
+
+# Training engine settings: bfloat16 autocast (also on CPU), gradient accumulation
+# up to EFFECTIVE_BATCH_SIZE (None = one step per batch), optional torch.compile
+PRECISION = 'bf16'
+EFFECTIVE_BATCH_SIZE = None
+COMPILE_MODEL = False
+
+# Model outputs on the test set are computed once per weights and reused by every report
+EVAL_CACHE_DIR = '/content/drive/MyDrive/eval_cache'
+
+# Checkpoints (checkpointing.py) are written in the background every CHECKPOINT_EVERY_STEPS
+# optimizer steps and at the end of each epoch; a restarted run resumes from the latest one
+CHECKPOINT_DIR = '/content/drive/MyDrive/checkpoints/swin'
+CHECKPOINT_EVERY_STEPS = 200
+
+# Progressive resizing (progressive_resizing.py): EfficientNet trains from 128px with larger
+# batches up to 224px over the first half of the run; validation is always at 224px.
+# The time until TARGET_ACCURACY is printed either way, to compare with the fixed-size run
+PROGRESSIVE_RESIZING = False
+TARGET_ACCURACY = 0.85
 
+# Gradual unfreezing (gradual_unfreezing.py): the classifier trains alone at first, then
+# EfficientNet's stages 8, 7, 6 and finally the rest of `features` join at the epochs in
+# UNFREEZE_AT. Frozen stages get no backward pass and no Adam state. None trains everything
+UNFREEZE_AT = None  # e.g. [1, 3, 5, 8]
 
+# Data-parallel training on N local CPU processes:
+#   python distributed_training.py launch --nproc N swin.py
+# Each rank trains on its shard of the data; without the launcher this does nothing
+init_from_env()
+
+
+
+# Images come pre-resized to 224x224 from the decoded image cache
 transform = transforms.Compose([
-    transforms.Resize((224, 224)),
     transforms.ToTensor(),
 ])
-train_data = datasets.ImageFolder(root='/content/drive/MyDrive/data/train', transform=transform)
-test_data = datasets.ImageFolder(root='/content/drive/MyDrive/data/test', transform=transform)
+with main_process_first():  # Rank 0 builds the image caches, the other ranks reuse them
+    train_data = CachedImageFolder(root='/content/drive/MyDrive/data/train', size=224, transform=transform)
+    test_data = CachedImageFolder(root='/content/drive/MyDrive/data/test', size=224, transform=transform)
 
-train_loader = DataLoader(train_data, batch_size=32, shuffle=True)
-test_loader = DataLoader(test_data, batch_size=32)
+train_loader = make_loader(train_data, batch_size=32, shuffle=True, name='train')
+test_loader = make_loader(test_data, batch_size=32, name='test')
 
 def imshow(img):
     img = img / 2 + 0.5  # Desnormalizar
@@ -98,66 +146,60 @@ def plot_color_histogram(image_path):
     plt.ylabel('Frequency')
     plt.show()
 
-def train_model(model, train_loader, val_loader, criterion, optimizer, num_epochs, lr, save_metrics=True):
+def train_model(model, train_loader, val_loader, criterion, optimizer, num_epochs, lr, save_metrics=True,
+                train_transform=None, val_transform=None, schedule=None, unfreezer=None):
 
     history = {
-        c
+        'train_loss': [], 'train_acc': [], 'train_f1': [], 'train_precision': [], 'train_recall': [],
+        'val_loss': [], 'val_acc': [], 'val_f1': [], 'val_precision': [], 'val_recall': []
     }
 
-    for epoch in range(num_epochs):
+    # Shared loop (training_engine.py): autocast, gradient accumulation, throughput report
+    checkpoints = CheckpointManager(CHECKPOINT_DIR, every_steps=CHECKPOINT_EVERY_STEPS)
+    trainer = Trainer(model, optimizer, criterion, device, precision=PRECISION,
+                      effective_batch_size=EFFECTIVE_BATCH_SIZE, compile=COMPILE_MODEL,
+                      batch_transform=train_transform, checkpoint=checkpoints, unfreezer=unfreezer)
+    start_epoch = trainer.resume()
+    history = trainer.extra or history  # Metrics of the epochs before the restart
+    tracker = TimeToAccuracy()
+    if schedule is not None:
+        print(f'Progressive resizing: {schedule}')
+        loaders = ProgressiveLoaders(train_loader.dataset, name='train')
+
+    for epoch in range(start_epoch, num_epochs):
+        if schedule is not None:
+            stage = schedule.stage(epoch)
+            train_transform.size = stage.size  # Augmentation resizes the batch on the device
+            set_resolution(model, stage.size)
+            train_loader = loaders.get(stage.batch_size)
+
         # --- Treinamento ---
-        model.train()
-        train_loss = 0.0
-        all_preds = []
-        all_labels = []
-
-        for inputs, labels in train_loader:
-            inputs, labels = inputs.to(device), labels.to(device)
-
-            optimizer.zero_grad()
-            outputs = model(inputs)
-            loss = criterion(outputs, labels)
-            loss.backward()
-            optimizer.step()
-
-            train_loss += loss.item()
-            _, preds = torch.max(outputs, 1)
-            all_preds.extend(preds.cpu().numpy())
-            all_labels.extend(labels.cpu().numpy())
-
-        train_acc = accuracy_score(all_labels, all_preds)
-        train_f1 = f1_score(all_labels, all_preds, average='weighted')
-        train_precision = precision_score(all_labels, all_preds, average='weighted')
-        train_recall = recall_score(all_labels, all_preds, average='weighted')
-
-        history['train_loss'].append(train_loss / len(train_loader))
+        train = trainer.train_epoch(train_loader)
+        metrics = train['metrics']  # Confusion matrix accumulated on the device
+
+        train_acc = metrics.accuracy()
+        train_f1 = metrics.f1('weighted')
+        train_precision = metrics.precision('weighted')
+        train_recall = metrics.recall('weighted')
+
+        history['train_loss'].append(train['loss'])
         history['train_acc'].append(train_acc)
         history['train_f1'].append(train_f1)
         history['train_precision'].append(train_precision)
         history['train_recall'].append(train_recall)
 
-        model.eval()
-        val_loss = 0.0
-        all_preds = []
-        all_labels = []
-
-        with torch.no_grad():
-            for inputs, labels in val_loader:
-                inputs, labels = inputs.to(device), labels.to(device)
-                outputs = model(inputs)
-                loss = criterion(outputs, labels)
-                val_loss += loss.item()
-
-                _, preds = torch.max(outputs, 1)
-                all_preds.extend(preds.cpu().numpy())
-                all_labels.extend(labels.cpu().numpy())
+        if schedule is not None:
+            set_resolution(model, schedule.final_size)
+        val = trainer.evaluate(val_loader, transform=val_transform)
+        metrics = val['metrics']
 
-        val_acc = accuracy_score(all_labels, all_preds)
-        val_f1 = f1_score(all_labels, all_preds, average='weighted')
-        val_precision = precision_score(all_labels, all_preds, average='weighted')
-        val_recall = recall_score(all_labels, all_preds, average='weighted')
+        val_acc = metrics.accuracy()
+        tracker.record(val_acc)
+        val_f1 = metrics.f1('weighted')
+        val_precision = metrics.precision('weighted')
+        val_recall = metrics.recall('weighted')
 
-        history['val_loss'].append(val_loss / len(val_loader))
+        history['val_loss'].append(val['loss'])
         history['val_acc'].append(val_acc)
         history['val_f1'].append(val_f1)
         history['val_precision'].append(val_precision)
@@ -166,8 +208,15 @@ def train_model(model, train_loader, val_loader, criterion, optimizer, num_epoch
         print(f'Epoch [{epoch+1}/{num_epochs}]')
         print(f'Train - Loss: {history["train_loss"][-1]:.4f}, Acc: {history["train_acc"][-1]:.4f}, F1: {history["train_f1"][-1]:.4f}, Precision: {history["train_precision"][-1]:.4f}, Recall: {history["train_recall"][-1]:.4f}')
         print(f'Val   - Loss: {history["val_loss"][-1]:.4f}, Acc: {history["val_acc"][-1]:.4f}, F1: {history["val_f1"][-1]:.4f}, Precision: {history["val_precision"][-1]:.4f}, Recall: {history["val_recall"][-1]:.4f}')
+        trainer.save_checkpoint(metric=val_acc, extra=history)
 
-    if save_metrics:
+    checkpoints.close()
+    if is_main_process():
+        tracker.report(TARGET_ACCURACY, 'progressive' if schedule is not None else 'fixed resolution')
+        if unfreezer is not None:
+            unfreezer.report()  # Step time and gradient + optimizer memory per phase
+
+    if save_metrics and is_main_process():
         torch.save(history, 'training_history.pth')
 
     return history
@@ -223,39 +272,22 @@ def plot_metrics(history):
     plt.tight_layout()
     plt.show()
 
-def test_model_with_metrics(model, test_loader):
-    model.eval()
-    correct = 0
-    total = 0
-    test_loss = 0.0
-
-    all_preds = []
-    all_labels = []
-
+def evaluate_test_set(model, test_loader):
+    # One inference pass per model weights (evaluation_cache.py), shared by the functions below
+    trainer = Trainer(model, None, criterion, device, precision=PRECISION)
+    return evaluate_cached(EVAL_CACHE_DIR, 'swin-test', model.state_dict(), test_loader.dataset,
+                           lambda: trainer.predict(test_loader), extra=PRECISION)
 
-    with torch.no_grad():
-        for inputs, labels in test_loader:
-            inputs, labels = inputs.to(device), labels.to(device)
-
-
-            outputs = model(inputs)
-
-
-            loss = criterion(outputs, labels)
-            test_loss += loss.item()
-
-
-            _, predicted = torch.max(outputs, 1)
-
-            all_preds.extend(predicted.cpu().numpy())
-            all_labels.extend(labels.cpu().numpy())
+def test_model_with_metrics(model, test_loader):
+    results = evaluate_test_set(model, test_loader)
+    metrics = ConfusionMatrix.from_matrix(results.confusion())
 
-    accuracy = accuracy_score(all_labels, all_preds)
-    precision = precision_score(all_labels, all_preds, average='weighted')
-    recall = recall_score(all_labels, all_preds, average='weighted')
-    f1 = f1_score(all_labels, all_preds, average='weighted')
+    accuracy = metrics.accuracy()
+    precision = metrics.precision('weighted')
+    recall = metrics.recall('weighted')
+    f1 = metrics.f1('weighted')
 
-    print(f'Test Loss: {test_loss/len(test_loader):.4f}')
+    print(f'Test Loss: {results.log_loss():.4f}')
     print(f'Test Accuracy: {accuracy * 100:.2f}%')
     print(f'Precision: {precision:.4f}')
     print(f'Recall: {recall:.4f}')
@@ -264,22 +296,7 @@ def test_model_with_metrics(model, test_loader):
     return accuracy, precision, recall, f1
 
 def plot_confusion_matrix(model, test_loader, class_names):
-    model.eval()
-    all_preds = []
-    all_labels = []
-
-    with torch.no_grad():
-        for inputs, labels in test_loader:
-            inputs, labels = inputs.to(device), labels.to(device)
-
-            outputs = model(inputs)
-
-            _, predicted = torch.max(outputs, 1)
-
-            all_preds.extend(predicted.cpu().numpy())
-            all_labels.extend(labels.cpu().numpy())
-
-    cm = confusion_matrix(all_labels, all_preds)
+    cm = evaluate_test_set(model, test_loader).confusion()
 
     plt.figure(figsize=(8, 6))
     sns.heatmap(cm, annot=True, fmt="d", cmap="Blues", xticklabels=class_names, yticklabels=class_names)
@@ -289,13 +306,14 @@ def plot_confusion_matrix(model, test_loader, class_names):
     plt.show()
 
 class_names = train_data.classes
-class_counts = [len(os.listdir(os.path.join('/content/drive/MyDrive/data/train', cls))) for cls in class_names]
+# Counted from the dataset labels instead of listing every class directory
+class_counts = np.bincount(train_data.targets, minlength=len(class_names))
 
 plt.bar(class_names, class_counts)
 plt.title('Training Set Distribution')
 plt.show()
 
-class_counts = [len(os.listdir(os.path.join('/content/drive/MyDrive/data/test', cls))) for cls in class_names]
+class_counts = np.bincount(test_data.targets, minlength=len(class_names))
 
 plt.bar(class_names, class_counts)
 plt.title('Test Set Distribution')
@@ -314,15 +332,15 @@ sample_image_path_malignant = '/content/drive/MyDrive/data/test/malignant/1120.j
 plot_color_histogram(sample_image_path_benign)
 plot_color_histogram(sample_image_path_malignant)
 
-train_transforms = transforms.Compose([
-    transforms.RandomResizedCrop(224),
-    transforms.RandomRotation(20),
-    transforms.RandomHorizontalFlip(),
-    transforms.RandomVerticalFlip(),
-    transforms.ColorJitter(brightness=0.2, contrast=0.2, saturation=0.2),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-])
+# Training augmentation runs on whole uint8 batches after collation
+train_transforms = BatchAugment(
+    resized_crop=((0.08, 1.0), (3 / 4, 4 / 3)),  # RandomResizedCrop(224) defaults
+    rotation=20,
+    hflip=True,
+    vflip=True,
+    brightness=0.2, contrast=0.2, saturation=0.2,
+)
+val_transforms = BatchAugment()
 
 test_transforms = transforms.Compose([
     transforms.Resize(256),
@@ -331,16 +349,21 @@ test_transforms = transforms.Compose([
     transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
 ])
 
-train_dataset = datasets.ImageFolder(root='/content/drive/MyDrive/data/train', transform=train_transforms)
-test_dataset = datasets.ImageFolder(root='/content/drive/MyDrive/data/test', transform=test_transforms)
+# The test images are streamed from the sequential shard archive (packed on first use)
+SHARD_DIR = '/content/drive/MyDrive/shards'
+with main_process_first():  # Cache, shards and manifest are written by rank 0 only
+    train_dataset = CachedImageFolder(root='/content/drive/MyDrive/data/train', size=224, as_pil=False)
+    pack_split('/content/drive/MyDrive/data/test', SHARD_DIR, 'test')
+test_dataset = ShardedImageDataset(SHARD_DIR, 'test', transform=test_transforms, decode_size=256)
 
-train_size = int(0.8 * len(train_dataset))  # 80% treino
-val_size = len(train_dataset) - train_size  # 20% validação
-train_data, val_data = random_split(train_dataset, [train_size, val_size])
+# 80% treino / 20% validação, assigned by the content hashes recorded in the cache
+# (rebuilt whenever the dataset manifest changes) so the split is identical on every run
+train_indices, val_indices = train_dataset.split(0.2)
+train_data, val_data = Subset(train_dataset, train_indices), Subset(train_dataset, val_indices)
 
-train_loader = DataLoader(train_data, batch_size=32, shuffle=True)
-val_loader = DataLoader(val_data, batch_size=32)
-test_loader = DataLoader(test_dataset, batch_size=32)
+train_loader = make_loader(train_data, batch_size=32, shuffle=True, name='train')
+val_loader = make_loader(val_data, batch_size=32, name='val')
+test_loader = make_loader(test_dataset, batch_size=32, name='test')
 
 model = models.efficientnet_b0(pretrained=True)
 
@@ -348,14 +371,18 @@ num_features = model.classifier[1].in_features
 model.classifier[1] = nn.Linear(num_features, 2)
 
 criterion = nn.CrossEntropyLoss()
-optimizer = torch.optim.Adam([
-    {'params': model.features.parameters(), 'lr': 1e-5},
-    {'params': model.classifier.parameters(), 'lr': 1e-3}
-])
+optimizer = torch.optim.Adam(param_groups(model, {'features': 1e-5, 'classifier': 1e-3}))
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 model = model.to(device)
-
-history = train_model(model, train_loader, val_loader,criterion,optimizer, num_epochs=15, lr = 0.001)
+train_transforms.to(device)
+val_transforms.to(device)
+
+schedule = ResolutionSchedule(final_size=224, epochs=15, start_size=128, base_batch_size=32) if PROGRESSIVE_RESIZING else None
+unfreezer = GradualUnfreezer(model, optimizer, ['features.8', 'features.7', 'features.6', 'features'],
+                             unfreeze_at=UNFREEZE_AT) if UNFREEZE_AT else None
+history = train_model(model, train_loader, val_loader,criterion,optimizer, num_epochs=15, lr = 0.001,
+                      train_transform=train_transforms, val_transform=val_transforms, schedule=schedule,
+                      unfreezer=unfreezer)
 
 plot_metrics(history)
 
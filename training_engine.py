@@ -0,0 +1,400 @@
+"""Shared training/evaluation loop for the PyTorch scripts.
+
+swin.py, swim.py and hybrid_model.py all train through ``Trainer`` instead of
+their own copies of the loop:
+
+    trainer = Trainer(model, optimizer, criterion, device, precision='bf16',
+                      effective_batch_size=64, batch_transform=train_transforms)
+    for epoch in range(num_epochs):
+        train = trainer.train_epoch(train_loader)       # loss, accuracy, metrics
+        val = trainer.evaluate(val_loader, transform=val_transforms)
+
+- ``precision='bf16'`` runs forward and loss under ``torch.autocast`` with
+  bfloat16, on CPU as well as CUDA (fast on CPUs with AVX512-BF16/AMX).
+  Weights, gradients and the optimizer state stay float32.
+- ``effective_batch_size`` accumulates gradients over several loader batches
+  and steps the optimizer once per effective batch.
+- ``compile=True`` wraps the model in ``torch.compile`` where available.
+- Losses and a running confusion matrix (``metrics.ConfusionMatrix``) stay
+  on the device during the epoch and are read back once at the end, not
+  with ``.item()`` on every step.
+
+Every epoch prints images/sec and the mean step time split into data wait,
+forward, backward and optimizer step. On CUDA the split is only exact with
+``sync_timing=True``, as kernels otherwise run asynchronously.
+
+With a ``checkpointing.CheckpointManager`` the trainer snapshots the run
+every ``every_steps`` optimizer steps and on ``save_checkpoint()``;
+``resume()`` restores the latest snapshot, including the position within
+the epoch, and returns the epoch to continue from.
+
+In a data-parallel job (distributed_training.py) the model is wrapped in
+``DistributedDataParallel``; for loaders sharded by ``make_loader`` the loss,
+image counts and confusion matrices are summed over the ranks and
+``predict`` gathers every rank's outputs, so all results describe the whole
+dataset. Only rank 0 prints and writes checkpoints.
+
+With a ``gradual_unfreezing.GradualUnfreezer`` the trainer applies its
+phase at the start of every epoch (and before restoring a checkpointed
+optimizer state) and records each epoch's timings for its per-phase report.
+
+``param_groups`` builds per-module learning rates, e.g. EfficientNet's
+``features``/``classifier`` split:
+
+    optimizer = torch.optim.Adam(param_groups(model, {'features': 1e-5, 'classifier': 1e-3}))
+"""
+
+import contextlib
+import math
+import time
+
+import torch
+from torch.nn.parallel import DistributedDataParallel
+
+from checkpointing import rng_state, set_rng_state
+from distributed_training import all_reduce_max, all_reduce_sum, broadcast_buffers, gather_sharded, is_main_process, world_size
+from metrics import ConfusionMatrix
+
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def param_groups(model, learning_rates, default_lr=None):
+    """Optimizer parameter groups from ``{module name prefix: lr}``.
+
+    Every trainable parameter goes to the group of the longest matching
+    prefix; the rest get ``default_lr`` (an error if it is None).
+    """
+    groups = {prefix: [] for prefix in learning_rates}
+    rest = []
+    for name, parameter in model.named_parameters():
+        if not parameter.requires_grad:
+            continue
+        matches = [prefix for prefix in learning_rates if name == prefix or name.startswith(prefix + '.')]
+        if matches:
+            groups[max(matches, key=len)].append(parameter)
+        else:
+            rest.append(parameter)
+
+    result = [{'params': params, 'lr': learning_rates[prefix]} for prefix, params in groups.items() if params]
+    if rest:
+        if default_lr is None:
+            raise ValueError(f'{len(rest)} parameters match none of {sorted(learning_rates)} and no default_lr is set')
+        result.append({'params': rest, 'lr': default_lr})
+    return result
+
+
+def logits_of(outputs):
+    # Hugging Face models return an output object with .logits
+    return outputs.logits if hasattr(outputs, 'logits') else outputs
+
+
+class Trainer:
+    """Runs training epochs and evaluation passes for one model.
+
+    ``batch_transform`` is applied to every training batch on the device
+    (e.g. a ``BatchAugment``). ``scheduler`` is stepped once per epoch.
+    ``checkpoint`` is an optional ``CheckpointManager``, ``unfreezer`` an
+    optional ``GradualUnfreezer``.
+    """
+
+    def __init__(self, model, optimizer, criterion, device, precision='fp32', effective_batch_size=None,
+                 compile=False, batch_transform=None, scheduler=None, sync_timing=False, name='train',
+                 checkpoint=None, unfreezer=None):
+        if precision not in PRECISIONS:
+            raise ValueError(f'precision must be one of {sorted(PRECISIONS)}, got {precision!r}')
+        self.model = model
+        self.optimizer = optimizer
+        self.criterion = criterion
+        self.device = torch.device(device)
+        self.precision = precision
+        self.effective_batch_size = effective_batch_size
+        self.batch_transform = batch_transform
+        self.scheduler = scheduler
+        self.sync_timing = sync_timing and self.device.type == 'cuda'
+        self.name = name
+        self.history = []
+        self.checkpoint = checkpoint
+        self.epoch = 0
+        self.global_step = 0  # Optimizer steps over the whole run
+        self._resume = None
+        self.extra = None
+        self._sampler_seed = None
+        self.compile = compile
+        self.unfreezer = unfreezer
+        self._wrap_model()
+
+    def _wrap_model(self):
+        model = self.model
+        self.forward_model = self.eval_model = model
+        self._ddp = None
+        if world_size() > 1:
+            # Gradients are all-reduced across the ranks during backward. Evaluation
+            # runs on the plain model, as the ranks may hold different numbers of batches.
+            # DDP registers the parameters that require grad, so unfreezing re-wraps it
+            self.forward_model = self._ddp = DistributedDataParallel(model)
+        if self.compile and hasattr(torch, 'compile'):
+            self.forward_model = torch.compile(self.forward_model)
+            self.eval_model = torch.compile(model) if self._ddp is not None else self.forward_model
+
+    def autocast(self):
+        dtype = PRECISIONS[self.precision]
+        return torch.autocast(device_type=self.device.type, dtype=dtype or torch.float32, enabled=dtype is not None)
+
+    def _clock(self):
+        if self.sync_timing:
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def accumulation_steps(self, loader):
+        if not self.effective_batch_size:
+            return 1
+        return max(1, math.ceil(self.effective_batch_size / loader.batch_size))
+
+    def _state(self, batch=0, progress=None):
+        return {
+            'model': self.model.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': self.scheduler.state_dict() if self.scheduler is not None else None,
+            'rng': rng_state(),
+            'epoch': self.epoch,
+            'batch': batch,  # Next batch of `epoch` to train on
+            'global_step': self.global_step,
+            'sampler_seed': self._sampler_seed,
+            'progress': progress,  # Loss and confusion counts of the partial epoch
+            'history': [{key: result[key] for key in ('loss', 'accuracy', 'images_per_sec')}
+                        for result in self.history],
+            'extra': self.extra,  # As of the last epoch-end save, also in mid-epoch snapshots
+        }
+
+    def save_checkpoint(self, metric=None, extra=None):
+        """Snapshot at an epoch boundary; ``metric`` (e.g. validation
+        accuracy) decides whether it becomes ``best.pt``. ``extra`` (e.g. the
+        script's metric history) is given back as ``trainer.extra`` on resume."""
+        self.extra = extra
+        if not is_main_process():
+            return
+        self.checkpoint.save(self.global_step, self._state(), metric=metric)
+
+    def resume(self):
+        """Restores the latest checkpoint, if any, and returns the epoch to
+        continue from (0 for a fresh run)."""
+        state = self.checkpoint.load() if self.checkpoint is not None else None
+        if state is None:
+            return 0
+        self.model.load_state_dict(state['model'])
+        if self.unfreezer is not None and self.unfreezer.update(state['epoch']):
+            self._wrap_model()  # The optimizer has the saved phase's parameter groups again
+        self.optimizer.load_state_dict(state['optimizer'])
+        if self.scheduler is not None and state['scheduler'] is not None:
+            self.scheduler.load_state_dict(state['scheduler'])
+        self.epoch, self.global_step = state['epoch'], state['global_step']
+        self._sampler_seed = state['sampler_seed']
+        self.history = state['history']
+        self.extra = state.get('extra')
+        # Applied by the next train_epoch, after the loader has started its workers
+        self._resume = {'batch': state['batch'], 'progress': state['progress'], 'rng': state['rng']}
+        print(f"[{self.name}] resumed at epoch {self.epoch + 1}, batch {state['batch']} "
+              f"(step {self.global_step}) from {self.checkpoint.directory}")
+        return self.epoch
+
+    def _position_sampler(self, loader, start_batch):
+        # Same permutation as the interrupted epoch, without the batches already done
+        sampler = getattr(loader, 'sampler', None)
+        if not hasattr(sampler, 'set_epoch'):
+            return False
+        if self._sampler_seed is None:
+            self._sampler_seed = sampler.seed
+        sampler.seed = self._sampler_seed
+        sampler.set_epoch(self.epoch)
+        sampler.skip(start_batch * loader.batch_size)
+        return True
+
+    def train_epoch(self, loader):
+        """One pass over ``loader``. Returns a dict with the mean ``loss``,
+        ``accuracy``, the epoch's ``metrics`` (a ``ConfusionMatrix``) and timings."""
+        self.model.train()
+        if self.unfreezer is not None and self.unfreezer.update(self.epoch):
+            self._wrap_model()
+        steps = self.accumulation_steps(loader)
+        num_batches = len(loader)
+
+        total_loss = torch.zeros((), device=self.device)
+        metrics = None
+        timings = {'data': 0.0, 'forward': 0.0, 'backward': 0.0, 'optimizer': 0.0}
+        images_seen = 0
+
+        sharded = getattr(loader, 'sharded', False)
+        resume, self._resume = self._resume, None
+        start_batch = resume['batch'] if resume is not None else 0
+        # Saved progress is already summed over the ranks, so only rank 0 restores it
+        if resume is not None and resume['progress'] is not None and (is_main_process() or not sharded):
+            progress = resume['progress']
+            total_loss += progress['loss'].to(self.device)
+            metrics = ConfusionMatrix.from_matrix(progress['confusion'], self.device)
+            images_seen = progress['images']
+
+        positioned = self._position_sampler(loader, start_batch)  # Before the loader draws its indices
+        batches = iter(loader)
+        if not positioned:
+            # Unknown sampler: fall back to reading and dropping the finished batches
+            for _ in range(start_batch):
+                next(batches)
+
+        self.optimizer.zero_grad(set_to_none=True)
+        start = fetch_start = self._clock()
+        for i, (inputs, labels) in enumerate(batches, start=start_batch):
+            if resume is not None:
+                # Starting the loader consumes random numbers, so the RNG is restored after the first fetch
+                set_rng_state(resume['rng'])
+                resume = None
+            inputs = inputs.to(self.device, non_blocking=True)
+            labels = labels.to(self.device, non_blocking=True)
+            if self.batch_transform is not None:
+                inputs = self.batch_transform(inputs)
+            t_forward = self._clock()
+            timings['data'] += t_forward - fetch_start
+
+            # The last group of an epoch may hold fewer batches than `steps`
+            group_size = min(steps, num_batches - (i // steps) * steps)
+            stepping = (i + 1) % steps == 0 or i + 1 == num_batches
+            # Gradients are only all-reduced on the last micro-batch of a group
+            with self._ddp.no_sync() if self._ddp is not None and not stepping else contextlib.nullcontext():
+                with self.autocast():
+                    outputs = logits_of(self.forward_model(inputs))
+                    loss = self.criterion(outputs.float(), labels)
+                t_backward = self._clock()
+                (loss / group_size).backward()
+            t_optimizer = self._clock()
+
+            if stepping:
+                self.optimizer.step()
+                self.optimizer.zero_grad(set_to_none=True)
+                self.global_step += 1
+                if (self.checkpoint is not None and self.checkpoint.every_steps
+                        and self.global_step % self.checkpoint.every_steps == 0 and i + 1 < num_batches):
+                    progress = {'loss': total_loss + loss.detach(), 'images': images_seen + labels.size(0),
+                                'confusion': self._confusion_with(metrics, outputs, labels)}
+                    if sharded:
+                        progress = self._all_reduce_progress(progress)
+                    if is_main_process():
+                        self.checkpoint.save(self.global_step, self._state(i + 1, progress))
+            fetch_start = self._clock()
+
+            timings['forward'] += t_backward - t_forward
+            timings['backward'] += t_optimizer - t_backward
+            timings['optimizer'] += fetch_start - t_optimizer
+
+            if metrics is None:
+                metrics = ConfusionMatrix(outputs.size(1), self.device)
+            metrics.update(outputs.detach().argmax(dim=1), labels)
+            total_loss += loss.detach()
+            images_seen += labels.size(0)
+
+        if self.scheduler is not None:
+            self.scheduler.step()
+        self.epoch += 1
+
+        if sharded:
+            # Every rank ran num_batches batches of its own shard
+            all_reduce_sum(total_loss)
+            images_seen = int(all_reduce_sum(torch.tensor(images_seen)).item())
+            metrics = self._all_reduce_metrics(metrics)
+            num_batches *= world_size()
+
+        elapsed = time.perf_counter() - start
+        result = {
+            'loss': total_loss.item() / max(1, num_batches),  # Single sync per epoch
+            'accuracy': metrics.accuracy() if metrics is not None else 0.0,
+            'metrics': metrics,
+            'images_per_sec': images_seen / elapsed if elapsed > 0 else 0.0,
+            'step_ms': {phase: 1000 * t / max(1, num_batches) for phase, t in timings.items()},
+            'accumulation_steps': steps,
+        }
+        self.history.append(result)
+        if self.unfreezer is not None:
+            self.unfreezer.record(result)
+        self.report(result)
+        return result
+
+    @staticmethod
+    def _all_reduce_progress(progress):
+        confusion = torch.as_tensor(progress['confusion'])
+        return {'loss': all_reduce_sum(progress['loss'].clone()),
+                'images': int(all_reduce_sum(torch.tensor(progress['images'])).item()),
+                'confusion': all_reduce_sum(confusion).numpy()}
+
+    def _all_reduce_metrics(self, metrics):
+        # A rank whose shard is empty has no matrix yet (its size comes from the first batch's
+        # outputs); it takes the class count from the other ranks and contributes zeros
+        num_classes = torch.tensor(metrics.num_classes if metrics is not None else 0, device=self.device)
+        all_reduce_max(num_classes)
+        if metrics is None:
+            metrics = ConfusionMatrix(int(num_classes.item()), self.device)
+        return metrics.all_reduce()
+
+    @staticmethod
+    def _confusion_with(metrics, outputs, labels):
+        # Confusion counts including the current batch, which is added to `metrics` after the step
+        counts = ConfusionMatrix(outputs.size(1), outputs.device)
+        if metrics is not None:
+            counts.counts += metrics.counts
+        counts.update(outputs.detach().argmax(dim=1), labels)
+        return counts.matrix
+
+    def report(self, result):
+        if not is_main_process():
+            return
+        ms = result['step_ms']
+        print(f"[{self.name}] {result['images_per_sec']:.1f} img/s, {sum(ms.values()):.0f} ms/step "
+              f"(data {ms['data']:.0f}, forward {ms['forward']:.0f}, backward {ms['backward']:.0f}, "
+              f"optimizer {ms['optimizer']:.0f}), {self.precision}, accumulation x{result['accumulation_steps']}")
+
+    @torch.no_grad()
+    def predict(self, loader, transform=None):
+        """Float32 logits and labels of every sample, as numpy arrays (the
+        ``compute`` step of ``evaluation_cache.evaluate_cached``)."""
+        self.model.eval()
+        broadcast_buffers(self.model)
+        logits, labels_seen = [], []
+        for inputs, labels in loader:
+            inputs = inputs.to(self.device, non_blocking=True)
+            if transform is not None:
+                inputs = transform(inputs)
+            with self.autocast():
+                logits.append(logits_of(self.eval_model(inputs)).float())
+            labels_seen.append(labels)
+        logits, labels_seen = torch.cat(logits).cpu().numpy(), torch.cat(labels_seen).numpy()
+        if getattr(loader, 'sharded', False):
+            return gather_sharded(logits), gather_sharded(labels_seen)
+        return logits, labels_seen
+
+    @torch.no_grad()
+    def evaluate(self, loader, transform=None):
+        """Inference pass; returns the mean ``loss``, ``accuracy`` and the
+        ``metrics`` (a ``ConfusionMatrix``)."""
+        self.model.eval()
+        broadcast_buffers(self.model)
+        total_loss = torch.zeros((), device=self.device)
+        metrics = None
+        for inputs, labels in loader:
+            inputs = inputs.to(self.device, non_blocking=True)
+            labels = labels.to(self.device, non_blocking=True)
+            if transform is not None:
+                inputs = transform(inputs)
+            with self.autocast():
+                outputs = logits_of(self.eval_model(inputs)).float()
+            total_loss += self.criterion(outputs, labels) * labels.size(0)  # Mean over samples, not batches
+            if metrics is None:
+                metrics = ConfusionMatrix(outputs.size(1), self.device)
+            metrics.update(outputs.argmax(dim=1), labels)
+
+        if getattr(loader, 'sharded', False):
+            # Loss and counts of every rank's shard, so the metrics cover the whole set
+            all_reduce_sum(total_loss)
+            metrics = self._all_reduce_metrics(metrics)
+
+        return {
+            'loss': total_loss.item() / max(1, metrics.total if metrics is not None else 0),
+            'accuracy': metrics.accuracy() if metrics is not None else 0.0,
+            'metrics': metrics,
+        }
@@ -15,9 +15,36 @@ from tensorflow.keras import layers, models
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
 
+import image_loading
+from bottleneck_cache import cache_bottleneck_features, head_model
+from dataset_manifest import DatasetManifest
+from evaluation_cache import evaluate_cached
+from gradual_unfreezing import fit_unfreezing
+from keras_pipeline import flow_from_directory
+
+# Decode JPEGs at reduced resolution (DCT scaling) before the final resize,
+# set to False to decode at full resolution
+image_loading.FAST_DECODE = True
+
 # Define image size
 IMG_SIZE = (224, 224)  # Required input size for VGG16
 
+# Train the head on cached VGG16 features while the base is frozen (see bottleneck_cache.py).
+# AUGMENTED_VIEWS = 0 caches the plain images, N > 0 caches N augmented views of each image.
+# With False the head trains with model.fit on the augmented stream as before.
+BOTTLENECK_TRAINING = False
+AUGMENTED_VIEWS = 0
+BOTTLENECK_DIR = '/content/drive/MyDrive/bottlenecks'
+
+# Model outputs on the validation set are computed once per weights and reused by every report
+EVAL_CACHE_DIR = '/content/drive/MyDrive/eval_cache'
+
+# Fine-tuning with gradual unfreezing (gradual_unfreezing.py): instead of unfreezing
+# block5 by hand for all 30 epochs, block5 joins at UNFREEZE_AT[0] and block4 at
+# UNFREEZE_AT[1]. Until then they get no backward pass and no Adam state
+GRADUAL_UNFREEZING = False
+UNFREEZE_AT = [5, 15]
+
 # Load the VGG16 model pre-trained on ImageNet, without the top layers
 base_model = VGG16(weights='imagenet', include_top=False, input_shape=(224, 224, 3))
 
@@ -39,7 +66,7 @@ model.compile(optimizer=Adam(learning_rate=0.0001),
               loss='binary_crossentropy',
               metrics=['accuracy'])
 
-# Prepare the data generators
+# Prepare the data generators (tf.data pipelines configured by the ImageDataGenerators)
 
 # Data augmentation and rescaling for the training set
 train_datagen = ImageDataGenerator(
@@ -53,7 +80,8 @@ train_datagen = ImageDataGenerator(
 val_datagen = ImageDataGenerator(rescale=1./255)
 
 # Load and preprocess the training images
-train_generator = train_datagen.flow_from_directory(
+train_generator = flow_from_directory(
+    train_datagen,
     '/content/drive/MyDrive/data/train',              # Path to training data
     target_size=IMG_SIZE,       # Resize all images to 224x224 pixels
     batch_size=32,              # Number of images to be fed in each batch
@@ -61,21 +89,37 @@ train_generator = train_datagen.flow_from_directory(
 )
 
 # Load and preprocess the validation images
-validation_generator = val_datagen.flow_from_directory(
+validation_generator = flow_from_directory(
+    val_datagen,
     '/content/drive/MyDrive/data/test',          # Path to validation data
     target_size=IMG_SIZE,       # Resize all images to 224x224 pixels
     batch_size=32,              # Number of images in each batch
-    class_mode='binary'         # Binary classification
+    class_mode='binary',        # Binary classification
+    shuffle=False               # Keep predictions aligned with .classes
 )
 
 # Train the model using the data generators
-history = model.fit(
-    train_generator,
-    epochs=10,                  # Number of epochs to train
-)
+if BOTTLENECK_TRAINING:
+    # The frozen base runs once over the training images, the head trains on its outputs
+    feature_source = train_generator if AUGMENTED_VIEWS else flow_from_directory(
+        val_datagen, '/content/drive/MyDrive/data/train', target_size=IMG_SIZE, batch_size=32,
+        class_mode='binary', shuffle=False)
+    train_features = cache_bottleneck_features(base_model, feature_source, BOTTLENECK_DIR + '/vgg16_train',
+                                               views=max(1, AUGMENTED_VIEWS))
+    head = head_model(model, base_model)  # Shares its layers with model
+    head.compile(optimizer=Adam(learning_rate=0.0001), loss='binary_crossentropy', metrics=['accuracy'])
+    history = head.fit(
+        train_features.dataset(batch_size=32, shuffle=True),
+        epochs=10,              # Number of epochs to train
+    )
+else:
+    history = model.fit(
+        train_generator.dataset,
+        epochs=10,                  # Number of epochs to train
+    )
 
 # Evaluate the model on the validation set
-val_loss, val_acc = model.evaluate(validation_generator)
+val_loss, val_acc = model.evaluate(validation_generator.dataset)
 print(f'Validation Accuracy: {val_acc:.4f}')
 print(f'Validation Loss: {val_loss:.4f}')
 
@@ -107,7 +151,7 @@ from tensorflow.keras.preprocessing import image
 
 # Load and preprocess a single image
 img_path = '/content/drive/MyDrive/data/test/benign/1006.jpg'
-img = image.load_img(img_path, target_size=IMG_SIZE)
+img = image_loading.load_img(img_path, target_size=IMG_SIZE)  # Same as image.load_img, reduced-resolution decode
 img_array = image.img_to_array(img)
 img_array = np.expand_dims(img_array, axis=0)  # Add batch dimension
 img_array /= 255.  # Rescale like during training
@@ -132,7 +176,9 @@ from sklearn.metrics import f1_score
 import numpy as np
 
 # Make predictions on the validation set
-y_pred = model.predict(validation_generator)
+y_pred = evaluate_cached(EVAL_CACHE_DIR, 'vgg16-val', model.get_weights(), validation_generator,
+                         lambda: (model.predict(validation_generator.dataset), validation_generator.classes),
+                         transform=val_datagen, extra='224x224').outputs  # One pass per weights, then cached
 
 # Convert predictions to class labels (0 or 1)
 y_pred_classes = np.argmax(y_pred, axis=1)
@@ -153,9 +199,10 @@ from sklearn.metrics import classification_report
 
 print(classification_report(y_true_classes, y_pred_classes))
 
-# Unfreeze the last few layers of VGG16
-for layer in base_model.layers[-4:]:
-    layer.trainable = True
+# Unfreeze the last few layers of VGG16 (on the schedule of UNFREEZE_AT with GRADUAL_UNFREEZING)
+if not GRADUAL_UNFREEZING:
+    for layer in base_model.layers[-4:]:
+        layer.trainable = True
 
 model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'])
 
@@ -173,16 +220,17 @@ train_datagen = ImageDataGenerator(
 from sklearn.utils import class_weight
 import numpy as np
 
-# Get the classes from the generator
-class_indices = train_generator.class_indices  # Get class indices
+# Get the classes from the dataset manifest (no generator needed)
+train_manifest = DatasetManifest('/content/drive/MyDrive/data/train')
+class_indices = train_manifest.class_to_idx  # Get class indices
 num_classes = len(class_indices)  # Get number of classes
-y_train_classes = train_generator.classes  # Get the classes from the generator
+y_train_classes = train_manifest.targets  # Get the classes from the manifest
 
 # Calculate class weights
 class_weights = class_weight.compute_class_weight(
     class_weight='balanced',
     classes=np.array(list(class_indices.values())),  # The class labels
-    y=y_train_classes  # The actual labels from the generator
+    y=y_train_classes  # The actual labels from the manifest
 )
 
 # Convert to a dictionary for use in model fitting
@@ -190,21 +238,34 @@ class_weight_dict = dict(enumerate(class_weights))
 
 print("Class weights:", class_weight_dict)
 
-history = model.fit(
-    train_generator,
-    validation_data=validation_generator,
-    epochs=30,
-    class_weight=class_weight_dict,  # Pass the class weights
-)
+if GRADUAL_UNFREEZING:
+    history = fit_unfreezing(
+        model,
+        [base_model.layers[-4:], base_model.layers[-8:-4]],  # block5, then block4
+        UNFREEZE_AT,
+        train_generator.dataset,
+        validation_data=validation_generator.dataset,
+        epochs=30,
+        class_weight=class_weight_dict,
+    )
+else:
+    history = model.fit(
+        train_generator.dataset,
+        validation_data=validation_generator.dataset,
+        epochs=30,
+        class_weight=class_weight_dict,  # Pass the class weights
+    )
 
 # Evaluate the model on the validation set
-val_loss, val_accuracy = model.evaluate(validation_generator)
+val_loss, val_accuracy = model.evaluate(validation_generator.dataset)
 
 print(f'Validation Loss: {val_loss:.4f}')
 print(f'Validation Accuracy: {val_accuracy:.4f}')
 
 # Generate predictions
-y_pred = model.predict(validation_generator)
+y_pred = evaluate_cached(EVAL_CACHE_DIR, 'vgg16-val', model.get_weights(), validation_generator,
+                         lambda: (model.predict(validation_generator.dataset), validation_generator.classes),
+                         transform=val_datagen, extra='224x224').outputs  # One pass per weights, then cached
 y_pred_classes = (y_pred > 0.5).astype(int)  # Convert probabilities to binary predictions
 
 from sklearn.metrics import classification_report
@@ -289,7 +350,9 @@ model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy']
 from sklearn.metrics import accuracy_score, f1_score
 
 # Generate predictions
-y_pred = model.predict(validation_generator)
+y_pred = evaluate_cached(EVAL_CACHE_DIR, 'vgg16-val', model.get_weights(), validation_generator,
+                         lambda: (model.predict(validation_generator.dataset), validation_generator.classes),
+                         transform=val_datagen, extra='224x224').outputs  # One pass per weights, then cached
 y_pred_classes = (y_pred > 0.5).astype(int)  # Convert probabilities to binary predictions
 
 from sklearn.metrics import f1_score